@@ -0,0 +1,92 @@
+'''
+Benchmark for response compression (qbay.compression)
+
+Seeds a temporary SQLite database with products, renders the home page of
+a user, then compresses it with each encoding and level, reporting the
+compressed size, the bytes saved and the CPU time per response, to help
+pick compression_level (and brotli_quality, if brotli is installed)
+against egress costs.
+
+Usage:
+    python -m benchmarks.bench_compression [--rows 10000] [--limit 50]
+        [--seconds 1]
+'''
+import argparse
+import time
+
+from benchmarks.common import scratchDatabase, rawConnection, seedProducts
+
+# Point the app at a scratch database before qbay is imported
+scratchDatabase()
+
+from qbay import app, createApp  # NOQA: E402
+from qbay.compression import encodings, getCompressor  # NOQA: E402
+from qbay.models import db, createSchema, Session  # NOQA: E402
+
+# (encoding, level) configurations to measure, levels being brotli quality
+# for br and the zlib level otherwise
+CONFIGURATIONS = [
+    ('gzip', 1), ('gzip', 6), ('gzip', 9),
+    ('deflate', 6),
+    ('br', 1), ('br', 4), ('br', 6), ('br', 11),
+]
+
+
+def measure(body, encoding, level, seconds):
+    '''
+    Compress a body repeatedly for about the given number of seconds
+      Returns:
+        (compressed size, CPU seconds per response)
+    '''
+    count = 0
+    start = time.process_time()
+    while time.process_time() - start < seconds:
+        compressor = getCompressor(encoding, level, level)
+        data = compressor.compress(body) + compressor.finish()
+        count += 1
+    return len(data), (time.process_time() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--limit', type=int, default=50,
+                        help='products on the home page')
+    parser.add_argument('--seconds', type=float, default=1,
+                        help='time spent measuring each configuration')
+    args = parser.parse_args()
+
+    createApp()
+    with app.app_context():
+        createSchema()
+        raw, conn = rawConnection(db.engine)
+        print(f'Seeding {args.rows} products...')
+        seedProducts(conn, args.rows, max(1, args.rows // 100))
+        raw.close()
+        sessionId = Session.query.first().sessionId
+        db.session.remove()
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = sessionId
+    response = client.get(f'/?limit={args.limit}',
+                          environ_base={'REMOTE_ADDR': '127.0.0.1'})
+    if response.status_code != 200:
+        raise SystemExit(f'Home page failed with {response.status}')
+    body = response.data
+
+    print(f'\nHome page: {len(body)} bytes\n')
+    print(f"{'encoding':<10}{'level':>6}{'bytes':>9}{'saved':>8}"
+          f"{'ms/resp':>9}{'MB/s':>8}")
+    available = encodings()
+    for encoding, level in CONFIGURATIONS:
+        if encoding not in available:
+            continue
+        size, cpu = measure(body, encoding, level, args.seconds)
+        print(f'{encoding:<10}{level:>6}{size:>9}'
+              f'{1 - size / len(body):>8.1%}{cpu * 1000:>9.3f}'
+              f'{len(body) / cpu / 1e6:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+'''
+Microbenchmark for the password hashers in qbay.hashing
+
+Reports hashes per second and the time per hash for each algorithm and cost,
+to help pick a password_hash_cost that fits the login latency budget.
+
+Usage:
+    python -m benchmarks.bench_hashing [--seconds 2]
+'''
+import argparse
+import time
+
+from qbay.hashing import getHasher
+
+# (algorithm, cost) configurations to measure
+CONFIGURATIONS = [
+    ('pbkdf2_sha256', 50000),
+    ('pbkdf2_sha256', 100000),
+    ('pbkdf2_sha256', 260000),
+    ('pbkdf2_sha256', 600000),
+    ('scrypt', 2 ** 13),
+    ('scrypt', 2 ** 14),
+    ('scrypt', 2 ** 15),
+    ('scrypt', 2 ** 16),
+]
+
+
+def measure(hasher, seconds):
+    '''
+    Hash repeatedly for about the given number of seconds
+      Returns:
+        Hashes per second
+    '''
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        hasher.hash('P&ssw0rd')
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--seconds', type=float, default=2,
+                        help='time spent measuring each configuration')
+    args = parser.parse_args()
+
+    print(f"{'algorithm':<16}{'cost':>10}{'hashes/s':>12}{'ms/hash':>10}")
+    for name, cost in CONFIGURATIONS:
+        rate = measure(getHasher(name, cost), args.seconds)
+        print(f"{name:<16}{cost:>10}{rate:>12.1f}{1000 / rate:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
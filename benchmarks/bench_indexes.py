@@ -0,0 +1,101 @@
+'''
+Benchmark for the indexes declared in qbay.models
+
+Seeds a temporary SQLite database with products, then runs each hot lookup
+with and without the declared indexes, printing the EXPLAIN QUERY PLAN and
+the average query time for both.
+
+Usage:
+    python -m benchmarks.bench_indexes [--rows 1000000] [--users 10000]
+'''
+import argparse
+import time
+
+from benchmarks.common import scratchDatabase, rawConnection, seedProducts
+
+# Point the app at a scratch database before qbay is imported
+scratchDatabase()
+
+from qbay import app  # NOQA: E402
+from qbay.models import db, createSchema, Product, Session  # NOQA: E402
+
+# (name, SQL, parameters) for every hot lookup in backend and controllers
+LOOKUPS = [
+    ('login/validateEmail',
+     'SELECT * FROM user WHERE email = ?', ('user5000@bench.com',)),
+    ('validateProductParameters',
+     'SELECT * FROM product WHERE ownerEmail = ? AND productName = ?',
+     ('user5000@bench.com', 'Product 5000')),
+    ('updateProduct_get',
+     'SELECT * FROM product WHERE userId = ? AND productName = ?',
+     ('{user}', 'Product 5000')),
+    ('home own products',
+     'SELECT * FROM product WHERE userId = ? AND sold = 0', ('{user}',)),
+    ('home purchases',
+     'SELECT * FROM product WHERE buyerId = ?', ('{user}',)),
+    ('home listing',
+     'SELECT * FROM product WHERE sold = 0 AND userId != ? '
+     'ORDER BY lastModifiedDate DESC, id DESC LIMIT 51', ('{user}',)),
+    ('authenticate',
+     'SELECT * FROM session WHERE sessionId = ? AND ipAddress = ?',
+     ('{session}', '127.0.0.1')),
+]
+
+
+def run(conn, params, repeat=20):
+    '''
+    Run every lookup, returning (name, plan, milliseconds per query)
+    '''
+    results = []
+    for name, sql, args in LOOKUPS:
+        args = tuple(params.get(a.strip('{}'), a) for a in args)
+        plan = '; '.join(r[-1] for r in
+                         conn.execute('EXPLAIN QUERY PLAN ' + sql, args))
+        start = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(sql, args).fetchall()
+        elapsed = (time.perf_counter() - start) / repeat * 1000
+        results.append((name, plan, elapsed))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        createSchema()
+        indexes = list(Product.__table__.indexes) \
+            + list(Session.__table__.indexes)
+        raw, conn = rawConnection(db.engine)
+
+        # Measure without any of the declared indexes first
+        for index in indexes:
+            index.drop(db.engine)
+        print(f'Seeding {args.rows} products...')
+        start = time.perf_counter()
+        user = seedProducts(conn, args.rows, args.users)[5000 % args.users]
+        print(f'Seeded in {time.perf_counter() - start:.1f}s')
+        params = {
+            'user': user,
+            'session': conn.execute('SELECT sessionId FROM session '
+                                    'WHERE userId = ?', (user,)).fetchone()[0]
+        }
+        before = run(conn, params)
+
+        for index in indexes:
+            index.create(db.engine)
+        conn.execute('ANALYZE')
+        after = run(conn, params)
+        raw.close()
+
+    for (name, planA, timeA), (_, planB, timeB) in zip(before, after):
+        print(f'\n{name}: {timeA:.3f}ms -> {timeB:.3f}ms')
+        print(f'  before: {planA}')
+        print(f'  after:  {planB}')
+
+
+if __name__ == '__main__':
+    main()
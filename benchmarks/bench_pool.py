@@ -0,0 +1,126 @@
+'''
+Stress benchmark for the database connection pool
+
+Runs product lookups from many threads at once through pools of different
+sizes, each lookup holding its connection for a simulated network round
+trip, and reports throughput, the time spent waiting for a connection and
+the checkouts that timed out, to help pick db_pool_size for a number of
+server threads.
+
+Runs against db_string if it is set, such as the MySQL service in
+docker-compose.yml with some products in it, otherwise against a scratch
+SQLite database seeded with products.
+
+Usage:
+    python -m benchmarks.bench_pool [--pool-sizes 2,5,10,20]
+        [--threads 4,16,64] [--seconds 3] [--hold 2] [--timeout 5]
+'''
+import argparse
+import os
+import random
+import threading
+import time
+
+from benchmarks.common import scratchDatabase, rawConnection, seedProducts
+
+# Point the app at a scratch database before qbay is imported
+scratch = not os.getenv('db_string')
+if scratch:
+    scratchDatabase()
+
+from qbay import app  # NOQA: E402
+from qbay.models import db, createSchema, engineOptions, \
+    TimedQueuePool  # NOQA: E402
+from sqlalchemy import create_engine, text  # NOQA: E402
+from sqlalchemy.exc import TimeoutError as PoolTimeout  # NOQA: E402
+
+LOOKUP = text('SELECT * FROM product WHERE id = :id')
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] \
+        if values else 0.0
+
+
+def stress(engine, ids, threads, seconds, hold):
+    '''
+    Run lookups from several threads for a fixed time
+      Returns:
+        (lookups, timeouts)
+    '''
+    counts = [0] * threads
+    timeouts = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def run(i):
+        rand = random.Random(i)
+        while time.perf_counter() < deadline:
+            try:
+                with engine.connect() as conn:
+                    conn.execute(LOOKUP,
+                                 {'id': rand.choice(ids)}).fetchall()
+                    # The rest of a round trip to a database server
+                    time.sleep(hold)
+                counts[i] += 1
+            except PoolTimeout:
+                timeouts[i] += 1
+
+    workers = [threading.Thread(target=run, args=(i,))
+               for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts), sum(timeouts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--pool-sizes', default='2,5,10,20')
+    parser.add_argument('--threads', default='4,16,64')
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--hold', type=float, default=2,
+                        help='milliseconds each lookup holds its connection')
+    parser.add_argument('--timeout', type=float, default=5,
+                        help='seconds a checkout may wait (db_pool_timeout)')
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        createSchema()
+        if scratch:
+            raw, conn = rawConnection(db.engine)
+            print(f'Seeding {args.rows} products...')
+            seedProducts(conn, args.rows, max(1, args.rows // 100))
+            raw.close()
+        ids = [row[0] for row in db.session.execute(
+            text('SELECT id FROM product LIMIT 10000'))]
+        url = db.engine.url
+        db.session.remove()
+    if not ids:
+        raise SystemExit('No products to look up')
+
+    waits = []
+    TimedQueuePool.observer = lambda wait, timedOut: waits.append(wait)
+    print(f'\n{"pool":>5} {"threads":>8} {"lookups/s":>10} '
+          f'{"wait mean":>10} {"wait p99":>9} {"timeouts":>9}')
+    for size in map(int, args.pool_sizes.split(',')):
+        for threads in map(int, args.threads.split(',')):
+            config = dict(app.config, DB_POOL_SIZE=size, DB_MAX_OVERFLOW=0,
+                          DB_POOL_TIMEOUT=args.timeout)
+            engine = create_engine(url, **engineOptions(config))
+            # Open the connections first, so only waiting is measured
+            stress(engine, ids, size, 0.1, 0)
+            waits.clear()
+            lookups, timeouts = stress(engine, ids, threads, args.seconds,
+                                       args.hold / 1000)
+            engine.dispose()
+            print(f'{size:>5} {threads:>8} {lookups / args.seconds:>10.0f} '
+                  f'{sum(waits) / max(len(waits), 1) * 1000:>8.2f}ms '
+                  f'{percentile(waits, 0.99) * 1000:>7.2f}ms '
+                  f'{timeouts:>9}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+'''
+Benchmark for backend.searchProducts
+
+Seeds a temporary SQLite database with products that have random
+descriptions, then times searches for single words and word pairs through
+the FTS5 index, reporting the median and 99th percentile latency.
+
+Usage:
+    python -m benchmarks.bench_search [--rows 1000000] [--queries 200]
+'''
+import argparse
+import random
+import string
+import time
+
+from benchmarks.common import scratchDatabase, rawConnection, seedProducts
+
+# Point the app at a scratch database before qbay is imported
+scratchDatabase()
+
+from qbay import app  # NOQA: E402
+from qbay.models import db, createSchema  # NOQA: E402
+from qbay.backend import searchProducts  # NOQA: E402
+
+
+def vocabulary(size, rand):
+    '''
+    Generate random lowercase words to build descriptions from
+    '''
+    return [''.join(rand.choice(string.ascii_lowercase)
+                    for _ in range(rand.randint(4, 9)))
+            for _ in range(size)]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--words', type=int, default=20000,
+                        help='vocabulary size for descriptions')
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    rand = random.Random(0)
+    words = vocabulary(args.words, rand)
+    with app.app_context():
+        createSchema()
+        raw, conn = rawConnection(db.engine)
+        print(f'Seeding {args.rows} products...')
+        start = time.perf_counter()
+        seedProducts(conn, args.rows, args.users, words)
+        conn.execute(
+            "INSERT INTO product_fts(product_fts) VALUES ('optimize')")
+        conn.commit()
+        raw.close()
+        print(f'Seeded and indexed in {time.perf_counter() - start:.1f}s')
+
+        for name, size in [('one word', 1), ('two words', 2)]:
+            timings = []
+            found = 0
+            for _ in range(args.queries):
+                query = ' '.join(rand.choice(words) for _ in range(size))
+                start = time.perf_counter()
+                products, _ = searchProducts(query)
+                timings.append((time.perf_counter() - start) * 1000)
+                found += len(products)
+                db.session.remove()
+            print(f'{name}: p50 {percentile(timings, 0.5):.2f}ms, '
+                  f'p99 {percentile(timings, 0.99):.2f}ms, '
+                  f'{found / args.queries:.1f} results per page')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+'''
+Benchmark for the SQLite production profile (qbay.sqlite)
+
+Seeds a temporary SQLite database with products, then runs a mix of home
+page listings and login-like writes from many threads, against a copy of
+the database with the default settings and a copy with
+sqlite_profile=production, reporting reads and writes per second, the 99th
+percentile write latency and the writes that failed with "database is
+locked".
+
+Usage:
+    python -m benchmarks.bench_sqlite [--threads 16] [--writes 0.2]
+        [--seconds 5] [--rows 100000]
+'''
+import argparse
+import os
+import random
+import shutil
+import threading
+import time
+from uuid import uuid4
+
+from benchmarks.common import scratchDatabase, rawConnection, seedProducts
+
+# Point the app at a scratch database before qbay is imported
+database = scratchDatabase()
+
+from qbay import app  # NOQA: E402
+from qbay.models import db, createSchema, engineOptions  # NOQA: E402
+from sqlalchemy import create_engine, text  # NOQA: E402
+from sqlalchemy.exc import OperationalError  # NOQA: E402
+
+LISTING = text('SELECT * FROM product WHERE sold = 0 '
+               'ORDER BY lastModifiedDate DESC, id DESC LIMIT 51')
+DEBIT = text('UPDATE user SET balance = balance + 1 WHERE id = :id')
+LOGIN = text('INSERT INTO session (sessionId, userId, ipAddress) '
+             'VALUES (:sid, :id, \'127.0.0.1\')')
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] \
+        if values else 0.0
+
+
+def run(engine, userIds, threads, writeRatio, seconds):
+    '''
+    Run the read and write mix from several threads for a fixed time
+      Returns:
+        (reads, write latencies, failed writes)
+    '''
+    reads = [0] * threads
+    writes = [[] for _ in range(threads)]
+    failed = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def work(i):
+        rand = random.Random(i)
+        while time.perf_counter() < deadline:
+            if rand.random() >= writeRatio:
+                with engine.connect() as conn:
+                    conn.execute(LISTING).fetchall()
+                reads[i] += 1
+                continue
+            start = time.perf_counter()
+            try:
+                with engine.begin() as conn:
+                    uid = rand.choice(userIds)
+                    conn.execute(DEBIT, {'id': uid})
+                    conn.execute(LOGIN, {'sid': uuid4().bytes, 'id': uid})
+                writes[i].append(time.perf_counter() - start)
+            except OperationalError:
+                failed[i] += 1
+
+    workers = [threading.Thread(target=work, args=(i,))
+               for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(reads), [w for ws in writes for w in ws], sum(failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--writes', type=float, default=0.2,
+                        help='share of operations that write')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        createSchema()
+        raw, conn = rawConnection(db.engine)
+        print(f'Seeding {args.rows} products...')
+        userIds = seedProducts(conn, args.rows, args.users)
+        raw.close()
+        db.engine.dispose()
+
+    print(f'\n{"profile":>10} {"reads/s":>9} {"writes/s":>9} '
+          f'{"write p99":>10} {"locked":>7}')
+    for profile in ['default', 'production']:
+        # Each profile gets its own copy, as WAL mode stays with the file
+        path = os.path.join(os.path.dirname(database), f'{profile}.sqlite')
+        shutil.copy(database, path)
+        config = dict(app.config, SQLITE_PROFILE=profile,
+                      SQLALCHEMY_DATABASE_URI=f'sqlite:///{path}')
+        engine = create_engine(config['SQLALCHEMY_DATABASE_URI'],
+                               **engineOptions(config))
+        reads, writes, failed = run(engine, userIds, args.threads,
+                                    args.writes, args.seconds)
+        engine.dispose()
+        print(f'{profile:>10} {reads / args.seconds:>9.0f} '
+              f'{len(writes) / args.seconds:>9.0f} '
+              f'{percentile(writes, 0.99) * 1000:>8.1f}ms {failed:>7}')
+
+
+if __name__ == '__main__':
+    main()
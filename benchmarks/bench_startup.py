@@ -0,0 +1,69 @@
+'''
+Benchmark for startup time
+
+Imports each entry point in a fresh interpreter with `python -X importtime`,
+a few times each, and prints the median import time, the modules that take
+the longest themselves, and whether importing touched the database.
+
+Usage:
+    python -m benchmarks.bench_startup [--runs 5] [--top 8]
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.common import scratchDatabase
+
+# What a script, the image workers and the web server import
+TARGETS = ['qbay', 'qbay.backend', 'qbay.images', 'qbay.controllers']
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def importTimes(module):
+    '''
+    Import a module in a new interpreter
+      Returns:
+        (wall seconds, {module: (self us, cumulative us)})
+    '''
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             f'import {module}'],
+                            cwd=ROOT, capture_output=True, text=True,
+                            check=True)
+    wall = time.perf_counter() - start
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return wall, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=8)
+    args = parser.parse_args()
+    database = scratchDatabase()
+
+    for target in TARGETS:
+        runs = [importTimes(target) for _ in range(args.runs)]
+        wall = statistics.median(wall for wall, _ in runs)
+        total = statistics.median(times[target][1] for _, times in runs)
+        heavy = [name for name in ('sqlalchemy_imageattach', 'wand')
+                 if name in runs[-1][1]]
+        print(f'\nimport {target}: {total / 1000:.1f}ms '
+              f'({wall * 1000:.0f}ms with interpreter startup)')
+        print(f'  database created: {os.path.exists(database)}, '
+              f'imaging loaded: {", ".join(heavy) or "no"}')
+        slowest = sorted(runs[-1][1].items(), key=lambda item: -item[1][0])
+        for name, (own, _) in slowest[:args.top]:
+            print(f'  {own / 1000:8.1f}ms  {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''
+Benchmark for binary UUID keys (qbay.models.BinaryUUID)
+
+Seeds a temporary SQLite database with IDs stored as 36 character strings,
+as versions before BinaryUUID did, measures the size of every table and
+index and the speed of joins and key lookups, then converts the IDs with
+migrateUUIDs and measures again.
+
+Usage:
+    python -m benchmarks.bench_uuids [--rows 1000000] [--users 10000]
+'''
+import argparse
+import random
+import time
+
+from benchmarks.common import scratchDatabase, rawConnection, seedProducts
+
+# Point the app at a scratch database before qbay is imported
+scratchDatabase()
+
+from qbay import app  # NOQA: E402
+from qbay.models import db, createSchema, migrateUUIDs  # NOQA: E402
+
+JOIN = ('SELECT user.username, count(*) FROM product '
+        'JOIN user ON user.id = product.userId '
+        'WHERE product.sold = 0 GROUP BY user.id')
+LOOKUP = 'SELECT * FROM product WHERE id = ?'
+
+
+def sizes(conn):
+    '''
+    Get the bytes used by every table and index, from the dbstat table
+    '''
+    return dict(conn.execute('SELECT name, sum(pgsize) FROM dbstat '
+                             'GROUP BY name ORDER BY name'))
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def measure(conn, ids):
+    '''
+    Time the join and key lookups
+      Returns:
+        (ms per join, ms per 1000 lookups)
+    '''
+    join = timed(lambda: conn.execute(JOIN).fetchall(), 3)
+    lookups = timed(lambda: [conn.execute(LOOKUP, (i,)).fetchall()
+                             for i in ids], 3)
+    return join, lookups
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        createSchema()
+        raw, conn = rawConnection(db.engine)
+        print(f'Seeding {args.rows} products with text IDs...')
+        seedProducts(conn, args.rows, args.users, textIds=True)
+        conn.execute('ANALYZE')
+        rand = random.Random(0)
+        sample = [row[0] for row in
+                  conn.execute('SELECT id FROM product').fetchall()]
+        textIds = rand.sample(sample, min(1000, len(sample)))
+        beforeSizes = sizes(conn)
+        before = measure(conn, textIds)
+
+        start = time.perf_counter()
+        converted = migrateUUIDs()
+        conn.execute('VACUUM')
+        print(f'Converted {converted} IDs in '
+              f'{time.perf_counter() - start:.1f}s')
+        binaryIds = [row[0] for row in conn.execute(
+            'SELECT id FROM product').fetchall()]
+        binaryIds = rand.sample(binaryIds, min(1000, len(binaryIds)))
+        afterSizes = sizes(conn)
+        after = measure(conn, binaryIds)
+        raw.close()
+
+    print(f'\n{"table or index":32} {"text":>12} {"binary":>12}')
+    for name in sorted(beforeSizes):
+        if name.startswith(('product', 'user', 'session', 'ix_product',
+                            'ix_session', 'sqlite_autoindex')):
+            print(f'{name:32} {beforeSizes[name]:>12} '
+                  f'{afterSizes.get(name, 0):>12}')
+    total = sum(beforeSizes.values()), sum(afterSizes.values())
+    print(f'{"total":32} {total[0]:>12} {total[1]:>12}')
+    print(f'\njoin products to sellers: {before[0]:.1f}ms -> '
+          f'{after[0]:.1f}ms')
+    print(f'1000 product lookups by ID: {before[1]:.1f}ms -> '
+          f'{after[1]:.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''
+Helpers shared by the benchmarks
+'''
+import datetime as dt
+import os
+import random
+import tempfile
+from uuid import uuid4
+
+
+def scratchDatabase():
+    '''
+    Point the app at an empty SQLite database in a temporary directory
+    Must be called before qbay is imported
+      Returns:
+        Path of the database file
+    '''
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    os.environ['db_string'] = 'sqlite:///' + path
+    return path
+
+
+def rawConnection(engine):
+    '''
+    Get the DBAPI connection under a SQLAlchemy engine, for fast seeding
+      Returns:
+        (pool connection, DBAPI connection), close the first when done
+    '''
+    raw = engine.raw_connection()
+    conn = raw.driver_connection if hasattr(raw, 'driver_connection') \
+        else raw.connection
+    return raw, conn
+
+
+def seedProducts(conn, rows, users, words=None, seed=0, textIds=False):
+    '''
+    Insert users, one session per user and products with executemany
+      Parameters:
+        conn:           DBAPI connection
+        rows (int):     number of products
+        users (int):    number of users owning the products
+        words (list):   vocabulary for random descriptions, None for a
+                        fixed description
+        seed (int):     random seed, so runs are comparable
+        textIds (bool): store IDs as 36 character strings, as versions
+                        before models.BinaryUUID did
+      Returns:
+        List of user IDs, as stored
+    '''
+    rand = random.Random(seed)
+
+    def newId():
+        return str(uuid4()) if textIds else uuid4().bytes
+
+    userIds = [newId() for _ in range(users)]
+    conn.executemany(
+        'INSERT INTO user (id, username, email, password, balance) '
+        'VALUES (?, ?, ?, ?, 100)',
+        [(uid, f'user{i}', f'user{i}@bench.com', '')
+         for i, uid in enumerate(userIds)])
+    conn.executemany(
+        'INSERT INTO session (sessionId, userId, ipAddress) '
+        'VALUES (?, ?, ?)',
+        [(newId(), uid, '127.0.0.1') for uid in userIds])
+
+    base = dt.datetime(2021, 10, 8)
+    batch = []
+    for i in range(rows):
+        owner = i % users
+        sold = i % 10 == 0
+        description = ' '.join(rand.choice(words) for _ in range(12)) \
+            if words else 'Benchmark product'
+        batch.append((newId(), f'Product {i}', userIds[owner],
+                      f'user{owner}@bench.com', 10.0, description,
+                      base + dt.timedelta(seconds=i), sold,
+                      userIds[(owner + 1) % users] if sold else None))
+        if len(batch) == 50000:
+            _insertProducts(conn, batch)
+            batch = []
+    _insertProducts(conn, batch)
+    conn.commit()
+    return userIds
+
+
+def _insertProducts(conn, batch):
+    conn.executemany(
+        'INSERT INTO product (id, productName, userId, ownerEmail, price, '
+        'description, lastModifiedDate, sold, buyerId) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
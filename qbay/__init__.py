@@ -11,3 +11,97 @@ if db_string:
 else:
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///../db.sqlite'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Read replicas, comma separated URIs, used by models.replicaReads
+app.config['SQLALCHEMY_BINDS'] = {
+    f'replica{i}': uri
+    for i, uri in enumerate(filter(None, os.getenv('db_replicas',
+                                                   '').split(',')))}
+# Seconds a user's reads stay on the primary after they write, so they see
+# their own changes before the replicas catch up
+app.config['REPLICA_READ_AFTER_WRITE'] = float(
+    os.getenv('replica_read_after_write', 5))
+# Connections kept open per process, and extra ones opened under load
+app.config['DB_POOL_SIZE'] = int(os.getenv('db_pool_size', 10))
+app.config['DB_MAX_OVERFLOW'] = int(os.getenv('db_max_overflow', 10))
+# Seconds a request waits for a free connection before failing with 503
+app.config['DB_POOL_TIMEOUT'] = float(os.getenv('db_pool_timeout', 5))
+# Seconds before a connection is replaced, below MySQL's wait_timeout
+app.config['DB_POOL_RECYCLE'] = int(os.getenv('db_pool_recycle', 1800))
+# Test connections before use, replacing ones the server has closed
+app.config['DB_POOL_PRE_PING'] = \
+    os.getenv('db_pool_pre_ping', 'true').lower() in ('1', 'true', 'yes')
+# SQLite profile, production for WAL mode and queued writes, see qbay.sqlite
+app.config['SQLITE_PROFILE'] = os.getenv('sqlite_profile', 'default')
+app.config['SQLITE_MMAP_SIZE'] = int(os.getenv('sqlite_mmap_size',
+                                               256 * 1024 * 1024))
+app.config['SQLITE_CACHE_SIZE'] = int(os.getenv('sqlite_cache_size',
+                                                64 * 1024 * 1024))
+# Seconds a write waits for the database to be free
+app.config['SQLITE_BUSY_TIMEOUT'] = float(os.getenv('sqlite_busy_timeout',
+                                                    5))
+# Authenticated sessions are cached in process, see qbay.cache
+app.config['SESSION_CACHE_SIZE'] = int(os.getenv('session_cache_size', 10000))
+app.config['SESSION_CACHE_TTL'] = float(os.getenv('session_cache_ttl', 60))
+# Rendered product listings and the catalog version are cached in process
+# until the catalog changes, and for at most FRAGMENT_CACHE_TTL seconds, after
+# which other processes' changes show
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.getenv('fragment_cache_size',
+                                                  1000))
+app.config['FRAGMENT_CACHE_TTL'] = float(os.getenv('fragment_cache_ttl', 10))
+# Failed logins allowed per email before further attempts are rejected for
+# LOGIN_FAILURE_TTL seconds without checking the database
+app.config['LOGIN_FAILURE_LIMIT'] = int(os.getenv('login_failure_limit', 5))
+app.config['LOGIN_FAILURE_TTL'] = float(os.getenv('login_failure_ttl', 60))
+# Emails whose failure counts are kept, least recently failed dropped first
+app.config['LOGIN_FAILURE_CACHE_SIZE'] = int(
+    os.getenv('login_failure_cache_size', 10000))
+# Password hashing algorithm and work factor, see qbay.hashing
+app.config['PASSWORD_HASHER'] = os.getenv('password_hasher', 'pbkdf2_sha256')
+app.config['PASSWORD_HASH_COST'] = int(os.getenv('password_hash_cost', 0))
+# Hashing worker pool: none, thread or process
+app.config['PASSWORD_HASH_EXECUTOR'] = os.getenv('password_hash_executor',
+                                                 'none')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('password_hash_workers',
+                                                    os.cpu_count() or 1))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.getenv('password_hash_queue', 32))
+# Product image store and thumbnail widths, see qbay.images
+app.config['IMAGE_STORE'] = os.getenv(
+    'image_store', os.path.join(app.root_path, os.pardir, 'images'))
+app.config['THUMBNAIL_SIZES'] = [
+    int(width) for width in os.getenv('thumbnail_sizes', '160,480').split(',')]
+app.config['IMAGE_WORKERS'] = int(os.getenv('image_workers', 2))
+# Upload and resize limits for product images
+app.config['IMAGE_MAX_SIZE'] = int(os.getenv('image_max_size',
+                                             10 * 1024 * 1024))
+app.config['IMAGE_MAX_PIXELS'] = int(os.getenv('image_max_pixels',
+                                               25_000_000))
+app.config['IMAGE_RESIZE_MEMORY'] = int(os.getenv('image_resize_memory',
+                                                  1024 * 1024 * 1024))
+app.config['IMAGE_RESIZE_TIMEOUT'] = float(os.getenv('image_resize_timeout',
+                                                     30))
+# Bearer token Prometheus must send to read /_metrics, which is not served
+# at all without one
+app.config['METRICS_TOKEN'] = os.getenv('metrics_token')
+# Response compression, see qbay.compression: zlib level for gzip and
+# deflate, brotli quality, and the smallest body worth compressing in bytes
+app.config['COMPRESSION_LEVEL'] = int(os.getenv('compression_level', 6))
+app.config['BROTLI_QUALITY'] = int(os.getenv('brotli_quality', 4))
+app.config['COMPRESSION_MIN_SIZE'] = int(os.getenv('compression_min_size',
+                                                   500))
+
+
+def createApp():
+    '''
+    Get the web application with every route registered
+    Importing qbay only configures the app, so scripts and workers using
+    qbay.backend don't load the routes, templates or image libraries, and
+    don't connect to the database. Tables are created separately, see
+    models.createSchema
+      Returns:
+        The Flask application
+    '''
+    # Registers the routes, CLI commands and request metrics
+    from qbay import controllers  # NOQA
+    from qbay.compression import installCompression
+    installCompression(app)
+    return app
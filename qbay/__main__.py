@@ -1,13 +1,49 @@
-# Supress Flake8 warnings on the imports, as they are required but unused
-from qbay import app
-from qbay.models import * # NOQA
-from qbay.backend import * # NOQA
-from qbay.controllers import * # NOQA
+import argparse
+import os
+from qbay import createApp
+from qbay.backend import startSessionSweeper
+from qbay.models import createSchema
 
 """
 This file runs the server at a given port
+
+By default on the Werkzeug development server, with the debugger and code
+reloading. With --production, or server=production in the environment, on
+Gunicorn with several worker processes, see qbay.server
 """
 FLASK_PORT = 8081
 
+
+def parseArgs():
+    parser = argparse.ArgumentParser(prog='python -m qbay')
+    parser.add_argument('--production', action='store_true',
+                        default=os.getenv('server') == 'production',
+                        help='serve with Gunicorn worker processes')
+    parser.add_argument('--port', type=int,
+                        default=int(os.getenv('port', FLASK_PORT)))
+    parser.add_argument('--workers', type=int,
+                        default=int(os.getenv('server_workers',
+                                              2 * (os.cpu_count() or 1) + 1)),
+                        help='worker processes, with --production')
+    parser.add_argument('--threads', type=int,
+                        default=int(os.getenv('server_threads', 4)),
+                        help='request threads per worker, with --production')
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    app.run(debug=True, port=FLASK_PORT, host='0.0.0.0')
+    args = parseArgs()
+    app = createApp()
+    with app.app_context():
+        createSchema()
+    # Periodically delete expired sessions if an interval is configured
+    sweepInterval = os.getenv('session_sweep_interval')
+    sweepInterval = float(sweepInterval) if sweepInterval else None
+    if args.production:
+        from qbay.server import serveProduction
+        serveProduction(app, args.port, args.workers, args.threads,
+                        sweepInterval)
+    else:
+        if sweepInterval:
+            startSessionSweeper(app, sweepInterval)
+        app.run(debug=True, port=args.port, host='0.0.0.0')
@@ -1,10 +1,30 @@
-from qbay.models import db, User, Product, Session
+from qbay import app
+from qbay.models import db, User, Product, Session, Transaction, \
+    CatalogVersion, replicaReads
+from qbay.cache import sessionCache, loginFailures, catalogFragments, \
+    catalogVersions
+from qbay.hashing import hashPassword, verifyPassword, needsRehash
+from sqlalchemy import and_, or_, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from validate_email import validate_email
 from uuid import uuid4
+import base64
 import datetime as dt
-import hashlib
 import json
+import random
 import re
+import threading
+import time
+
+# Default and maximum number of products on a page of the product listing
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# Number of expired sessions deleted per statement by sweepSessions
+SWEEP_BATCH_SIZE = 1000
+# Number of times a purchase is retried after a deadlock or lock timeout
+PURCHASE_RETRIES = 5
 
 
 '''
@@ -27,25 +47,27 @@ def login(email, password, ip):
        or not validatePswd(password):
         return None
 
-    matches = User.query.filter_by(email=email).all()
-    user = None
-    # Check results for a password match
-    for m in matches:
-        # Extract salt from string
-        salt = m.password.split(":")[0]
-        # Hash input with salt and compare to target
-        if(m.password == salt + ":"
-           + hashlib.sha512((password + salt).encode('utf-8')).hexdigest()):
-            user = m
-            break
-    if user is None:
+    # Reject emails that keep failing without going to the database
+    failures = loginFailures.get(email) or 0
+    if failures >= app.config['LOGIN_FAILURE_LIMIT']:
         return None
 
-    time = dt.datetime.now()
+    # Email is unique, so there is at most one user to check
+    user = User.query.filter_by(email=email).one_or_none()
+    if user is None or not verifyPassword(password, user.password):
+        loginFailures.put(email, failures + 1)
+        return None
+    loginFailures.invalidate(email)
+
+    # Upgrade hashes from older algorithms or costs, committed with session
+    if needsRehash(user.password):
+        user.password = hashPassword(password)
+
+    now = dt.datetime.now()
     s = Session(user=user, userId=user.id, ipAddress=ip,
                 sessionId=str(uuid4()),
                 # Session expires after a year
-                expiry=dt.datetime(time.year+1, time.month, time.day))
+                expiry=dt.datetime(now.year+1, now.month, now.day))
     db.session.add(s)
     db.session.commit()
     return s
@@ -142,17 +164,15 @@ def register(name, email, password):
     '''
     if validateEmail(email) and validateUser(name) and validatePswd(password):
         # create a new user
-        salt = uuid4()
-        # Generate string from salt and hashed password
-        hashed = str(salt) + ":" + hashlib.sha512((password + str(salt))
-                                                  .encode('utf-8')).hexdigest()
         user = User(id=str(uuid4()), username=name, email=email,
-                    password=hashed, balance=100, shippingAddress="",
-                    postalCode="")
+                    password=hashPassword(password), balance=100,
+                    shippingAddress="", postalCode="")
         # add it to the current database session
         db.session.add(user)
         # actually save the user object
         db.session.commit()
+        # failures guessed at the email before it existed don't count
+        loginFailures.invalidate(email)
         return True
 
     return False
@@ -178,23 +198,19 @@ def queryUser(email, attribute, value):
     return False
 
 
-def validateProductParameters(productName, description, price,
-                              last_modified_date, owner_email,
-                              ignoreEmail=False, exceptions=False):
+def checkProductFields(productName, description, price,
+                       last_modified_date, owner_email):
     """
-    Create a Product
+    Check the product fields that can be validated without the database
       Parameters:
         productName (string):           product name
         description (string):           product description
         price (float):                  product price
         last_modified_date (DateTime):  product object last modified date
         owner_email:                    product owner's email
-        ignoreEmail:                    flag to bypass email check,
-                                            for updateProduct
-        exceptions:                    flag for if exceptions should be raised
 
-      Returns:
-        True if product parameters are vaild, otherwise False
+      Raises:
+        ValueError with error message if a field is invalid
     """
     # If the title without spaces is not alphanumeric-only,
     # or begins or ends in a space
@@ -203,71 +219,85 @@ def validateProductParameters(productName, description, price,
             productName[0] == " " or
             productName[-1] == " " or
             len(productName) > 80):
-        if(exceptions):
-            raise ValueError(f"Invalid name {productName}")
-        return False
+        raise ValueError(f"Invalid name {productName}")
 
     # If description is less than 20 or greater than 20
     # or length of description is less than or equal to length of title,
     # return False
     if ((len(description) < 20 or len(description) > 2000) or
             len(description) <= len(productName)):
-        if(exceptions):
-            raise ValueError("Invalid description length")
-        return False
+        raise ValueError("Invalid description length")
 
     # Check acceptable price range [10, 10000]
     if (price < 10.0 or price > 10000.0):
-        if(exceptions):
-            raise ValueError(f"Invalid price {price}")
-        return False
+        raise ValueError(f"Invalid price {price}")
 
     # Check acceptable last_modified_date range
     if (last_modified_date <= dt.datetime(2021, 1, 2) or
             last_modified_date >= dt.datetime(2025, 1, 2)):
-        if(exceptions):
-            raise ValueError("Invalid last modified date "
-                             + str(last_modified_date))
-        return False
+        raise ValueError("Invalid last modified date "
+                         + str(last_modified_date))
 
     # Check if owner email is null
     if (owner_email == "" or owner_email is None):
-        if(exceptions):
-            raise ValueError(f"Invalid owner email {owner_email}")
-        return False
+        raise ValueError(f"Invalid owner email {owner_email}")
 
-    # Check if owner of the corresponding product exists
-    owner = User.query.filter_by(email=owner_email).all()
-    if (len(owner) == 0 and not ignoreEmail):
-        if(exceptions):
+
+def validateProductParameters(productName, description, price,
+                              last_modified_date, owner_email,
+                              ignoreEmail=False, exceptions=False):
+    """
+    Create a Product
+      Parameters:
+        productName (string):           product name
+        description (string):           product description
+        price (float):                  product price
+        last_modified_date (DateTime):  product object last modified date
+        owner_email:                    product owner's email
+        ignoreEmail:                    flag to bypass email check,
+                                            for updateProduct
+        exceptions:                    flag for if exceptions should be raised
+
+      Returns:
+        True if product parameters are vaild, otherwise False
+    """
+    try:
+        checkProductFields(productName, description, price,
+                           last_modified_date, owner_email)
+
+        # Check if owner of the corresponding product exists
+        if (not ignoreEmail and
+                User.query.filter_by(email=owner_email).first() is None):
             raise ValueError(f"Owner does not exist {owner_email}")
-        return False
 
-    # Check if user has already used this title
-    userProducts = Product.query.filter_by(ownerEmail=owner_email,
-                                           productName=productName).all()
-    print(userProducts)
-    if (len(userProducts) >= 1):
-        if(exceptions):
+        # Check if user has already used this title
+        if Product.query.filter_by(ownerEmail=owner_email,
+                                   productName=productName).first():
             raise ValueError(f"User already has product {productName}")
+    except ValueError:
+        if(exceptions):
+            raise
         return False
 
     return True
 
 
 def createProduct(productName, description, price, owner_email,
-                  last_modified_date=dt.datetime.now()):
+                  last_modified_date=None):
     """
     Create a Product
       Parameters:
         productName (string):           product name
         description (string):           product description
         price (float):                  product price
-        last_modified_date (DateTime):  product object last modified date
+        last_modified_date (DateTime):  product object last modified date,
+                                        now if not given
         owner_email:                    product owner's email
       Returns:
         True if product creation succeeded, otherwise False
     """
+    if last_modified_date is None:
+        last_modified_date = dt.datetime.now()
     if(not validateProductParameters(productName, description, price,
                                      last_modified_date, owner_email,
                                      False, True)):
@@ -288,9 +318,11 @@ def createProduct(productName, description, price, owner_email,
 
     # Add it to the current database session
     db.session.add(product)
+    version = touchCatalog()
 
     # Save the product object
     db.session.commit()
+    catalogChanged(version)
 
     return True
 
@@ -365,7 +397,9 @@ def updateProduct(productId, **kwargs):
             setattr(product, key, val)
 
     product.lastModifiedDate = dt.datetime.now()
+    version = touchCatalog()
     db.session.commit()
+    catalogChanged(version)
     return True
 
 
@@ -418,6 +452,7 @@ def updateUser(userID, **kwargs):
         return False
 
     username = kwargs.get('username', userUpdate.username)
+    renamed = 'username' in kwargs
     # Check if username has been used before
     usernameUnique = User.query.filter(User.username == username)\
                                .filter(User.id != userID).all()
@@ -455,7 +490,13 @@ def updateUser(userID, **kwargs):
             raise ValueError("Invalid postal code")
         kwargs.pop('postalCode')
 
+    # Listings show the seller's name
+    version = touchCatalog() if renamed else None
     db.session.commit()
+    # Sessions cache a copy of the user, so drop the stale copies
+    sessionCache.invalidateUser(userID)
+    if version is not None:
+        catalogChanged(version)
     return True
 
 
@@ -464,6 +505,9 @@ def purchaseProduct(userID, productID):
     Have a user purchase a product
     If the user has sufficient funds, they will be transferred to the product's
     owner, and the product will be marked as sold
+    Every change is a conditional UPDATE, so concurrent purchases can never
+    sell a product twice or overdraw a balance. Attempts that fail with a
+    database lock error are retried up to PURCHASE_RETRIES times
         Parameter:
             userID: ID of user buying the product
             productId: ID of the product being sold
@@ -472,23 +516,434 @@ def purchaseProduct(userID, productID):
         Throws:
             ValueError with error message on failure
     """
-    # Get the user and product
-    user = User.query.filter_by(id=userID).first()
-    product = Product.query.filter_by(id=productID).first()
+    for attempt in range(PURCHASE_RETRIES + 1):
+        try:
+            sellerId, version = _purchase(userID, productID)
+            break
+        except OperationalError:
+            # Deadlock or lock timeout, back off and try again
+            db.session.rollback()
+            if attempt == PURCHASE_RETRIES:
+                raise
+            time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+        except ValueError:
+            db.session.rollback()
+            raise
+
+    # Both balances changed, so drop the cached copies of both users
+    sessionCache.invalidateUser(userID)
+    sessionCache.invalidateUser(sellerId)
+    # The product is no longer listed
+    catalogChanged(version)
+    return True
+
+
+def _purchase(userID, productID):
+    '''
+    Run one attempt of purchaseProduct in a single transaction
+      Returns:
+        (sellerId, version) ID of the seller and the new catalog version
+    '''
+    # Read plain values rather than objects, so retries never see stale state
+    product = db.session.query(Product.userId, Product.price, Product.sold)\
+                        .filter(Product.id == productID).one_or_none()
+    if product is None:
+        raise ValueError("Product does not exist")
+    sellerId, price, sold = product
 
     # Make sure the user isn't buying their own product
-    if(user.id == product.user.id):
+    if(userID == sellerId):
         raise ValueError("You cannot buy your own products")
+    if sold:
+        raise ValueError("Product has already been sold")
+
+    # Mark as sold, unless another buyer got there first or the price changed
+    claimed = Product.query.filter(Product.id == productID,
+                                   Product.sold.is_(False),
+                                   Product.price == price)\
+        .update({Product.sold: True, Product.buyerId: userID},
+                synchronize_session=False)
+    if claimed != 1:
+        raise ValueError("Product has already been sold")
+
+    # Update both balances in ID order, so two purchases between the same
+    # users always lock rows in the same order and cannot deadlock
+    for uid in sorted([userID, sellerId]):
+        if uid == userID:
+            # Check that the user can afford the product
+            debited = User.query.filter(User.id == userID,
+                                        User.balance >= price)\
+                .update({User.balance: User.balance - price},
+                        synchronize_session=False)
+            if debited != 1:
+                raise ValueError("You cannot afford the product")
+        else:
+            User.query.filter(User.id == sellerId)\
+                .update({User.balance: User.balance + price},
+                        synchronize_session=False)
+
+    # Record the purchase in the ledger, in the same transaction
+    db.session.add(Transaction(paymentId=str(uuid4()), customerId=userID,
+                               merchantId=sellerId, productId=productID,
+                               netAmount=price,
+                               createdAt=dt.datetime.now()))
+    # Last, so every transaction takes the catalog version row's lock after
+    # its other locks
+    version = touchCatalog()
+
+    # Commit expires loaded objects, so callers see the new balances
+    db.session.commit()
+    return sellerId, version
 
-    # Check that the user can afford the product
-    if(user.balance < product.price):
-        raise ValueError("You cannot afford the product")
 
-    # Transfer funds and mark as sold
-    product.user.balance += product.price
-    product.buyer = user
-    product.buyerId = user.id
-    user.balance -= product.price
-    product.sold = True
-    db.session.commit()
-    return True
+def encodeCursor(date, key):
+    '''
+    Build an opaque cursor pointing after a row of a keyset paginated list
+      Parameters:
+        date (DateTime): date column of the last row on the current page
+        key (string):    ID of the last row, to break ties between dates
+      Returns:
+        URL-safe string encoding the (date, key) pair
+    '''
+    key = date.isoformat() + "|" + key
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decodeCursor(cursor):
+    '''
+    Decode a cursor created by encodeCursor
+      Parameters:
+        cursor (string): cursor from the query string
+      Returns:
+        (date, key) tuple, None if the cursor is malformed
+    '''
+    try:
+        key = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        date, key = key.split("|", 1)
+        return dt.datetime.fromisoformat(date), key
+    except (ValueError, UnicodeError):
+        return None
+
+
+def keysetPage(query, dateColumn, keyColumn, cursor=None, limit=PAGE_SIZE):
+    '''
+    Get one page of a query, newest first, using keyset pagination
+    Pages continue from the (date, key) of the previous page's last row
+    rather than an offset, so with an index ending in (date, key) every page
+    is a range scan no matter how deep it is
+      Parameters:
+        query (Query):        filtered query to paginate
+        dateColumn (Column):  date column to order by
+        keyColumn (Column):   unique column to break ties between dates
+        cursor (string):      cursor returned with the previous page, or None
+        limit (int):          maximum number of rows on the page
+      Returns:
+        (rows, nextCursor) where nextCursor is None on the last page
+    '''
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    key = decodeCursor(cursor) if cursor else None
+    if key is not None:
+        date, rowKey = key
+        # Continue strictly after the last row of the previous page
+        query = query.filter(or_(
+            dateColumn < date,
+            and_(dateColumn == date, keyColumn < rowKey)
+        ))
+
+    # Fetch one extra row to find out if there is another page
+    rows = query.order_by(dateColumn.desc(), keyColumn.desc())\
+                .limit(limit + 1).all()
+    nextCursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        nextCursor = encodeCursor(getattr(last, dateColumn.key),
+                                  getattr(last, keyColumn.key))
+    return rows, nextCursor
+
+
+@replicaReads
+def listProducts(userId=None, cursor=None, limit=PAGE_SIZE):
+    '''
+    Get a page of unsold products from other users, newest first
+    Paginated on (lastModifiedDate, id) using ix_product_listing
+      Parameters:
+        userId (string):  ID of the user viewing the listing, whose own
+                          products are left out, None to list every seller
+        cursor (string):  cursor returned with the previous page, or None
+        limit (int):      maximum number of products on the page
+      Returns:
+        (products, nextCursor) where nextCursor is None on the last page
+    '''
+    # Load the sellers in the same statement since the listing shows them
+    query = Product.query.options(joinedload(Product.user))\
+                         .filter(Product.sold.is_(False))
+    if userId is not None:
+        query = query.filter(Product.userId != userId)
+    return keysetPage(query, Product.lastModifiedDate, Product.id,
+                      cursor, limit)
+
+
+@replicaReads
+def purchaseHistory(userId, cursor=None, limit=PAGE_SIZE):
+    '''
+    Get a page of a user's purchases, newest first
+    Paginated on (createdAt, paymentId) using ix_transaction_customer
+      Parameters:
+        userId (string):  ID of the buyer
+        cursor (string):  cursor returned with the previous page, or None
+        limit (int):      maximum number of transactions on the page
+      Returns:
+        (transactions, nextCursor) where nextCursor is None on the last page
+    '''
+    query = Transaction.query.options(joinedload(Transaction.product))\
+                             .filter(Transaction.customerId == userId)
+    return keysetPage(query, Transaction.createdAt, Transaction.paymentId,
+                      cursor, limit)
+
+
+@replicaReads
+def salesHistory(userId, cursor=None, limit=PAGE_SIZE):
+    '''
+    Get a page of a user's sales, newest first
+    Paginated on (createdAt, paymentId) using ix_transaction_merchant
+      Parameters:
+        userId (string):  ID of the seller
+        cursor (string):  cursor returned with the previous page, or None
+        limit (int):      maximum number of transactions on the page
+      Returns:
+        (transactions, nextCursor) where nextCursor is None on the last page
+    '''
+    query = Transaction.query.options(joinedload(Transaction.product))\
+                             .filter(Transaction.merchantId == userId)
+    return keysetPage(query, Transaction.createdAt, Transaction.paymentId,
+                      cursor, limit)
+
+
+@replicaReads
+def userProducts(userId):
+    '''
+    Get the products a user is selling and the products they have bought
+    Both lists come from a single query
+      Parameters:
+        userId (string): ID of the user
+      Returns:
+        (selling, purchased) lists of products
+    '''
+    products = Product.query.filter(or_(Product.userId == userId,
+                                        Product.buyerId == userId)).all()
+    selling = [p for p in products if p.userId == userId]
+    purchased = [p for p in products if p.buyerId == userId]
+    return selling, purchased
+
+
+@replicaReads
+def getSessionUser(sessionId, ip):
+    '''
+    Resolve a session to its user with a single joined query
+    Sessions past their expiry are treated as missing, sessions without an
+    expiry never expire
+      Parameters:
+        sessionId (string): ID of the session
+        ip (string):        IP address the request came from
+      Returns:
+        (user, expiry) tuple, None if there is no valid session
+    '''
+    return db.session.query(User, Session.expiry)\
+        .join(Session, Session.userId == User.id)\
+        .filter(Session.sessionId == sessionId,
+                Session.ipAddress == ip,
+                or_(Session.expiry.is_(None),
+                    Session.expiry > dt.datetime.now()))\
+        .one_or_none()
+
+
+def sweepSessions(batchSize=SWEEP_BATCH_SIZE):
+    '''
+    Delete expired sessions in batches, committing after each batch so the
+    session table is never locked for long
+      Parameters:
+        batchSize (int): maximum number of sessions deleted per statement
+      Returns:
+        Number of sessions deleted
+    '''
+    now = dt.datetime.now()
+    deleted = 0
+    while True:
+        ids = [row[0] for row in db.session.query(Session.sessionId)
+               .filter(Session.expiry <= now).limit(batchSize)]
+        if len(ids) == 0:
+            break
+        Session.query.filter(Session.sessionId.in_(ids))\
+                     .delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(ids)
+        if len(ids) < batchSize:
+            break
+    return deleted
+
+
+def startSessionSweeper(app, interval):
+    '''
+    Run sweepSessions periodically on a background daemon thread
+      Parameters:
+        app (Flask):      application, used for the database context
+        interval (float): seconds between sweeps
+      Returns:
+        The started thread
+    '''
+    def sweep():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    sweepSessions()
+                finally:
+                    db.session.remove()
+
+    thread = threading.Thread(target=sweep, name='session-sweeper',
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def touchCatalog():
+    '''
+    Give the catalog a new version in the current transaction, for every
+    change to what product pages show. Call it after the change's other
+    writes, and pass the result to catalogChanged once the commit succeeds
+      Returns:
+        The new (version, changedAt)
+    '''
+    version = (uuid4().hex, dt.datetime.now())
+    CatalogVersion.query.filter(CatalogVersion.id == 1)\
+        .update({CatalogVersion.version: version[0],
+                 CatalogVersion.changedAt: version[1]},
+                synchronize_session=False)
+    return version
+
+
+def catalogChanged(version):
+    '''
+    Make a committed catalog change show in this process at once
+    Other processes see it once their cached version expires
+      Parameters:
+        version (tuple): (version, changedAt) from touchCatalog
+    '''
+    cached = catalogVersions.get('catalog')
+    # Concurrent changes can finish out of order, keep the newest
+    if cached is None or cached[1] is None or cached[1] <= version[1]:
+        catalogVersions.put('catalog', version)
+    catalogFragments.bump()
+
+
+def catalogVersion():
+    '''
+    Get the version of the product catalog, for validating pages built from
+    it. Reads the single catalog version row, which touchCatalog replaces
+    in every change, and caches it for up to FRAGMENT_CACHE_TTL seconds, so
+    most requests run no statement for it
+      Returns:
+        (version, changedAt) random version and when it was written,
+        changedAt being None if createSchema has not added the row
+    '''
+    version = catalogVersions.get('catalog')
+    if version is None:
+        version = _readCatalogVersion()
+        catalogVersions.put('catalog', version)
+    return version
+
+
+@replicaReads
+def _readCatalogVersion():
+    row = db.session.query(CatalogVersion.version, CatalogVersion.changedAt)\
+        .filter(CatalogVersion.id == 1).one_or_none()
+    return tuple(row) if row is not None else ('', None)
+
+
+@replicaReads
+def searchProducts(query, limit=PAGE_SIZE, offset=0):
+    '''
+    Search unsold products by name and description, best matches first
+    Uses the full-text index from models.createSearchIndex, which is an
+    FTS5 table on SQLite and a FULLTEXT index on MySQL. Names are weighted
+    above descriptions on SQLite
+      Parameters:
+        query (string):  words to search for, every word must match
+        limit (int):     maximum number of products on the page
+        offset (int):    number of results to skip
+      Returns:
+        (products, nextOffset) where nextOffset is None on the last page
+    '''
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    offset = max(0, offset)
+    words = re.findall(r"\w+", query)
+    if len(words) == 0:
+        return [], None
+
+    dialect = db.engine.dialect.name
+    params = {'limit': limit + 1, 'offset': offset}
+    if dialect == 'sqlite' and _hasSearchTable():
+        # Quote every word so user input is never parsed as FTS5 syntax
+        params['match'] = " ".join('"' + w + '"' for w in words)
+        statement = text(
+            "SELECT product.* FROM product_fts "
+            "JOIN product ON product.rowid = product_fts.rowid "
+            "WHERE product_fts MATCH :match AND product.sold = 0 "
+            "ORDER BY bm25(product_fts, 10.0, 1.0) "
+            "LIMIT :limit OFFSET :offset")
+    elif dialect == 'mysql':
+        # Boolean mode with + so every word must match, like FTS5
+        params['match'] = " ".join('+' + w for w in words)
+        statement = text(
+            "SELECT product.* FROM product "
+            "WHERE MATCH (productName, description) "
+            "AGAINST (:match IN BOOLEAN MODE) AND sold = 0 "
+            "ORDER BY MATCH (productName, description) "
+            "AGAINST (:match IN BOOLEAN MODE) DESC "
+            "LIMIT :limit OFFSET :offset")
+    else:
+        statement = None
+
+    if statement is not None:
+        # Typed columns, so IDs are converted as in any other query
+        statement = statement.columns(*Product.__table__.columns)
+        products = Product.query.from_statement(statement)\
+                                .params(**params).all()
+    else:
+        # No text index, scan with LIKE and show the newest matches first
+        filters = [or_(Product.productName.ilike(f"%{w}%"),
+                       Product.description.ilike(f"%{w}%")) for w in words]
+        products = Product.query.filter(Product.sold.is_(False), *filters)\
+            .order_by(Product.lastModifiedDate.desc())\
+            .limit(limit + 1).offset(offset).all()
+
+    nextOffset = None
+    if len(products) > limit:
+        products = products[:limit]
+        nextOffset = offset + limit
+    # Load the sellers in one query and attach them, so product.user needs
+    # no lazy loads. The session only holds weak references, so sellers not
+    # attached to anything could be dropped before the page renders
+    sellerIds = {p.userId for p in products}
+    if sellerIds:
+        sellers = {u.id: u for u in
+                   User.query.filter(User.id.in_(sellerIds))}
+        for product in products:
+            set_committed_value(product, 'user', sellers[product.userId])
+    return products, nextOffset
+
+
+# Engines known to have the FTS5 table. Only its presence is remembered, so
+# a table created by create-schema after startup is used on the next search
+_searchTables = set()
+
+
+def _hasSearchTable():
+    engine = db.session().get_bind()
+    if engine not in _searchTables and db.session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'product_fts'"
+    )).first() is not None:
+        _searchTables.add(engine)
+    return engine in _searchTables
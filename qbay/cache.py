@@ -0,0 +1,209 @@
+from qbay import app
+from collections import OrderedDict
+import datetime as dt
+import threading
+import time
+
+'''
+This file defines in-process caches shared by request threads
+'''
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache where entries also expire after a fixed time
+      Parameters:
+        maxsize (int): maximum number of entries before the least recently
+                       used one is evicted
+        ttl (float):   seconds an entry stays valid after it is stored
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Get a cached value, None if it is missing or has expired
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._evict(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        '''
+        Store a value, evicting the least recently used entry if full
+        '''
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._evict(next(iter(self._entries)))
+
+    def invalidate(self, key):
+        '''
+        Remove an entry if it is cached
+        '''
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._evict(key)
+
+    def stats(self):
+        '''
+        Get the cache counters
+          Returns:
+            dict with size, hits and misses
+        '''
+        return {'size': len(self._entries), 'hits': self.hits,
+                'misses': self.misses}
+
+    def _evict(self, key):
+        # Callers must hold the lock
+        del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SessionCache(TTLCache):
+    """
+    Cache from (sessionId, ipAddress) to a snapshot of the session's user
+    Snapshots are plain dicts of column values, so no ORM instance is ever
+    shared between request threads. Entries are indexed by user so every
+    session of a user can be dropped when the user changes.
+    """
+
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize, ttl)
+        self._byUser = {}
+
+    def getUser(self, sessionId, ip):
+        '''
+        Get the cached user for a session
+          Parameters:
+            sessionId (string): ID of the session
+            ip (string):        IP address the request came from
+          Returns:
+            dict of User column values, None on a miss or expired session
+        '''
+        entry = self.get((sessionId, ip))
+        if entry is None:
+            return None
+        expiry, user = entry
+        # Never serve a session past its expiry, even if the entry is fresh
+        if expiry is not None and expiry <= dt.datetime.now():
+            with self._lock:
+                if (sessionId, ip) in self._entries:
+                    self._evict((sessionId, ip))
+                # Count it as a miss, since the caller has to go to the DB
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return user
+
+    def putUser(self, sessionId, ip, expiry, user):
+        '''
+        Cache the user for a session
+          Parameters:
+            sessionId (string):  ID of the session
+            ip (string):         IP address the session is bound to
+            expiry (DateTime):   session expiry
+            user (dict):         User column values
+        '''
+        self.put((sessionId, ip), (expiry, user))
+        with self._lock:
+            self._byUser.setdefault(user['id'], set()).add((sessionId, ip))
+
+    def invalidateSession(self, sessionId, ip):
+        '''
+        Drop a session from the cache, used on logout
+        '''
+        self.invalidate((sessionId, ip))
+
+    def invalidateUser(self, userId):
+        '''
+        Drop every cached session of a user, used when the user changes
+        '''
+        with self._lock:
+            for key in list(self._byUser.get(userId, ())):
+                if key in self._entries:
+                    self._evict(key)
+            self._byUser.pop(userId, None)
+
+    def _evict(self, key):
+        _, (_, user) = self._entries.pop(key)
+        keys = self._byUser.get(user['id'])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._byUser[user['id']]
+
+
+class FragmentCache(TTLCache):
+    """
+    Cache of rendered page fragments, stamped with a generation counter
+    Bumping the generation makes every cached fragment stale at once, so
+    changes never have to work out which fragments they affect. Fragments
+    of old generations are never read again and age out of the cache.
+    """
+
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize, ttl)
+        self.generation = 0
+
+    def bump(self):
+        '''
+        Start a new generation, used whenever what the fragments show changes
+        '''
+        with self._lock:
+            self.generation += 1
+
+    def fragment(self, key, render):
+        '''
+        Get a fragment of the current generation, rendering it on a miss
+          Parameters:
+            key (tuple):         what the fragment depends on, besides the
+                                 generation
+            render (function):   renders the fragment, without arguments
+          Returns:
+            The rendered fragment
+        '''
+        # Read the generation first, so a change made while rendering is
+        # never stored under the new generation
+        key = (self.generation, key)
+        value = self.get(key)
+        if value is None:
+            value = render()
+            self.put(key, value)
+        return value
+
+
+sessionCache = SessionCache(app.config['SESSION_CACHE_SIZE'],
+                            app.config['SESSION_CACHE_TTL'])
+# Recent failed login count per email, see backend.login
+loginFailures = TTLCache(app.config['LOGIN_FAILURE_CACHE_SIZE'],
+                         app.config['LOGIN_FAILURE_TTL'])
+# Rendered product listings, bumped by every change to a listed product
+catalogFragments = FragmentCache(app.config['FRAGMENT_CACHE_SIZE'],
+                                 app.config['FRAGMENT_CACHE_TTL'])
+# This process's copy of the catalog version row, see backend.catalogVersion
+catalogVersions = TTLCache(1, app.config['FRAGMENT_CACHE_TTL'])
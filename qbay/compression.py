@@ -0,0 +1,206 @@
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_list_header, \
+    parse_set_header
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+'''
+This file compresses responses, as WSGI middleware around the app
+
+The encoding is negotiated from Accept-Encoding: brotli if the brotli
+package is installed and the client accepts it, then gzip, then deflate.
+HTML, JSON and other text is compressed once it is at least
+COMPRESSION_MIN_SIZE bytes, or of unknown length. Responses that are
+already compressed, such as images, partial, or marked no-transform are
+passed through.
+
+Bodies are compressed chunk by chunk as the app yields them, so nothing is
+buffered, and streamed responses (those without a Content-Length) are
+flushed after every chunk so each one reaches the client without waiting
+for the next.
+'''
+
+# Content types worth compressing, other than text/*
+COMPRESSIBLE_TYPES = {'application/json', 'application/javascript',
+                      'application/xml', 'image/svg+xml'}
+# zlib window bits of each container
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+class ZlibCompressor:
+    """
+    Incremental gzip or deflate compressor
+    """
+
+    def __init__(self, encoding, level):
+        self._zlib = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+
+    def compress(self, data):
+        return self._zlib.compress(data)
+
+    def flush(self):
+        # Ends the current block on a byte boundary, so everything so far
+        # can be decompressed, without ending the stream
+        return self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._zlib.flush()
+
+
+class BrotliCompressor:
+    """
+    Incremental brotli compressor
+    """
+
+    def __init__(self, quality):
+        self._brotli = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._brotli.process(data)
+
+    def flush(self):
+        return self._brotli.flush()
+
+    def finish(self):
+        return self._brotli.finish()
+
+
+def encodings():
+    '''
+    Get the encodings responses can be compressed with, most preferred first
+    '''
+    return (['br'] if brotli else []) + ['gzip', 'deflate']
+
+
+def getCompressor(encoding, level, brotliQuality):
+    '''
+    Get a new compressor for one response
+      Parameters:
+        encoding (string):    br, gzip or deflate
+        level (int):          zlib level, 1 (fastest) to 9 (smallest)
+        brotliQuality (int):  brotli quality, 0 (fastest) to 11 (smallest)
+      Returns:
+        Compressor with compress, flush and finish methods
+    '''
+    if encoding == 'br':
+        return BrotliCompressor(brotliQuality)
+    return ZlibCompressor(encoding, level)
+
+
+def compressible(status, headers, minSize):
+    '''
+    Check if a response is worth compressing
+      Parameters:
+        status (string):    WSGI status line
+        headers (Headers):  response headers
+        minSize (int):      smallest body in bytes worth compressing
+      Returns:
+        True if the response should be compressed
+    '''
+    # No body, or a range of the uncompressed body
+    if status[:3] in ('204', '206', '304'):
+        return False
+    if 'Content-Encoding' in headers or 'Content-Range' in headers:
+        return False
+    if 'no-transform' in parse_list_header(headers.get('Cache-Control',
+                                                       '')):
+        return False
+    mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+    if not (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES):
+        return False
+    length = headers.get('Content-Length')
+    return length is None or int(length) >= minSize
+
+
+class CompressionMiddleware:
+    """
+    WSGI middleware compressing responses for clients that accept it
+      Parameters:
+        app (function):       WSGI application
+        level (int):          zlib level for gzip and deflate
+        brotliQuality (int):  brotli quality
+        minSize (int):        smallest body in bytes worth compressing
+    """
+
+    def __init__(self, app, level=6, brotliQuality=4, minSize=500):
+        self.app = app
+        self.level = level
+        self.brotliQuality = brotliQuality
+        self.minSize = minSize
+
+    def __call__(self, environ, start_response):
+        encoding = parse_accept_header(
+            environ.get('HTTP_ACCEPT_ENCODING', '')).best_match(encodings())
+        # HEAD must get the headers GET would, without the work
+        if encoding is None or environ['REQUEST_METHOD'] == 'HEAD':
+            return self.app(environ, start_response)
+
+        state = {}
+
+        def startResponse(status, headers, exc_info=None):
+            state['started'] = True
+            headers = Headers(headers)
+            if compressible(status, headers, self.minSize):
+                state['streamed'] = 'Content-Length' not in headers
+                state['compressor'] = getCompressor(encoding, self.level,
+                                                    self.brotliQuality)
+                del headers['Content-Length']
+                headers['Content-Encoding'] = encoding
+                vary = parse_set_header(headers.get('Vary'))
+                vary.add('Accept-Encoding')
+                headers['Vary'] = vary.to_header()
+                # The bytes differ from the uncompressed response's
+                etag = headers.get('ETag')
+                if etag and not etag.startswith('W/'):
+                    headers['ETag'] = 'W/' + etag
+            return start_response(status, headers.to_wsgi_list(), exc_info)
+
+        body = self.app(environ, startResponse)
+        if state.get('started') and 'compressor' not in state:
+            # Passed through as is, keeping wsgi.file_wrapper for images
+            return body
+        return self.compress(body, state)
+
+    def compress(self, body, state):
+        '''
+        Compress a response body as it is iterated
+          Parameters:
+            body (iterable):  body from the app, which has called
+                              start_response by its first chunk
+            state (dict):     compressor chosen by start_response, if any
+        '''
+        try:
+            for chunk in body:
+                compressor = state.get('compressor')
+                if compressor is None:
+                    yield chunk
+                    continue
+                data = compressor.compress(chunk)
+                if state['streamed']:
+                    data += compressor.flush()
+                if data:
+                    yield data
+            if state.get('compressor') is not None:
+                yield state['compressor'].finish()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+
+def installCompression(app):
+    '''
+    Compress the app's responses, with the levels in its config
+    Does nothing if it is already installed
+      Parameters:
+        app (Flask): application
+    '''
+    if isinstance(app.wsgi_app, CompressionMiddleware):
+        return
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app, level=app.config['COMPRESSION_LEVEL'],
+        brotliQuality=app.config['BROTLI_QUALITY'],
+        minSize=app.config['COMPRESSION_MIN_SIZE'])
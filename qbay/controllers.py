@@ -1,13 +1,131 @@
-from flask import render_template, request, session, redirect
-from qbay.models import User, Product, Session
+import click
+import datetime as dt
+import hashlib
+import hmac
+import os
+import time
+from flask import render_template, request, session, redirect, jsonify, \
+    abort, get_template_attribute, g
+from sqlalchemy import text
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.orm import make_transient_to_detached
+from werkzeug.exceptions import RequestEntityTooLarge
+from qbay.models import db, User, Product, createSchema, migrateUUIDs, \
+    migrateSchema, replicaReads
 from qbay.backend import (login, register, validateEmail,
                           validateUser, validatePswd,
                           createProduct, updateProduct, updateUser,
-                          purchaseProduct)
+                          purchaseProduct, listProducts, userProducts,
+                          getSessionUser, sweepSessions, purchaseHistory,
+                          salesHistory, searchProducts, catalogVersion,
+                          PAGE_SIZE)
+from qbay.cache import sessionCache, catalogFragments
+from qbay.hashing import HashingPoolFull
+from qbay.images import receiveUpload, saveProductImage, pictureFor, \
+    sendImage, collectImages, recountImages, storageStats, ImageTooLarge
+from qbay.importer import readRows, importProducts, BATCH_SIZE
+from qbay.metrics import metrics, timedMacro
 from qbay import app
 
 app.secret_key = 'KEY'
 
+# Width product pictures are shown at on the update page
+PICTURE_WIDTH = 480
+# User columns pages show, and so their ETags depend on
+PAGE_USER_COLUMNS = ('id', 'username', 'email', 'balance',
+                     'shippingAddress', 'postalCode')
+
+
+def codeVersion():
+    '''
+    Hash the code and templates pages are built with, so the ETags of every
+    page change when a new version is deployed
+      Returns:
+        string of hex digits
+    '''
+    digest = hashlib.sha1()
+    root = os.path.dirname(__file__)
+    for folder, _, files in sorted(os.walk(root)):
+        for name in sorted(files):
+            if name.endswith(('.py', '.html')):
+                with open(os.path.join(folder, name), 'rb') as f:
+                    digest.update(f.read())
+    return digest.hexdigest()
+
+
+CODE_VERSION = codeVersion()
+
+
+def notModified(user, state, lastModified=None):
+    '''
+    Check a GET request's If-None-Match or If-Modified-Since against the
+    page about to be built, so a 304 can be sent without building it
+    The page's validators are also set on the response, see setValidators
+      Parameters:
+        user (User):            logged in user
+        state (tuple):          everything else the page shows, that its
+                                weak ETag is hashed from
+        lastModified (DateTime): when state last changed, None if unknown
+      Returns:
+        True if the client's copy is current
+    '''
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    userState = tuple(getattr(user, c) for c in PAGE_USER_COLUMNS)
+    g.pop('lastModified', None)
+    g.etag = hashlib.sha1(repr((CODE_VERSION, userState, state))
+                          .encode()).hexdigest()
+    # The user's own changes, such as to their profile, are only dated by
+    # the write time kept in their session, see models.chooseReplica
+    changed = max(session.get('wroteAt', 0),
+                  lastModified.timestamp() if lastModified else 0)
+    # Send Last-Modified only once its second is over, since a change
+    # later in the same second would have the same Last-Modified
+    if 0 < changed < int(time.time()):
+        g.lastModified = dt.datetime.fromtimestamp(int(changed),
+                                                   dt.timezone.utc)
+    # If-Modified-Since only counts without If-None-Match, RFC 7232 6
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(g.etag)
+    return 'lastModified' in g and request.if_modified_since is not None \
+        and g.lastModified <= request.if_modified_since
+
+
+@app.after_request
+def setValidators(response):
+    # Pages checked with notModified can be revalidated by the browser.
+    # Popped, since g outlives the request when an app context was pushed
+    etag = g.pop('etag', None)
+    lastModified = g.pop('lastModified', None)
+    if etag and response.status_code in (200, 304):
+        response.set_etag(etag, weak=True)
+        if lastModified:
+            response.last_modified = lastModified
+        # Only the logged in user's browser may keep the page, and must
+        # revalidate it before each use
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
+def cachedUser(sessionId, ip):
+    '''
+    Get the user for a session from the session cache, without touching
+    the database
+      Parameters:
+        sessionId (string): ID of the session
+        ip (string):        IP address the request came from
+      Returns:
+        User attached to the current database session, None on a miss
+    '''
+    values = sessionCache.getUser(sessionId, ip)
+    if values is None:
+        return None
+    user = User(**values)
+    # Mark the copy as persistent so it can be attached without a SELECT
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
 
 def authenticate(inner_function):
     """
@@ -28,16 +146,23 @@ def authenticate(inner_function):
             sessionId = session['logged_in']
             ip = str(request.remote_addr)
             try:
-                # Get the sessionId
-                sessionObj = Session.query.filter_by(sessionId=sessionId,
-                                                     ipAddress=ip
-                                                     ).one_or_none()
-                # Get the user id associated with the session
-                user = User.query.filter_by(id=sessionObj.userId).one_or_none()
+                user = cachedUser(sessionId, ip)
+                if user is None:
+                    # Get the unexpired session and its user in one query
+                    resolved = getSessionUser(sessionId, ip)
+                    if resolved is None:
+                        return redirect('/user/login')
+                    user, expiry = resolved
+                    sessionCache.putUser(sessionId, ip, expiry,
+                                         {c.key: getattr(user, c.key)
+                                          for c in User.__table__.columns})
                 if user:
                     # if the user exists, call the inner_function
                     # with user as parameter
                     return inner_function(user, *args, **kwargs)
+            except PoolTimeout:
+                # Overloaded rather than logged out, see pool_timeout
+                raise
             except Exception as e:
                 print(e)
                 return redirect('/user/login')
@@ -49,6 +174,88 @@ def authenticate(inner_function):
     return wrapped_inner
 
 
+@app.cli.command('create-schema')
+def create_schema():
+    """Create missing tables and the search index."""
+    createSchema()
+    print("Schema created")
+
+
+@app.cli.command('sweep-sessions')
+def sweep_sessions():
+    """Delete expired sessions."""
+    print(f"Deleted {sweepSessions()} expired sessions")
+
+
+@app.cli.command('import-products')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              default=None, help='Defaults to the file extension')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True)
+def import_products(file, fmt, batch_size):
+    """Bulk import products from a CSV or JSON Lines file."""
+    fmt = fmt or ('jsonl' if file.name.endswith('.jsonl') else 'csv')
+    print(importProducts(readRows(file, fmt), batch_size))
+
+
+@app.cli.command('migrate-schema')
+def migrate_schema():
+    """Add the columns and indexes older tables lack, fix nullability."""
+    changed = migrateSchema()
+    for name in changed:
+        print(f"Changed {name}")
+    print(f"Changed {len(changed)} columns and indexes")
+
+
+@app.cli.command('migrate-uuids')
+def migrate_uuids():
+    """Convert IDs stored as text to 16 byte binary."""
+    print(f"Converted {migrateUUIDs()} IDs")
+    if db.engine.dialect.name == 'sqlite':
+        # The old values' pages are only given back by rebuilding the file
+        db.session.execute(text('VACUUM'))
+
+
+@app.cli.command('gc-images')
+@click.option('--recount', is_flag=True,
+              help='Rebuild reference counts from the pictures first')
+def gc_images(recount):
+    """Delete stored images no product picture uses."""
+    if recount:
+        recountImages()
+    deleted, freed = collectImages(orphans=True)
+    print(f"Deleted {deleted} unused images, freeing {freed} bytes")
+
+
+@app.cli.command('image-stats')
+def image_stats():
+    """Report the storage saved by sharing identical images."""
+    stats = storageStats()
+    print(f"{stats['pictures']} pictures stored in {stats['files']} files: "
+          f"{stats['storedBytes']} bytes instead of "
+          f"{stats['referencedBytes']}, saving {stats['savedBytes']} bytes")
+
+
+@app.errorhandler(PoolTimeout)
+def pool_timeout(err):
+    # Every database connection stayed busy for DB_POOL_TIMEOUT seconds.
+    # Failing fast sheds load, where queueing would make every request slow
+    return "The server is busy, please try again", 503, {'Retry-After': '1'}
+
+
+# Prometheus metrics, only served to scrapers with METRICS_TOKEN. The peer
+# address can't be trusted, since behind a reverse proxy every request
+# comes from the local machine
+@app.route("/_metrics", methods=["GET"])
+def metrics_get():
+    token = app.config['METRICS_TOKEN']
+    if not token or not hmac.compare_digest(
+            request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(404)
+    return metrics.render(db.engine.pool), 200, \
+        {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
 # Endpoint used to set session ID while testing
 @app.route("/_test/<sid>", methods=["GET"])
 def test_set_session(sid):
@@ -66,7 +273,11 @@ def login_form():
     email = request.form.get('email')
     password = request.form.get('password')
     ip = str(request.remote_addr)
-    userSession = login(email, password, ip)
+    try:
+        userSession = login(email, password, ip)
+    except HashingPoolFull as err:
+        # Too many logins in flight, reject rather than queue without bound
+        return render_template('user/login.html', message=str(err)), 503
     if userSession:
         session['logged_in'] = userSession.sessionId
         """
@@ -86,6 +297,26 @@ def login_form():
                                "email or password")
 
 
+def availableRows(cursor, limit):
+    '''
+    Render a page of the home page's Available products list, shared by
+    every user
+    Each row is rendered with the Buy button enabled and disabled, so the
+    page can pick one for the user's balance without rendering again. Rows
+    of every seller are rendered, and the page leaves out the user's own
+      Parameters:
+        cursor (string):  cursor of the page, or None for the first page
+        limit (int):      maximum number of products on the page
+      Returns:
+        (rows, nextCursor) where rows are
+        (price, sellerId, affordable, unaffordable)
+    '''
+    products, nextCursor = listProducts(None, cursor, limit)
+    row = timedMacro(get_template_attribute('product/listing.html', 'row'))
+    return [(p.price, p.userId, row(p, True), row(p, False))
+            for p in products], nextCursor
+
+
 @app.route('/', methods=['GET', 'POST'])
 @authenticate
 def home(user):
@@ -98,12 +329,26 @@ def home(user):
         product = request.args.get('product')
         purchaseProduct(user.id, product)
 
-    # Get products from other users
-    otherProducts = Product.query.filter(Product.userId != user.id,
-                                         Product.sold.is_(False)).all()
-    purchased = Product.query.filter(Product.buyerId == user.id)
+    # Every product on the page is covered by the catalog's version
+    version = catalogVersion()
+    if notModified(user, version, version[1]):
+        return '', 304
+
+    # Get a page of products, rendered once per change to the catalog for
+    # every user rather than on every visit. The template leaves out the
+    # user's own, so their pages can hold fewer than limit products
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    available, nextCursor = catalogFragments.fragment(
+        ('available', version, cursor, limit),
+        lambda: availableRows(cursor, limit))
+    # Get the user's own and purchased products, so the template never
+    # has to lazy load relationships
+    ownProducts, purchased = userProducts(user.id)
     return render_template('index.html', user=user,
-                           otherProducts=otherProducts, purchased=purchased)
+                           available=available, purchased=purchased,
+                           ownProducts=ownProducts, nextCursor=nextCursor,
+                           limit=limit)
 
 
 @app.route('/user/register', methods=['GET'])
@@ -124,7 +369,11 @@ def register_post():
         error_message = "The passwords do not match"
     else:
         # use backend api to register the user
-        success = register(name, email, password)
+        try:
+            success = register(name, email, password)
+        except HashingPoolFull as err:
+            return render_template('user/register.html',
+                                   message=str(err)), 503
         if not success:
             if validateEmail(email) is False:
                 error_message = ("Registration Failed. Invalid email or"
@@ -144,7 +393,8 @@ def register_post():
 @app.route('/user/logout')
 def logout():
     if 'logged_in' in session:
-        session.pop('logged_in', None)
+        sessionCache.invalidateSession(session.pop('logged_in'),
+                                       str(request.remote_addr))
     return redirect('/')
 
 
@@ -192,6 +442,7 @@ def createProduct_post(user):
 
 @app.route('/product/update/<prodName>', methods=['GET'])
 @authenticate
+@replicaReads
 def updateProduct_get(user, prodName):
     # Get product by name and user
     product = Product.query.filter_by(productName=prodName, userId=user.id)\
@@ -200,9 +451,17 @@ def updateProduct_get(user, prodName):
     if(product is None):
         return render_template("message.html", user=user, message="Product " +
                                prodName + " not found in your products")
+    # Thumbnails are made after upload, so the picture shown can change
+    # without the product
+    picture = pictureFor(product, PICTURE_WIDTH)
+    shown = picture and (picture.contentHash, picture.width)
+    if notModified(user, (product.id, product.productName,
+                          product.description, product.price, shown),
+                   product.lastModifiedDate):
+        return '', 304
     # If product can be found, display update page
     return render_template("product/update.html", user=user, message="",
-                           product=product)
+                           product=product, picture=picture)
 
 
 @app.route('/product/update/<prodName>', methods=['POST'])
@@ -244,12 +503,55 @@ def updateProduct_post(user, prodName):
 
     # Display page with error message on failure
     return render_template("product/update.html", user=user,
-                           message=error_message, product=product)
+                           message=error_message, product=product,
+                           picture=pictureFor(product, PICTURE_WIDTH))
+
+
+@app.route('/product/image/<prodName>', methods=['POST'])
+@authenticate
+def productImage_post(user, prodName):
+    # Get product by name and user
+    product = Product.query.filter_by(productName=prodName, userId=user.id)\
+                .one_or_none()
+    if(product is None):
+        return render_template("message.html", user=user, message="Product " +
+                               prodName + " not found in your products")
+
+    # The upload is streamed to a temporary file with a size limit.
+    # saveProductImage stores the original and returns before the
+    # thumbnails are made, and throws ValueError if it isn't an image
+    try:
+        with receiveUpload(request.environ, 'image') as upload:
+            saveProductImage(product.id, upload)
+        return redirect(f"/product/update/{product.productName}")
+    except RequestEntityTooLarge as err:
+        error_message = err.description
+        status = 413
+    except ImageTooLarge as err:
+        error_message = err
+        status = 413
+    except ValueError as err:
+        error_message = err
+        status = 400
+
+    return render_template("product/update.html", user=user,
+                           message=error_message, product=product,
+                           picture=pictureFor(product, PICTURE_WIDTH)), status
+
+
+# Product images, named by content so they never change. A reverse proxy
+# can serve IMAGE_STORE at /images/ directly with the same headers.
+@app.route('/images/<path:path>', methods=['GET'])
+def image_get(path):
+    return sendImage(path)
 
 
 @app.route('/user/modify', methods=['GET'])
 @authenticate
 def update_get_user(user):
+    # The page only shows the user
+    if notModified(user, ()):
+        return '', 304
     # If user can be found, display update page
     return render_template("user/modify.html", message="", user=user)
 
@@ -273,3 +575,62 @@ def update_post_user(user):
 
     # Display page with error message on failure
     return render_template("user/modify.html", message=message, user=user)
+
+
+def historyPage(history, user):
+    '''
+    Build the JSON response for a page of purchase or sales history
+      Parameters:
+        history (function): purchaseHistory or salesHistory
+        user (User):        logged in user
+    '''
+    # Validated by catalogVersion(), which every purchase and product rename
+    # replaces in the same transaction
+    version = catalogVersion()
+    if notModified(user, version, version[1]):
+        return '', 304
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    transactions, nextCursor = history(user.id, cursor, limit)
+    return jsonify({
+        'transactions': [{
+            'paymentId': t.paymentId,
+            'productId': t.productId,
+            'productName': t.product.productName,
+            'customerId': t.customerId,
+            'merchantId': t.merchantId,
+            'amount': t.netAmount,
+            'createdAt': t.createdAt.isoformat(),
+        } for t in transactions],
+        'nextCursor': nextCursor,
+    })
+
+
+@app.route('/user/purchases', methods=['GET'])
+@authenticate
+def purchases_get(user):
+    # Page of the user's purchases, pass nextCursor as ?cursor= for more
+    return historyPage(purchaseHistory, user)
+
+
+@app.route('/user/sales', methods=['GET'])
+@authenticate
+def sales_get(user):
+    # Page of the user's sales, pass nextCursor as ?cursor= for more
+    return historyPage(salesHistory, user)
+
+
+@app.route('/search', methods=['GET'])
+@authenticate
+def search_get(user):
+    # Ranked page of unsold products matching ?q=
+    version = catalogVersion()
+    if notModified(user, version, version[1]):
+        return '', 304
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    products, nextOffset = searchProducts(query, limit, offset)
+    return render_template('search.html', user=user, query=query,
+                           products=products, nextOffset=nextOffset,
+                           limit=limit)
@@ -0,0 +1,276 @@
+from qbay import app
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import hashlib
+import hmac
+import os
+import threading
+
+'''
+This file defines password hashing
+
+Hashes are stored as "algorithm$cost$salt$digest" strings, so the algorithm
+and cost can change without a migration. Hashes from older configurations
+are still verified, and login rehashes them with the current configuration.
+Hashes from before this format ("salt:digest", one round of salted SHA-512)
+are verified by LegacySHA512Hasher.
+
+Hashing can run on a bounded worker pool (PASSWORD_HASH_EXECUTOR), so a
+burst of logins queues for a fixed number of workers instead of taking CPU
+from every request thread, and is rejected once the queue is full.
+'''
+
+
+class HashingPoolFull(Exception):
+    """
+    Raised when the hashing pool has no free worker or queue slot
+    """
+    pass
+
+
+class Hasher:
+    """
+    Base class for password hashing algorithms
+      Parameters:
+        cost (int): algorithm specific work factor
+    """
+    name = None
+
+    def __init__(self, cost):
+        self.cost = cost
+
+    def digest(self, password, salt, cost):
+        '''
+        Compute the raw digest of a password
+          Parameters:
+            password (string): password to hash
+            salt (bytes):      random salt
+            cost (int):        work factor to hash with
+          Returns:
+            Digest as bytes
+        '''
+        raise NotImplementedError
+
+    def hash(self, password):
+        '''
+        Hash a password with a new random salt
+          Parameters:
+            password (string): password to hash
+          Returns:
+            Encoded hash string
+        '''
+        salt = os.urandom(16)
+        digest = self.digest(password, salt, self.cost)
+        return "$".join([self.name, str(self.cost), salt.hex(), digest.hex()])
+
+    def verify(self, password, encoded):
+        '''
+        Check a password against an encoded hash of this algorithm
+          Parameters:
+            password (string): password to check
+            encoded (string):  hash string created by hash()
+          Returns:
+            True if the password matches, otherwise False
+        '''
+        _, cost, salt, digest = encoded.split("$")
+        actual = self.digest(password, bytes.fromhex(salt), int(cost))
+        return hmac.compare_digest(actual, bytes.fromhex(digest))
+
+    def needsRehash(self, encoded):
+        '''
+        Check if a hash was created with a different algorithm or cost
+        '''
+        parts = encoded.split("$")
+        return parts[0] != self.name or parts[1] != str(self.cost)
+
+
+class PBKDF2Hasher(Hasher):
+    """
+    PBKDF2-HMAC-SHA256, cost is the number of iterations
+    """
+    name = 'pbkdf2_sha256'
+
+    def digest(self, password, salt, cost):
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt,
+                                   cost)
+
+
+class ScryptHasher(Hasher):
+    """
+    scrypt with r=8 and p=1, cost is the CPU/memory cost N (a power of 2)
+    """
+    name = 'scrypt'
+
+    def digest(self, password, salt, cost):
+        # scrypt needs 128 * N * r bytes, allow some headroom over that
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=cost,
+                              r=8, p=1, maxmem=256 * cost * 8, dklen=32)
+
+
+class LegacySHA512Hasher(Hasher):
+    """
+    One round of SHA-512 over password + salt, stored as "salt:digest"
+    Only kept to verify hashes created before versioned hashes existed
+    """
+    name = 'sha512'
+
+    def hash(self, password):
+        raise ValueError("Legacy hashes can no longer be created")
+
+    def verify(self, password, encoded):
+        salt, digest = encoded.split(":", 1)
+        actual = hashlib.sha512((password + salt).encode('utf-8')).hexdigest()
+        return hmac.compare_digest(actual, digest)
+
+    def needsRehash(self, encoded):
+        return True
+
+
+# Algorithms that can be selected with the password_hasher setting
+HASHERS = {h.name: h for h in [PBKDF2Hasher, ScryptHasher]}
+# Default cost for each algorithm
+DEFAULT_COSTS = {PBKDF2Hasher.name: 100000, ScryptHasher.name: 2 ** 14}
+
+_hashers = {}
+
+
+def getHasher(name=None, cost=None):
+    '''
+    Get a hasher, by default the one selected in the app config
+      Parameters:
+        name (string): algorithm name, one of HASHERS
+        cost (int):    work factor, the algorithm's default if None
+      Returns:
+        Hasher instance
+    '''
+    if name is None:
+        name = app.config['PASSWORD_HASHER']
+        cost = cost or app.config['PASSWORD_HASH_COST']
+    if name not in HASHERS:
+        raise ValueError(f"Unknown password hasher {name}")
+    cost = cost or DEFAULT_COSTS[name]
+    if (name, cost) not in _hashers:
+        _hashers[(name, cost)] = HASHERS[name](cost)
+    return _hashers[(name, cost)]
+
+
+def _hasherFor(encoded):
+    # Hashes without an algorithm prefix are legacy "salt:digest" strings
+    if "$" not in encoded:
+        return LegacySHA512Hasher(None)
+    return getHasher(encoded.split("$", 1)[0], 1)
+
+
+class HashingPool:
+    """
+    Executor for hashing with a bounded number of queued jobs
+      Parameters:
+        kind (string):     "thread" for a thread pool, since hashlib's KDFs
+                           release the GIL, or "process" for a process pool
+        workers (int):     number of workers
+        queueDepth (int):  number of jobs that may wait for a worker
+    """
+
+    def __init__(self, kind, workers, queueDepth):
+        if kind == 'thread':
+            self.executor = ThreadPoolExecutor(
+                workers, thread_name_prefix='password-hash')
+        elif kind == 'process':
+            self.executor = ProcessPoolExecutor(workers)
+        else:
+            raise ValueError(f"Unknown hashing executor {kind}")
+        self._slots = threading.BoundedSemaphore(workers + queueDepth)
+
+    def run(self, fn, *args):
+        '''
+        Run a function on the pool and wait for its result
+          Raises:
+            HashingPoolFull if every worker and queue slot is taken
+        '''
+        if not self._slots.acquire(blocking=False):
+            raise HashingPoolFull("Server is busy, please try again")
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+
+_pool = None
+_poolLock = threading.Lock()
+
+
+def getPool():
+    '''
+    Get the hashing pool selected in the app config
+      Returns:
+        HashingPool, None if hashing runs on the calling thread
+    '''
+    global _pool
+    kind = app.config['PASSWORD_HASH_EXECUTOR']
+    if kind == 'none':
+        return None
+    with _poolLock:
+        if _pool is None:
+            _pool = HashingPool(kind, app.config['PASSWORD_HASH_WORKERS'],
+                                app.config['PASSWORD_HASH_QUEUE'])
+    return _pool
+
+
+def _hash(name, cost, password):
+    # Module level so it can be sent to a process pool
+    return getHasher(name, cost).hash(password)
+
+
+def _verify(password, encoded):
+    try:
+        return _hasherFor(encoded).verify(password, encoded)
+    except ValueError:
+        # Malformed or unknown hash
+        return False
+
+
+def hashPassword(password):
+    '''
+    Hash a password with the configured algorithm
+      Parameters:
+        password (string): password to hash
+      Returns:
+        Encoded hash string to store in User.password
+      Raises:
+        HashingPoolFull if the hashing pool is saturated
+    '''
+    hasher = getHasher()
+    pool = getPool()
+    if pool is None:
+        return hasher.hash(password)
+    return pool.run(_hash, hasher.name, hasher.cost, password)
+
+
+def verifyPassword(password, encoded):
+    '''
+    Check a password against a stored hash of any supported algorithm
+      Parameters:
+        password (string): password to check
+        encoded (string):  hash from User.password
+      Returns:
+        True if the password matches, otherwise False
+      Raises:
+        HashingPoolFull if the hashing pool is saturated
+    '''
+    pool = getPool()
+    if pool is None:
+        return _verify(password, encoded)
+    return pool.run(_verify, password, encoded)
+
+
+def needsRehash(encoded):
+    '''
+    Check if a stored hash should be replaced with the configured algorithm
+      Parameters:
+        encoded (string): hash from User.password
+      Returns:
+        True if the hash uses another algorithm or cost
+    '''
+    return "$" not in encoded or getHasher().needsRehash(encoded)
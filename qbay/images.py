@@ -0,0 +1,652 @@
+from qbay import app
+from qbay.models import db, Product, ImageBlob, BinaryUUID, BACKFILL
+from flask import abort, send_from_directory
+from sqlalchemy import ForeignKey, event, func
+from sqlalchemy.orm import aliased, relationship
+from sqlalchemy_imageattach.context import store_context
+from sqlalchemy_imageattach.entity import Image, image_attachment
+from sqlalchemy_imageattach.store import Store
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import mimetypes
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+'''
+This file defines product image storage and thumbnails
+
+Image files are kept in a filesystem store (IMAGE_STORE) and named by the
+SHA-256 of their content, so an image URL always refers to the same bytes
+and can be cached forever. Uploading a picture stores the original and
+returns at once; its thumbnails (THUMBNAIL_SIZES widths) are resized on a
+background worker pool and attached as ProductPicture rows when ready.
+
+Pictures are declared here rather than in qbay.models, so that only code
+using them loads sqlalchemy_imageattach and Wand.
+
+Identical files are stored once: every file has an ImageBlob row counting
+the pictures that use it, and is deleted by collectImages once none do.
+Files of uploads that rolled back have no row, and are deleted by
+collectOrphans.
+Thumbnails of an image that is already stored are shared, not resized again.
+
+Uploads are streamed to a temporary file and rejected once they pass
+IMAGE_MAX_SIZE, and only their header is read before they are accepted.
+ImageMagick only ever runs in a separate process (qbay.resizer) with memory
+and time limits, so a huge or malicious image can't take down a worker.
+'''
+
+# Bytes copied at a time
+CHUNK_SIZE = 64 * 1024
+# Seconds browsers and proxies may cache an image without revalidating
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+# Uploads up to this size are kept in memory, larger ones on disk
+UPLOAD_SPOOL_SIZE = 256 * 1024
+# Bytes allowed for the non-file fields of an upload form
+FORM_MEMORY_SIZE = 64 * 1024
+# Path of a stored file relative to the store root, see ContentStore
+STORE_PATH = re.compile(r'^[0-9a-f]{2}/([0-9a-f]{64})\.[a-z]+$')
+# Seconds a stored file may go without an ImageBlob row before
+# collectOrphans deletes it, far longer than an upload's transaction
+ORPHAN_AGE = 60 * 60
+
+
+# Source:
+#   https://sqlalchemy-imageattach.readthedocs.io/en/1.1.0/guide/declare.html
+class ProductPicture(db.Model, Image):
+    """Product picture model."""
+
+    productId = db.Column(BinaryUUID, ForeignKey('product.id'),
+                          primary_key=True)
+    # SHA-256 of the file, which names it in the image store, see ContentStore
+    contentHash = db.Column(db.String(64),
+                            ForeignKey('image_blob.contentHash'),
+                            nullable=False, index=True)
+    product = relationship('Product', back_populates="image")
+    __tablename__ = 'product_picture'
+
+    @property
+    def object_id(self):
+        # sqlalchemy_imageattach needs an integer ID, product IDs are UUIDs
+        return int(self.productId.replace('-', ''), 16)
+
+
+@event.listens_for(ProductPicture, 'before_insert')
+def referenceBlob(mapper, connection, target):
+    # Runs before sqlalchemy_imageattach stores and closes target.file
+    blobs = ImageBlob.__table__
+    updated = connection.execute(
+        blobs.update().where(blobs.c.contentHash == target.contentHash)
+        .values(refCount=blobs.c.refCount + 1)).rowcount
+    if not updated:
+        target.file.seek(0, os.SEEK_END)
+        size = target.file.tell()
+        target.file.seek(0)
+        connection.execute(blobs.insert().values(
+            contentHash=target.contentHash, mimetype=target.mimetype,
+            size=size, refCount=1))
+
+
+@event.listens_for(ProductPicture, 'after_delete')
+def releaseBlob(mapper, connection, target):
+    blobs = ImageBlob.__table__
+    connection.execute(
+        blobs.update().where(blobs.c.contentHash == target.contentHash)
+        .values(refCount=blobs.c.refCount - 1))
+
+
+Product.image = image_attachment('ProductPicture')
+
+
+def dropUnstoredPictures(conn, column):
+    '''
+    Fill ProductPicture.contentHash for models.migrateSchema, by deleting
+    the pictures attached before it existed
+    Those versions configured no image store, so no file was ever kept for
+    them, there is nothing to hash, and they could never be served. Their
+    products show no picture until one is uploaded.
+    '''
+    conn.execute(column.table.delete().where(column.is_(None)))
+
+
+BACKFILL[('product_picture', 'contentHash')] = dropUnstoredPictures
+
+
+class ResizeError(Exception):
+    """
+    Raised when ImageMagick fails or goes over a limit while resizing
+    """
+    pass
+
+
+class ImageTooLarge(ValueError):
+    """
+    Raised when an image has more than IMAGE_MAX_PIXELS pixels
+    """
+    pass
+
+
+class UploadFile(tempfile.SpooledTemporaryFile):
+    """
+    Temporary file for an upload that refuses to grow past a size limit
+      Parameters:
+        limit (int): maximum size in bytes
+    """
+
+    def __init__(self, limit):
+        super().__init__(max_size=UPLOAD_SPOOL_SIZE, mode='w+b')
+        self.limit = limit
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise RequestEntityTooLarge()
+        return super().write(data)
+
+
+class ContentStore(Store):
+    """
+    sqlalchemy_imageattach store that keeps files in a directory, named by
+    the SHA-256 of their content (ProductPicture.contentHash)
+    Identical files are only stored once, so a file is never deleted along
+    with a single picture, see collectImages.
+      Parameters:
+        path (string):    root directory of the store
+        baseUrl (string): URL the root directory is served at
+    """
+
+    def __init__(self, path, baseUrl='/images/'):
+        self.path = path
+        self.baseUrl = baseUrl
+
+    def relativePath(self, contentHash, mimetype):
+        '''
+        Get the path of a file relative to the store root
+        '''
+        extension = mimetypes.guess_extension(mimetype) or '.bin'
+        return f'{contentHash[:2]}/{contentHash}{extension}'
+
+    def filePath(self, image):
+        '''
+        Get the absolute path of the file of a picture
+        '''
+        return os.path.join(self.path, self.relativePath(image.contentHash,
+                                                         image.mimetype))
+
+    def store(self, image, file):
+        path = self.filePath(image)
+        if os.path.exists(path):
+            # Restarts the wait before collectOrphans may delete it
+            os.utime(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary name first, so a file is never seen partially
+        # written under its final name
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                shutil.copyfileobj(file, out, CHUNK_SIZE)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def delete(self, image):
+        # Files may be shared between pictures, see collectImages. This is
+        # also called on rollback, for files stored by any thread's
+        # transaction since sqlalchemy_imageattach tracks them globally, so
+        # the files of failed uploads are left to collectOrphans instead
+        pass
+
+    def open(self, image, use_seek=False):
+        return open(self.filePath(image), 'rb')
+
+    def locate(self, image):
+        return self.baseUrl + self.relativePath(image.contentHash,
+                                                image.mimetype)
+
+
+imageStore = ContentStore(app.config['IMAGE_STORE'])
+
+
+@app.template_filter('imageUrl')
+def imageUrl(picture):
+    '''
+    Get the URL of a ProductPicture, used as {{ picture|imageUrl }}
+    '''
+    return picture.locate(imageStore)
+
+
+def imageInfo(file):
+    '''
+    Identify an image from its header, without decoding it
+      Parameters:
+        file (file): seekable binary file positioned at its start
+      Returns:
+        (mimetype, width, height)
+      Raises:
+        ValueError if the file is not a supported image
+    '''
+    head = file.read(32)
+    try:
+        if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+            mimetype = 'image/png'
+            width, height = struct.unpack('>II', head[16:24])
+        elif head[:6] in (b'GIF87a', b'GIF89a'):
+            mimetype = 'image/gif'
+            width, height = struct.unpack('<HH', head[6:10])
+        elif head.startswith(b'\xff\xd8'):
+            mimetype = 'image/jpeg'
+            width, height = _jpegSize(file)
+        elif head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            mimetype = 'image/webp'
+            width, height = _webpSize(head)
+        else:
+            raise ValueError("Unsupported image type")
+    except struct.error:
+        raise ValueError("Truncated image header")
+    if width <= 0 or height <= 0:
+        raise ValueError("Invalid image size")
+    return mimetype, width, height
+
+
+def _jpegSize(file):
+    # Walk the segments up to the start of frame, which holds the size
+    file.seek(2)
+    while True:
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ValueError("Invalid JPEG")
+        # Markers may be padded with any number of 0xFF bytes
+        while marker[1] == 0xFF:
+            padding = file.read(1)
+            if not padding:
+                raise ValueError("Invalid JPEG")
+            marker = marker[1:] + padding
+        length, = struct.unpack('>H', file.read(2))
+        # SOF0 to SOF15, except DHT, JPG and DAC which share the range
+        if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8,
+                                                           0xCC):
+            _, height, width = struct.unpack('>BHH', file.read(5))
+            return width, height
+        file.seek(length - 2, os.SEEK_CUR)
+
+
+def _webpSize(head):
+    chunk = head[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', head[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L':
+        bits, = struct.unpack('<I', head[21:25])
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X':
+        width = int.from_bytes(head[24:27], 'little') + 1
+        height = int.from_bytes(head[27:30], 'little') + 1
+        return width, height
+    raise ValueError("Invalid WebP")
+
+
+def contentHash(file):
+    '''
+    Compute the SHA-256 of a file and rewind it
+      Returns:
+        Hex digest
+    '''
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def receiveUpload(environ, field):
+    '''
+    Stream a file from a multipart request body to a temporary file, in
+    chunks, stopping as soon as it passes IMAGE_MAX_SIZE
+      Parameters:
+        environ (dict): WSGI environment of the request
+        field (string): name of the file input
+      Returns:
+        Temporary file positioned at its start, to be closed by the caller
+      Raises:
+        RequestEntityTooLarge if the body or the file is too large
+        ValueError if no file was sent in the field
+    '''
+    limit = app.config['IMAGE_MAX_SIZE']
+    try:
+        # Bodies that can't fit are rejected before any of them is read
+        _, _, files = parse_form_data(
+            environ, stream_factory=lambda *args, **kwargs: UploadFile(limit),
+            max_form_memory_size=FORM_MEMORY_SIZE,
+            max_content_length=limit + FORM_MEMORY_SIZE, silent=False)
+    except RequestEntityTooLarge:
+        raise RequestEntityTooLarge(
+            f"Images can be at most {limit / 1024 / 1024:g}MB")
+    upload = files.get(field)
+    if upload is None or not upload.filename:
+        for other in files.values():
+            other.close()
+        raise ValueError("Please choose an image")
+    return upload.stream
+
+
+def resize(path, width, height):
+    '''
+    Resize an image file with ImageMagick, in a separate process limited to
+    IMAGE_RESIZE_MEMORY bytes and IMAGE_RESIZE_TIMEOUT seconds
+      Parameters:
+        path (string): path of the image file
+        width (int):   width to resize to
+        height (int):  height to resize to
+      Returns:
+        Resized image bytes, in the format of the original
+      Raises:
+        ResizeError if ImageMagick fails or goes over a limit
+    '''
+    memory = app.config['IMAGE_RESIZE_MEMORY']
+    timeout = app.config['IMAGE_RESIZE_TIMEOUT']
+    # ImageMagick's own limits make it fail cleanly before the process
+    # limit is hit, half the memory is left for the interpreter
+    env = dict(os.environ,
+               MAGICK_AREA_LIMIT=str(app.config['IMAGE_MAX_PIXELS']),
+               MAGICK_MEMORY_LIMIT=str(memory // 2),
+               MAGICK_MAP_LIMIT=str(memory // 2),
+               MAGICK_DISK_LIMIT=str(memory),
+               MAGICK_TIME_LIMIT=str(int(timeout)))
+    fd, target = tempfile.mkstemp(suffix=os.path.splitext(path)[1])
+    os.close(fd)
+    try:
+        result = subprocess.run(
+            [sys.executable, '-m', 'qbay.resizer', path, target, str(width),
+             str(height), str(memory)],
+            cwd=os.path.dirname(app.root_path), env=env, timeout=timeout,
+            stdin=subprocess.DEVNULL, capture_output=True)
+        if result.returncode != 0:
+            lines = result.stderr.decode(errors='replace').strip()
+            raise ResizeError(lines.splitlines()[-1] if lines
+                              else f"Exit status {result.returncode}")
+        with open(target, 'rb') as f:
+            return f.read()
+    except subprocess.TimeoutExpired:
+        raise ResizeError(f"Resizing took over {timeout}s")
+    finally:
+        os.unlink(target)
+
+
+_pool = None
+_poolLock = threading.Lock()
+
+
+def getPool():
+    '''
+    Get the thumbnail worker pool
+    Each worker only waits on a resize process, so threads are enough.
+    '''
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(app.config['IMAGE_WORKERS'],
+                                       thread_name_prefix='thumbnail')
+    return _pool
+
+
+def saveProductImage(productId, file):
+    '''
+    Store the picture of a product, replacing any previous one, and queue
+    its thumbnails
+      Parameters:
+        productId (string): ID of the product
+        file (file):        seekable binary file of the image
+      Returns:
+        Future of the thumbnail job, see generateThumbnails
+      Raises:
+        ValueError with error message if the file is not a supported image
+        or the product does not exist, ImageTooLarge if it has more than
+        IMAGE_MAX_PIXELS pixels
+    '''
+    mimetype, width, height = imageInfo(file)
+    # Checked before anything decodes the image, since a small file can
+    # claim a size that would take gigabytes to decode
+    if width * height > app.config['IMAGE_MAX_PIXELS']:
+        raise ImageTooLarge(f"Image is too large ({width}x{height})")
+    file.seek(0)
+    digest = contentHash(file)
+    product = db.session.get(Product, productId)
+    if product is None:
+        raise ValueError(f"Product {productId} does not exist")
+
+    # Replaces the previous original and its thumbnails
+    product.image.from_raw_file(file, imageStore, size=(width, height),
+                                mimetype=mimetype, original=True,
+                                extra_kwargs={'contentHash': digest})
+    db.session.commit()
+    collectImages()
+    return getPool().submit(generateThumbnails, productId, digest)
+
+
+def generateThumbnails(productId, digest):
+    '''
+    Resize the picture of a product to every thumbnail width smaller than
+    it, runs on the thumbnail pool
+    Thumbnails already made from the same image for another product are
+    shared instead of resized again.
+      Parameters:
+        productId (string): ID of the product
+        digest (string):    content hash of the picture to resize, nothing
+                            is done if the picture was replaced since
+      Returns:
+        Number of thumbnails created
+    '''
+    with app.app_context(), store_context(imageStore):
+        try:
+            product = db.session.get(Product, productId)
+            original = product.image.original if product else None
+            if original is None or original.contentHash != digest:
+                return 0
+            source = imageStore.filePath(original)
+            shared = sharedThumbnails(digest)
+            created = 0
+            for width in app.config['THUMBNAIL_SIZES']:
+                if width >= original.width:
+                    continue
+                if width in shared:
+                    thumbnail = shared[width]
+                    product.image.from_raw_file(
+                        imageStore.open(thumbnail), imageStore,
+                        size=thumbnail.size, mimetype=thumbnail.mimetype,
+                        original=False,
+                        extra_kwargs={'contentHash': thumbnail.contentHash})
+                    created += 1
+                    continue
+                height = max(1, round(original.height * width
+                                      / original.width))
+                try:
+                    blob = resize(source, width, height)
+                except ResizeError as err:
+                    # Other sizes would fail the same way
+                    print(f"Thumbnail of product {productId} failed: {err}")
+                    break
+                product.image.from_raw_file(
+                    io.BytesIO(blob), imageStore, size=(width, height),
+                    mimetype=original.mimetype, original=False,
+                    extra_kwargs={
+                        'contentHash': hashlib.sha256(blob).hexdigest()})
+                created += 1
+            db.session.commit()
+            return created
+        finally:
+            db.session.remove()
+
+
+def sharedThumbnails(digest):
+    '''
+    Find thumbnails already made from an image
+      Parameters:
+        digest (string): content hash of the original image
+      Returns:
+        dict from width to a ProductPicture thumbnail of that width
+    '''
+    original = aliased(ProductPicture)
+    thumbnails = ProductPicture.query \
+        .join(original, original.productId == ProductPicture.productId) \
+        .filter(original.original.is_(True),
+                original.contentHash == digest,
+                ProductPicture.original.is_(False))
+    return {thumbnail.width: thumbnail for thumbnail in thumbnails}
+
+
+def collectImages(orphans=False):
+    '''
+    Delete the stored files that no picture refers to anymore
+      Parameters:
+        orphans (bool): also delete the files of failed uploads, see
+                        collectOrphans
+      Returns:
+        (number of files deleted, bytes freed)
+    '''
+    deleted = freed = 0
+    unused = ImageBlob.query.filter(ImageBlob.refCount <= 0).all()
+    for blob in unused:
+        # A concurrent upload may have started using it since, and keeps
+        # waiting on this row until the file is gone and committed
+        if ImageBlob.query.filter(ImageBlob.contentHash == blob.contentHash,
+                                  ImageBlob.refCount <= 0) \
+                .delete(synchronize_session=False):
+            path = os.path.join(imageStore.path, imageStore.relativePath(
+                blob.contentHash, blob.mimetype))
+            if os.path.exists(path):
+                os.unlink(path)
+            deleted += 1
+            freed += blob.size
+    db.session.commit()
+    if orphans:
+        count, size = collectOrphans()
+        deleted += count
+        freed += size
+    return deleted, freed
+
+
+def collectOrphans():
+    '''
+    Delete the stored files that have no ImageBlob row, once they are
+    ORPHAN_AGE seconds old
+    Uploads whose transaction rolls back leave their file behind without a
+    row. Newer files may belong to an upload that hasn't committed yet.
+    Walks the whole store, so it is only run by `flask gc-images`.
+      Returns:
+        (number of files deleted, bytes freed)
+    '''
+    deleted = freed = 0
+    if not os.path.isdir(imageStore.path):
+        return deleted, freed
+    cutoff = time.time() - ORPHAN_AGE
+    for prefix in sorted(os.listdir(imageStore.path)):
+        directory = os.path.join(imageStore.path, prefix)
+        if not os.path.isdir(directory):
+            continue
+        files = {}
+        for name in os.listdir(directory):
+            match = STORE_PATH.match(f'{prefix}/{name}')
+            path = os.path.join(directory, name)
+            if match is not None and os.path.getmtime(path) < cutoff:
+                files[match.group(1)] = path
+        if not files:
+            continue
+        known = {digest for digest, in db.session.query(
+            ImageBlob.contentHash).filter(ImageBlob.contentHash.in_(files))}
+        for digest, path in files.items():
+            if digest not in known:
+                freed += os.path.getsize(path)
+                os.unlink(path)
+                deleted += 1
+    return deleted, freed
+
+
+def recountImages():
+    '''
+    Rebuild every ImageBlob row from the pictures that refer to it, for
+    pictures stored before blobs were counted or counts that have drifted
+    '''
+    counts = db.session.query(ProductPicture.contentHash,
+                              ProductPicture.mimetype, func.count()) \
+        .group_by(ProductPicture.contentHash, ProductPicture.mimetype)
+    blobs = {blob.contentHash: blob for blob in ImageBlob.query}
+    for blob in blobs.values():
+        blob.refCount = 0
+    for digest, mimetype, count in counts:
+        blob = blobs.get(digest)
+        if blob is None:
+            path = os.path.join(imageStore.path,
+                                imageStore.relativePath(digest, mimetype))
+            blob = ImageBlob(contentHash=digest, mimetype=mimetype,
+                             size=os.path.getsize(path))
+            db.session.add(blob)
+        blob.refCount = count
+    db.session.commit()
+
+
+def storageStats():
+    '''
+    Get how much storage sharing identical images saves
+      Returns:
+        dict with the number of stored files and of pictures using them,
+        storedBytes, referencedBytes (size without sharing) and savedBytes
+    '''
+    files, pictures, stored, referenced = db.session.query(
+        func.count(), func.coalesce(func.sum(ImageBlob.refCount), 0),
+        func.coalesce(func.sum(ImageBlob.size), 0),
+        func.coalesce(func.sum(ImageBlob.size * ImageBlob.refCount), 0)) \
+        .filter(ImageBlob.refCount > 0).one()
+    return {'files': files, 'pictures': pictures, 'storedBytes': stored,
+            'referencedBytes': referenced,
+            'savedBytes': referenced - stored}
+
+
+def pictureFor(product, width):
+    '''
+    Get the picture of a product best suited to a display width
+      Parameters:
+        product (Product): product to get the picture of
+        width (int):       width the picture is displayed at
+      Returns:
+        Smallest ProductPicture at least width wide, or the largest one if
+        none is, None if the product has no picture
+    '''
+    pictures = product.image.order_by(ProductPicture.width).all()
+    for picture in pictures:
+        if picture.width >= width:
+            return picture
+    return pictures[-1] if pictures else None
+
+
+def sendImage(path):
+    '''
+    Serve a file from the image store
+    Files never change under a name, so responses have a strong ETag (the
+    content hash) and may be cached as immutable. Range and conditional
+    requests are answered by send_from_directory.
+      Parameters:
+        path (string): path relative to the store root
+      Returns:
+        Flask response, 404 for a malformed or unknown path
+    '''
+    match = STORE_PATH.match(path)
+    if match is None:
+        abort(404)
+    response = send_from_directory(imageStore.path, path,
+                                   etag=match.group(1),
+                                   max_age=IMAGE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,198 @@
+from qbay.models import db, User, Product
+from qbay.backend import checkProductFields, touchCatalog, catalogChanged
+from uuid import uuid4
+import csv
+import datetime as dt
+import json
+import time
+
+'''
+This file defines bulk product import
+
+Rows are validated and inserted in batches: each batch resolves its owners
+and checks for duplicate (ownerEmail, productName) pairs with one query
+each, inserts the valid rows with a single bulk insert, and commits.
+'''
+
+# Number of rows validated, inserted and committed together
+BATCH_SIZE = 1000
+# Row fields that must be strings when present
+TEXT_FIELDS = ('productName', 'description', 'ownerEmail', 'lastModifiedDate')
+
+
+class ImportReport:
+    """
+    Result of a bulk import
+      Attributes:
+        imported (int):  number of products created
+        errors (list):   (row number, error message) for every rejected row
+        elapsed (float): seconds taken by the import
+    """
+
+    def __init__(self):
+        self.imported = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+    @property
+    def rows(self):
+        return self.imported + len(self.errors)
+
+    @property
+    def rowsPerSecond(self):
+        return self.rows / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        lines = [f"Row {row}: {message}" for row, message in self.errors]
+        lines.append(f"Imported {self.imported} of {self.rows} rows in "
+                     f"{self.elapsed:.2f}s ({self.rowsPerSecond:.0f} rows/s)")
+        return "\n".join(lines)
+
+
+def readRows(stream, fmt):
+    '''
+    Read product rows from a CSV or JSON Lines stream
+      Parameters:
+        stream (file): text stream to read
+        fmt (string):  "csv" (with a header row) or "jsonl"
+      Returns:
+        Generator of (row number, dict or ValueError) tuples
+    '''
+    if fmt == 'csv':
+        # Header is row 1, so data starts at row 2
+        for number, row in enumerate(csv.DictReader(stream), 2):
+            yield number, row
+    elif fmt == 'jsonl':
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError("Row is not an object")
+                yield number, row
+            except ValueError as err:
+                yield number, ValueError(f"Invalid JSON: {err}")
+    else:
+        raise ValueError(f"Unknown import format {fmt}")
+
+
+def parseRow(row):
+    '''
+    Convert a raw row into product fields and check them
+      Parameters:
+        row (dict): productName, description, price, ownerEmail and
+                    optionally lastModifiedDate (ISO 8601)
+      Returns:
+        dict of Product column values
+      Raises:
+        ValueError with error message if the row is invalid
+    '''
+    # JSON Lines values can be of any type, CSV ones are always strings
+    for field in TEXT_FIELDS:
+        if not isinstance(row.get(field) or '', str):
+            raise ValueError(f"Invalid {field} {row.get(field)!r}, "
+                             "expected a string")
+    price = row.get('price')
+    if isinstance(price, bool) \
+            or not isinstance(price, (str, int, float)):
+        raise ValueError(f"Invalid price {price}")
+    try:
+        price = float(price)
+    except ValueError:
+        raise ValueError(f"Invalid price {price}")
+    date = row.get('lastModifiedDate')
+    date = dt.datetime.fromisoformat(date) if date else dt.datetime.now()
+    values = {
+        'productName': row.get('productName') or '',
+        'description': row.get('description') or '',
+        'price': price,
+        'lastModifiedDate': date,
+        'ownerEmail': row.get('ownerEmail'),
+    }
+    try:
+        checkProductFields(values['productName'], values['description'],
+                           price, date, values['ownerEmail'])
+    except (TypeError, AttributeError) as err:
+        # Reported as a bad row, like failed checks, not an import error
+        raise ValueError(f"Invalid row: {err}")
+    return values
+
+
+def importBatch(batch, seen, report):
+    '''
+    Validate, insert and commit one batch of rows
+      Parameters:
+        batch (list):          (row number, dict or ValueError) tuples
+        seen (set):            (ownerEmail, productName) pairs imported so
+                               far, updated with this batch
+        report (ImportReport): report to add results to
+    '''
+    parsed = []
+    for number, row in batch:
+        try:
+            if isinstance(row, ValueError):
+                raise row
+            parsed.append((number, parseRow(row)))
+        except ValueError as err:
+            report.errors.append((number, str(err)))
+
+    emails = {v['ownerEmail'] for _, v in parsed}
+    names = {v['productName'] for _, v in parsed}
+    # Resolve every owner in the batch at once
+    owners = dict(db.session.query(User.email, User.id)
+                  .filter(User.email.in_(emails)))
+    # Find existing products with any of the batch's owners and names, the
+    # exact pairs are checked below
+    existing = set(db.session.query(Product.ownerEmail, Product.productName)
+                   .filter(Product.ownerEmail.in_(emails),
+                           Product.productName.in_(names)))
+
+    mappings = []
+    for number, values in parsed:
+        pair = (values['ownerEmail'], values['productName'])
+        if pair[0] not in owners:
+            report.errors.append((number, f"Owner does not exist {pair[0]}"))
+        elif pair in existing or pair in seen:
+            report.errors.append(
+                (number, f"User already has product {pair[1]}"))
+        else:
+            seen.add(pair)
+            values['id'] = str(uuid4())
+            values['userId'] = owners[pair[0]]
+            values['sold'] = False
+            mappings.append(values)
+
+    version = None
+    if mappings:
+        db.session.bulk_insert_mappings(Product, mappings)
+        version = touchCatalog()
+    db.session.commit()
+    if version is not None:
+        catalogChanged(version)
+    report.imported += len(mappings)
+
+
+def importProducts(rows, batchSize=BATCH_SIZE):
+    '''
+    Bulk import products
+      Parameters:
+        rows (iterable):  (row number, dict) tuples, such as from readRows
+        batchSize (int):  number of rows committed together
+      Returns:
+        ImportReport with per-row errors and throughput
+    '''
+    report = ImportReport()
+    seen = set()
+    start = time.perf_counter()
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batchSize:
+            importBatch(batch, seen, report)
+            batch = []
+    if batch:
+        importBatch(batch, seen, report)
+    report.errors.sort()
+    report.elapsed = time.perf_counter() - start
+    return report
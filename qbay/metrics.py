@@ -0,0 +1,293 @@
+from qbay import app
+from qbay.models import TimedQueuePool
+from flask import g, request, has_request_context, before_render_template, \
+    template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import bisect
+import functools
+import threading
+import time
+
+'''
+This file defines request metrics
+
+Every request records its latency, the number of SQL statements it ran,
+the time spent in the database and the time spent rendering templates,
+labelled by route. Metrics are kept in fixed-size histograms, so recording
+is a few additions under a lock, and exported in Prometheus text format.
+
+The database pool's checkout waits and timeouts are recorded as well, with
+its current size, so pool exhaustion shows up before requests fail.
+'''
+
+# Upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+# Upper bounds (seconds) of the pool checkout wait buckets, waiting for a
+# free connection should normally take well under a millisecond
+CHECKOUT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                    1.0, 2.5, 5.0, 10.0)
+# Quantiles estimated from the latency histograms
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """
+    Prometheus style histogram with fixed buckets
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # One count per bucket, plus the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''
+        Estimate a quantile by interpolating within its bucket
+          Parameters:
+            q (float): quantile between 0 and 1
+          Returns:
+            Estimated value, 0 if nothing was observed
+        '''
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                if i == len(self.buckets):
+                    # Values above the last bucket can't be interpolated
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) \
+                    * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def lines(self, name, labels):
+        '''
+        Format the histogram as Prometheus text lines
+        '''
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class RouteStats:
+    """
+    Metrics for one route
+    """
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.dbTime = Histogram()
+        self.renderTime = Histogram()
+        self.statements = 0
+
+
+class Metrics:
+    """
+    Registry of per-route metrics
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.checkoutWait = Histogram(CHECKOUT_BUCKETS)
+        self.checkoutTimeouts = 0
+        self._lock = threading.Lock()
+
+    def record(self, method, route, latency, statements, dbTime,
+               renderTime):
+        '''
+        Record a finished request
+          Parameters:
+            method (string):    HTTP method
+            route (string):     URL rule that matched the request
+            latency (float):    seconds taken by the request
+            statements (int):   SQL statements executed
+            dbTime (float):     seconds spent executing SQL
+            renderTime (float): seconds spent rendering templates
+        '''
+        with self._lock:
+            stats = self.routes.get((method, route))
+            if stats is None:
+                stats = self.routes[(method, route)] = RouteStats()
+            stats.latency.observe(latency)
+            stats.dbTime.observe(dbTime)
+            stats.renderTime.observe(renderTime)
+            stats.statements += statements
+
+    def recordCheckout(self, wait, timedOut):
+        '''
+        Record a database pool checkout, see models.TimedQueuePool
+          Parameters:
+            wait (float):       seconds waited for a connection
+            timedOut (bool):    no connection was free within the timeout
+        '''
+        with self._lock:
+            self.checkoutWait.observe(wait)
+            if timedOut:
+                self.checkoutTimeouts += 1
+
+    def render(self, pool=None):
+        '''
+        Export every metric in Prometheus text format
+          Parameters:
+            pool (Pool): database pool to report the size of
+          Returns:
+            Exposition text
+        '''
+        with self._lock:
+            routes = sorted(self.routes.items())
+            out = []
+            families = [
+                ('qbay_request_duration_seconds', 'latency',
+                 'Request latency'),
+                ('qbay_db_duration_seconds', 'dbTime',
+                 'Time spent executing SQL per request'),
+                ('qbay_render_duration_seconds', 'renderTime',
+                 'Time spent rendering templates per request'),
+            ]
+            for name, attr, description in families:
+                out.append(f'# HELP {name} {description}')
+                out.append(f'# TYPE {name} histogram')
+                for key, stats in routes:
+                    out.extend(getattr(stats, attr).lines(name, labels(key)))
+
+            name = 'qbay_request_duration_quantile_seconds'
+            out.append(f'# HELP {name} Request latency quantile estimates')
+            out.append(f'# TYPE {name} gauge')
+            for key, stats in routes:
+                for q in QUANTILES:
+                    out.append(f'{name}{{{labels(key)},quantile="{q}"}} '
+                               f'{stats.latency.quantile(q)}')
+
+            name = 'qbay_sql_statements_total'
+            out.append(f'# HELP {name} SQL statements executed')
+            out.append(f'# TYPE {name} counter')
+            for key, stats in routes:
+                out.append(f'{name}{{{labels(key)}}} {stats.statements}')
+
+            name = 'qbay_db_pool_checkout_seconds'
+            out.append(f'# HELP {name} Time waited for a database connection')
+            out.append(f'# TYPE {name} histogram')
+            out.extend(self.checkoutWait.lines(name, 'pool="default"'))
+            name = 'qbay_db_pool_timeouts_total'
+            out.append(f'# HELP {name} Checkouts finding no free connection')
+            out.append(f'# TYPE {name} counter')
+            out.append(f'{name} {self.checkoutTimeouts}')
+        if isinstance(pool, TimedQueuePool):
+            for name, value, description in [
+                    ('size', pool.size(), 'Connections kept open'),
+                    ('checked_out', pool.checkedout(),
+                     'Connections in use'),
+                    ('overflow', max(pool.overflow(), 0),
+                     'Connections open beyond the pool size')]:
+                name = f'qbay_db_pool_{name}'
+                out.append(f'# HELP {name} {description}')
+                out.append(f'# TYPE {name} gauge')
+                out.append(f'{name} {value}')
+        return '\n'.join(out) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self.routes = {}
+            self.checkoutWait = Histogram(CHECKOUT_BUCKETS)
+            self.checkoutTimeouts = 0
+
+
+def labels(key):
+    '''
+    Format a (method, route) key as Prometheus labels
+    '''
+    method, route = key
+    route = route.replace('\\', '\\\\').replace('"', '\\"')
+    return f'method="{method}",route="{route}"'
+
+
+metrics = Metrics()
+
+
+@app.before_request
+def startRequest():
+    g.metricsStart = time.perf_counter()
+    g.metricsStatements = 0
+    g.metricsDbTime = 0.0
+    g.metricsRenderTime = 0.0
+
+
+@app.teardown_request
+def finishRequest(_):
+    if 'metricsStart' not in g:
+        return
+    rule = request.url_rule
+    metrics.record(request.method, rule.rule if rule else 'unmatched',
+                   time.perf_counter() - g.metricsStart,
+                   g.metricsStatements, g.metricsDbTime,
+                   g.metricsRenderTime)
+
+
+def beforeCursorExecute(conn, cursor, statement, parameters, context,
+                        executemany):
+    if has_request_context():
+        g.metricsQueryStart = time.perf_counter()
+
+
+def afterCursorExecute(conn, cursor, statement, parameters, context,
+                       executemany):
+    if has_request_context() and 'metricsQueryStart' in g:
+        g.metricsStatements = g.get('metricsStatements', 0) + 1
+        g.metricsDbTime = g.get('metricsDbTime', 0.0) \
+            + time.perf_counter() - g.pop('metricsQueryStart')
+
+
+def beforeRender(sender, template, context, **extra):
+    g.metricsRenderStart = time.perf_counter()
+
+
+def afterRender(sender, template, context, **extra):
+    if 'metricsRenderStart' in g:
+        g.metricsRenderTime = g.get('metricsRenderTime', 0.0) \
+            + time.perf_counter() - g.pop('metricsRenderStart')
+
+
+def timedMacro(macro):
+    '''
+    Count the time spent calling a template macro as rendering
+    Macros from get_template_attribute render without the template signals
+    render_template sends, so they are timed here instead
+      Parameters:
+        macro (function): macro from get_template_attribute
+      Returns:
+        Function calling the macro
+    '''
+    @functools.wraps(macro)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return macro(*args, **kwargs)
+        finally:
+            if has_request_context():
+                g.metricsRenderTime = g.get('metricsRenderTime', 0.0) \
+                    + time.perf_counter() - start
+    return timed
+
+
+# Listening on Engine covers the primary and every read replica, including
+# replica engines made after this module is imported
+event.listen(Engine, 'before_cursor_execute', beforeCursorExecute)
+event.listen(Engine, 'after_cursor_execute', afterCursorExecute)
+TimedQueuePool.observer = metrics.recordCheckout
+before_render_template.connect(beforeRender, app)
+template_rendered.connect(afterRender, app)
@@ -1,19 +1,135 @@
 from qbay import app
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey
+from qbay import sqlite
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import ForeignKey, LargeBinary, event, inspect, orm, text
+from sqlalchemy.dialects import mysql
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeout
 from sqlalchemy.orm import relationship
-from sqlalchemy_imageattach.entity import Image, image_attachment
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.types import TypeDecorator
+import datetime as dt
+import flask
+import functools
+import itertools
+import time
+import uuid
 
-db = SQLAlchemy(app)
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that times how long every checkout waits for a connection
+    """
+    # Called with the seconds waited and whether the wait timed out, set by
+    # qbay.metrics
+    observer = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timedOut = False
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            timedOut = True
+            raise
+        finally:
+            if TimedQueuePool.observer is not None:
+                TimedQueuePool.observer(time.perf_counter() - start,
+                                        timedOut)
+
+
+def engineOptions(config):
+    '''
+    Get the create_engine options for the DB_POOL settings
+      Parameters:
+        config (dict): app config
+      Returns:
+        dict of options
+    '''
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite' \
+            and url.database in (None, '', ':memory:'):
+        # An in memory database only exists in its one connection
+        return {}
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    if url.get_backend_name() == 'sqlite':
+        # Pooled connections are used by one thread at a time, but not
+        # always the thread that opened them
+        options['connect_args'] = {'check_same_thread': False,
+                                   **sqlite.connectArgs(config)}
+    return options
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends queries to a read replica inside replicaReads
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica')
+        if replica is not None and not self._flushing:
+            return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engineOptions(app.config)
+db = RoutingSQLAlchemy(app)
 
 '''
 This file defines data models
 '''
 
 
+class BinaryUUID(TypeDecorator):
+    """
+    UUID column stored as 16 bytes (BINARY(16) on MySQL, BLOB elsewhere)
+    instead of 36 characters of text, which makes every key, index and join
+    less than half the size. Values are still written and read as strings.
+    """
+    impl = LargeBinary(16)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'mysql':
+            return dialect.type_descriptor(mysql.BINARY(16))
+        return dialect.type_descriptor(LargeBinary(16))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, uuid.UUID):
+            return value.bytes
+        try:
+            return uuid.UUID(value).bytes
+        except ValueError:
+            # A malformed ID, such as from a tampered cookie, can't match
+            # any row, but shouldn't make the query fail either
+            return value.encode()
+
+    def process_result_value(self, value, dialect):
+        if value is None or isinstance(value, str):
+            # Text values are left by databases not yet migrated, see
+            # migrateUUIDs
+            return value
+        return str(uuid.UUID(bytes=bytes(value)))
+
+
 class User(db.Model):
     """User model."""
-    id = db.Column(db.String(36), primary_key=True)
+    id = db.Column(BinaryUUID, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password = db.Column(db.String(165), nullable=False)
@@ -38,20 +154,17 @@ class User(db.Model):
                 % (self.postalCode, self.balance))
 
 
-# Source:
-#   https://sqlalchemy-imageattach.readthedocs.io/en/1.1.0/guide/declare.html
-# Used for including product image
 class Product(db.Model):
     """Product model."""
-    id = db.Column(db.String(36), primary_key=True)
+    id = db.Column(BinaryUUID, primary_key=True)
     productName = db.Column(db.String(80), nullable=False)
-    userId = db.Column(db.String(36), ForeignKey('user.id'), nullable=False)
+    userId = db.Column(BinaryUUID, ForeignKey('user.id'), nullable=False)
     ownerEmail = db.Column(db.String(120), nullable=False)
     price = db.Column(db.Float, nullable=False)
     description = db.Column(db.String(2000), nullable=False)
     lastModifiedDate = db.Column(db.DateTime, nullable=False)
     sold = db.Column(db.Boolean, nullable=False, default=False)
-    buyerId = db.Column(db.String(36), ForeignKey('user.id'), default=None)
+    buyerId = db.Column(BinaryUUID, ForeignKey('user.id'), default=None)
     # brand = db.Column(db.String(128))
     # size = db.Column(db.Float)
     # width = db.Column(db.Float)
@@ -62,52 +175,80 @@ class Product(db.Model):
     # shipCost = db.Column(db.Float, nullable=False)
     # category = db.Column(db.String(64))
     # bidder = db.Column(db.String(64))
-    image = image_attachment('ProductPicture')
+    # Pictures are declared in qbay.images, which adds Product.image when
+    # it's imported, so sqlalchemy_imageattach and Wand load on first use
 
     user = relationship('User', back_populates='products', foreign_keys=userId)
     reviews = relationship('Review', back_populates='product')
     transaction = relationship('Transaction', back_populates='product')
     buyer = relationship('User', foreign_keys=buyerId)
     __tablename__ = "product"
+    __table_args__ = (
+        # Keyset index for the home page listing, see backend.listProducts
+        db.Index('ix_product_listing', 'sold', 'lastModifiedDate', 'id'),
+        # Duplicate name check in backend.validateProductParameters
+        db.Index('ix_product_owner_name', 'ownerEmail', 'productName'),
+        # Product lookup by name in controllers.updateProduct_get/post
+        db.Index('ix_product_user_name', 'userId', 'productName'),
+        # Own products for sale on the home page
+        db.Index('ix_product_user_sold', 'userId', 'sold'),
+        # Purchase history on the home page
+        db.Index('ix_product_buyer', 'buyerId'),
+    )
 
 
-class ProductPicture(db.Model, Image):
-    """Product picture model."""
-
-    productId = db.Column(db.String(36), ForeignKey('product.id'),
-                          primary_key=True)
-    product = relationship('Product', back_populates="image")
-    __tablename__ = 'product_picture'
+class ImageBlob(db.Model):
+    """Image file model, shared by every picture with the same content."""
+    contentHash = db.Column(db.String(64), primary_key=True)
+    mimetype = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    # Number of ProductPicture rows with this content, kept by the listeners
+    # in qbay.images, which also removes the files of unreferenced blobs
+    refCount = db.Column(db.Integer, nullable=False, default=0)
+    __tablename__ = 'image_blob'
+    __table_args__ = (
+        # Unreferenced blob lookup in images.collectImages
+        db.Index('ix_image_blob_refs', 'refCount'),
+    )
 
 
 class Session(db.Model):
     """Session model."""
-    sessionId = db.Column(db.String(36), primary_key=True)
-    userId = db.Column(db.String(36), ForeignKey('user.id'), nullable=False)
+    sessionId = db.Column(BinaryUUID, primary_key=True)
+    userId = db.Column(BinaryUUID, ForeignKey('user.id'), nullable=False)
     expiry = db.Column(db.DateTime)
     ipAddress = db.Column(db.String(15))
     csrfToken = db.Column(db.String(32))
-    user = db.Column(db.String(36), ForeignKey('product.id'))
+    user = db.Column(BinaryUUID, ForeignKey('product.id'))
 
     user = relationship('User', back_populates='sessions')
     __tablename__ = "session"
+    __table_args__ = (
+        # Session lookup in controllers.authenticate
+        db.Index('ix_session_id_ip', 'sessionId', 'ipAddress'),
+        # Expired session sweep in backend.sweepSessions
+        db.Index('ix_session_expiry', 'expiry'),
+    )
 
 
 # Used to process transactions
 class Transaction(db.Model):
     """Transaction model."""
-    paymentId = db.Column(db.String(36), primary_key=True)
-    customerId = db.Column(db.String(36), ForeignKey('user.id'),
+    paymentId = db.Column(BinaryUUID, primary_key=True)
+    customerId = db.Column(BinaryUUID, ForeignKey('user.id'),
                            nullable=False)
-    merchantId = db.Column(db.String(36), ForeignKey('user.id'),
+    merchantId = db.Column(BinaryUUID, ForeignKey('user.id'),
                            nullable=False)
-    productId = db.Column(db.String(36), ForeignKey('product.id'),
+    productId = db.Column(BinaryUUID, ForeignKey('product.id'),
                           nullable=False)
     netAmount = db.Column(db.Float, nullable=False)
-    cardId = db.Column(db.BigInteger, nullable=False, unique=True)
-    cvv = db.Column(db.Integer, nullable=False)
-    expiryDate = db.Column(db.Date(), nullable=False)
-    billAddress = db.Column(db.String(128), nullable=False)
+    createdAt = db.Column(db.DateTime, nullable=False)
+    # Card details are only set for card payments, purchases paid from the
+    # user's balance leave them empty
+    cardId = db.Column(db.BigInteger, unique=True)
+    cvv = db.Column(db.Integer)
+    expiryDate = db.Column(db.Date())
+    billAddress = db.Column(db.String(128))
 
     customer = relationship('User', back_populates='buyTransactions',
                             uselist=False, foreign_keys=[customerId])
@@ -115,14 +256,21 @@ class Transaction(db.Model):
                             uselist=False, foreign_keys=[merchantId])
     product = relationship('Product', back_populates='transaction')
     __tablename__ = "transaction"
+    __table_args__ = (
+        # Keyset indexes for backend.purchaseHistory and backend.salesHistory
+        db.Index('ix_transaction_customer', 'customerId', 'createdAt',
+                 'paymentId'),
+        db.Index('ix_transaction_merchant', 'merchantId', 'createdAt',
+                 'paymentId'),
+    )
 
 
 class Review(db.Model):
     """Product Review model."""
-    id = db.Column(db.String(36), primary_key=True, unique=True)
-    productId = db.Column(db.String(36), ForeignKey('product.id'),
+    id = db.Column(BinaryUUID, primary_key=True, unique=True)
+    productId = db.Column(BinaryUUID, ForeignKey('product.id'),
                           nullable=False)
-    userId = db.Column(db.String(36), ForeignKey('user.id'), nullable=False)
+    userId = db.Column(BinaryUUID, ForeignKey('user.id'), nullable=False)
     rating = db.Column(db.Integer, nullable=False)
     content = db.Column(db.String(32767), nullable=False)
     datetime = db.Column(db.DateTime, nullable=False)
@@ -132,5 +280,320 @@ class Review(db.Model):
     __tablename__ = "review"
 
 
-# create all tables
-db.create_all()
+class CatalogVersion(db.Model):
+    """
+    Single row identifying the current state of the product catalog
+    Every change to what product pages show writes a new random version in
+    its own transaction, see backend.touchCatalog, so pages can be
+    validated by reading this row instead of scanning product
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.String(32), nullable=False)
+    changedAt = db.Column(db.DateTime, nullable=False)
+    __tablename__ = "catalog_version"
+
+
+# SQLite full-text index over product names and descriptions. The FTS5 table
+# reads its content from product and triggers keep it in sync with every
+# insert, update and delete, see backend.searchProducts
+SQLITE_SEARCH_INDEX = [
+    """CREATE VIRTUAL TABLE product_fts USING fts5(
+        productName, description, content='product', content_rowid='rowid')
+    """,
+    """CREATE TRIGGER product_fts_insert AFTER INSERT ON product BEGIN
+        INSERT INTO product_fts(rowid, productName, description)
+        VALUES (new.rowid, new.productName, new.description);
+    END""",
+    """CREATE TRIGGER product_fts_delete AFTER DELETE ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, productName, description)
+        VALUES ('delete', old.rowid, old.productName, old.description);
+    END""",
+    """CREATE TRIGGER product_fts_update
+    AFTER UPDATE OF productName, description ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, productName, description)
+        VALUES ('delete', old.rowid, old.productName, old.description);
+        INSERT INTO product_fts(rowid, productName, description)
+        VALUES (new.rowid, new.productName, new.description);
+    END""",
+    # Index the products that existed before the table was created
+    "INSERT INTO product_fts(product_fts) VALUES ('rebuild')",
+]
+MYSQL_SEARCH_INDEX = [
+    "ALTER TABLE product ADD FULLTEXT INDEX ix_product_text "
+    "(productName, description)",
+]
+
+
+def createSearchIndex():
+    '''
+    Create the full-text index for product search if it doesn't exist
+    Other databases, or SQLite builds without FTS5, are searched without
+    an index
+    '''
+    dialect = db.engine.dialect.name
+    try:
+        with db.engine.begin() as conn:
+            if dialect == 'sqlite':
+                exists = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'product_fts'"
+                )).first()
+                statements = SQLITE_SEARCH_INDEX
+            elif dialect == 'mysql':
+                exists = conn.execute(text(
+                    "SHOW INDEX FROM product WHERE Key_name = "
+                    "'ix_product_text'")).first()
+                statements = MYSQL_SEARCH_INDEX
+            else:
+                return
+            if exists is None:
+                for statement in statements:
+                    conn.execute(text(statement))
+    except OperationalError as err:
+        print(f"Full-text search index unavailable: {err}")
+
+
+def migrateUUIDs():
+    '''
+    Convert UUID columns written as 36 character strings, before BinaryUUID,
+    to 16 byte binary. Rows already converted are left alone, so it can be
+    run again after an interrupted migration.
+    On SQLite only the values change, since any column can hold a BLOB; the
+    file shrinks after a VACUUM. On MySQL every column is changed to
+    BINARY(16), with foreign key checks off while the keys disagree.
+      Returns:
+        Number of values converted
+    '''
+    # Registers the picture tables
+    from qbay import images  # NOQA
+    columns = [(table.name, column) for table in db.metadata.sorted_tables
+               for column in table.columns
+               if isinstance(column.type, BinaryUUID)]
+    dialect = db.engine.dialect.name
+    converted = 0
+    with db.engine.begin() as conn:
+        if dialect == 'sqlite':
+            conn.connection.create_function(
+                'uuid_bytes', 1, lambda value: uuid.UUID(value).bytes,
+                deterministic=True)
+        elif dialect == 'mysql':
+            conn.execute(text("SET FOREIGN_KEY_CHECKS = 0"))
+        for table, column in columns:
+            name = column.name
+            if dialect == 'sqlite':
+                converted += conn.execute(text(
+                    f'UPDATE "{table}" SET "{name}" = uuid_bytes("{name}") '
+                    f'WHERE typeof("{name}") = \'text\'')).rowcount
+            elif dialect == 'mysql':
+                null = '' if column.nullable else ' NOT NULL'
+                conn.execute(text(f"ALTER TABLE `{table}` MODIFY `{name}` "
+                                  f"VARBINARY(36){null}"))
+                converted += conn.execute(text(
+                    f"UPDATE `{table}` SET `{name}` = "
+                    f"UNHEX(REPLACE(`{name}`, '-', '')) "
+                    f"WHERE LENGTH(`{name}`) = 36")).rowcount
+                conn.execute(text(f"ALTER TABLE `{table}` MODIFY `{name}` "
+                                  f"BINARY(16){null}"))
+            else:
+                raise ValueError(f"Can't migrate UUIDs on {dialect}")
+        if dialect == 'mysql':
+            conn.execute(text("SET FOREIGN_KEY_CHECKS = 1"))
+    return converted
+
+
+def fillNow(conn, column):
+    '''
+    Set a date column to now in every row that lacks it, see BACKFILL
+    '''
+    conn.execute(column.table.update().where(column.is_(None))
+                 .values({column: dt.datetime.now()}))
+
+
+# Functions filling NOT NULL columns added to existing tables by
+# migrateSchema, called with the connection and the column once it has been
+# added as nullable. qbay.images adds the picture columns'
+BACKFILL = {
+    # Purchases recorded before the ledger was dated
+    ('transaction', 'createdAt'): fillNow,
+}
+
+
+def migrateSchema():
+    '''
+    Bring tables created by older versions up to date with the models, by
+    adding the columns and indexes they lack and making columns nullable or
+    NOT NULL as the models declare. db.create_all only creates missing
+    tables, so existing ones never get them otherwise. Run once when
+    deploying a new version, after createSchema; it can be run again.
+    NOT NULL columns are added as nullable, filled from BACKFILL, then made
+    NOT NULL. SQLite can't change a column, so its tables are rebuilt
+    instead, see rebuildTable.
+      Returns:
+        List of the columns and indexes added or changed, as "table.name"
+    '''
+    # Registers the picture tables and their BACKFILL
+    from qbay import images  # NOQA
+    dialect = db.engine.dialect
+    quote = dialect.identifier_preparer.quote
+    changed = []
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        tables = set(inspector.get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = {c['name']: c for c in
+                        inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable \
+                        and (table.name, column.name) not in BACKFILL:
+                    raise ValueError(f"No value to fill {table.name}."
+                                     f"{column.name} with")
+                columnType = column.type.compile(dialect=dialect)
+                conn.execute(text(f'ALTER TABLE {quote(table.name)} '
+                                  f'ADD COLUMN {quote(column.name)} '
+                                  f'{columnType}'))
+                if not column.nullable:
+                    BACKFILL[(table.name, column.name)](conn, column)
+                existing[column.name] = {'nullable': True}
+                changed.append(f'{table.name}.{column.name}')
+
+            # Primary keys are NOT NULL whatever the database reports
+            mismatched = [column for column in table.columns
+                          if not column.primary_key and column.nullable
+                          != existing[column.name]['nullable']]
+            if mismatched and dialect.name == 'sqlite':
+                rebuildTable(conn, table)
+            for column in mismatched:
+                if dialect.name == 'mysql':
+                    null = 'NULL' if column.nullable else 'NOT NULL'
+                    conn.execute(text(
+                        f'ALTER TABLE {quote(table.name)} MODIFY '
+                        f'{quote(column.name)} '
+                        f'{column.type.compile(dialect=dialect)} {null}'))
+                name = f'{table.name}.{column.name}'
+                if name not in changed:
+                    changed.append(name)
+
+            # Rebuilt tables lose their indexes too
+            indexes = {i['name'] for i in
+                       inspect(conn).get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+                    changed.append(f'{table.name}.{index.name}')
+    return changed
+
+
+def rebuildTable(conn, table):
+    '''
+    Recreate a SQLite table as its model declares it, keeping its rows
+    SQLite's ALTER TABLE can't change a column, so the table is copied into
+    a new one that replaces it, as its documentation recommends. The old
+    table's indexes are dropped with it.
+      Parameters:
+        conn (Connection): connection in the migration's transaction
+        table (Table):     model table, whose rows all fit its columns
+    '''
+    quote = conn.dialect.identifier_preparer.quote
+    name = quote(table.name)
+    temporary = quote(f'_rebuild_{table.name}')
+    create = str(CreateTable(table).compile(dialect=conn.dialect))
+    conn.execute(text(create.replace(f'CREATE TABLE {name}',
+                                     f'CREATE TABLE {temporary}', 1)))
+    columns = ', '.join(quote(column.name) for column in table.columns)
+    conn.execute(text(f'INSERT INTO {temporary} ({columns}) '
+                      f'SELECT {columns} FROM {name}'))
+    conn.execute(text(f'DROP TABLE {name}'))
+    conn.execute(text(f'ALTER TABLE {temporary} RENAME TO {name}'))
+
+
+def createSchema():
+    '''
+    Create missing tables, the catalog version row and the full-text search
+    index
+    Run once when deploying, by `python -m qbay` or `flask --app
+    qbay.controllers create-schema`, not when qbay is imported
+    '''
+    # Registers the picture tables
+    from qbay import images  # NOQA
+    db.create_all()
+    if db.session.get(CatalogVersion, 1) is None:
+        db.session.add(CatalogVersion(id=1, version=uuid.uuid4().hex,
+                                      changedAt=dt.datetime.now()))
+        db.session.commit()
+    createSearchIndex()
+
+
+_replicaTurn = itertools.count()
+
+
+def replicaEngines():
+    '''
+    Get the engine of every read replica, in db_replicas order
+      Returns:
+        List of engines, empty without replicas
+    '''
+    binds = app.config['SQLALCHEMY_BINDS'] or {}
+    return [db.get_engine(bind=name) for name in sorted(binds)
+            if name.startswith('replica')]
+
+
+def chooseReplica():
+    '''
+    Get the engine of the next read replica, round-robin
+      Returns:
+        Engine, None to read from the primary: without replicas, after the
+        current session wrote, or within REPLICA_READ_AFTER_WRITE seconds
+        of the user's last write
+    '''
+    if db.session.info.get('wrote'):
+        return None
+    if flask.has_request_context() and time.time() \
+            - flask.session.get('wroteAt', 0) \
+            < app.config['REPLICA_READ_AFTER_WRITE']:
+        return None
+    engines = replicaEngines()
+    if not engines:
+        return None
+    return engines[next(_replicaTurn) % len(engines)]
+
+
+def replicaReads(function):
+    '''
+    Decorator for read-only backend functions, running their queries on a
+    read replica chosen by chooseReplica
+    Functions that write, or read what they are about to write, must not
+    use it: their reads stay on the primary, inside their transaction
+    '''
+    @functools.wraps(function)
+    def wrapped(*args, **kwargs):
+        replica = chooseReplica()
+        if replica is None:
+            return function(*args, **kwargs)
+        previous = db.session.info.get('replica')
+        db.session.info['replica'] = replica
+        try:
+            return function(*args, **kwargs)
+        finally:
+            db.session.info['replica'] = previous
+    return wrapped
+
+
+def _markWrite(session):
+    # Keep this session, and the user's next requests, on the primary
+    session.info['wrote'] = True
+    if flask.has_request_context():
+        flask.session['wroteAt'] = time.time()
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def flushed(session, context):
+    _markWrite(session)
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def executed(state):
+    if state.is_update or state.is_delete or state.is_insert:
+        _markWrite(state.session)
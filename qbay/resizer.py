@@ -0,0 +1,26 @@
+import resource
+import sys
+
+'''
+This file resizes an image in its own process
+
+qbay.images runs it as
+    python -m qbay.resizer SOURCE TARGET WIDTH HEIGHT MEMORY
+so ImageMagick can only exhaust the MEMORY bytes of address space given to
+this process, and can be killed when it takes too long.
+'''
+
+
+def main(source, target, width, height, memory):
+    # Limit the address space before ImageMagick is loaded
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    from wand.image import Image as WandImage
+    with WandImage(filename=source) as image:
+        image.resize(width, height)
+        # Thumbnails don't need the original's EXIF and colour profiles
+        image.strip()
+        image.save(filename=target)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2], *map(int, sys.argv[3:6]))
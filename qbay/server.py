@@ -0,0 +1,87 @@
+from qbay.backend import startSessionSweeper
+from qbay.models import db, replicaEngines
+from gunicorn.app.base import BaseApplication
+
+'''
+This file runs the app in production, on Gunicorn
+
+The app is imported and the schema created once in the master process,
+which then forks WORKERS processes serving THREADS requests each. Worker
+processes share nothing at run time: each has its own database pool,
+session cache, metrics and image and hashing pools.
+
+Send the master SIGHUP to replace the workers one at a time without
+dropping requests, for example after changing the environment, or SIGUSR2
+then SIGTERM to the old master to start a new one running new code.
+'''
+
+# Seconds a worker may take on a request before it is restarted
+REQUEST_TIMEOUT = 60
+# Seconds workers get to finish their requests on reload or shutdown
+GRACEFUL_TIMEOUT = 30
+
+
+class ProductionServer(BaseApplication):
+    """
+    Gunicorn server for an already loaded app
+    """
+
+    def __init__(self, app, options):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def afterFork(app, sweepInterval=None):
+    '''
+    Get a Gunicorn post_fork hook preparing a new worker process
+      Parameters:
+        app (Flask):            application
+        sweepInterval (float):  seconds between session sweeps in each
+                                worker, None for no sweeps
+      Returns:
+        Hook taking the Gunicorn arbiter and worker
+    '''
+    def postFork(server, worker):
+        with app.app_context():
+            # Connections opened by the master before forking, such as by
+            # createSchema, would be used by every worker at once. Drop them
+            # from this process's pool, leaving them open for the master
+            for engine in [db.engine] + replicaEngines():
+                engine.dispose(close=False)
+        if sweepInterval:
+            startSessionSweeper(app, sweepInterval)
+    return postFork
+
+
+def serveProduction(app, port, workers, threads, sweepInterval=None):
+    '''
+    Serve the app until the server is stopped
+      Parameters:
+        app (Flask):            application, with the schema created
+        port (int):             port to listen on, on every interface
+        workers (int):          worker processes
+        threads (int):          request threads per worker
+        sweepInterval (float):  seconds between session sweeps, None for
+                                no sweeps
+    '''
+    ProductionServer(app, {
+        'bind': f'0.0.0.0:{port}',
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread',
+        # Import once in the master, so workers start at once and share
+        # its memory until they write to it
+        'preload_app': True,
+        'timeout': REQUEST_TIMEOUT,
+        'graceful_timeout': GRACEFUL_TIMEOUT,
+        'post_fork': afterFork(app, sweepInterval),
+        'accesslog': '-',
+    }).run()
@@ -0,0 +1,168 @@
+from collections import deque
+import functools
+import re
+import sqlite3
+import threading
+
+'''
+This file defines the SQLite production profile (sqlite_profile=production)
+
+Every connection is opened in WAL mode, so reads never wait for writes and
+a write never waits for reads, with synchronous=NORMAL, a memory map and a
+larger page cache. pysqlite only opens a transaction before the first
+INSERT, UPDATE, DELETE or REPLACE, with BEGIN IMMEDIATE, so that statement
+takes the write lock at once rather than upgrading a read lock. Statements
+before it, such as the reads of a read-then-write, run outside any
+transaction and each see the latest commit, so a row read before the first
+write may have changed by the time it is written. Writes that depend on
+what was read must check it again, as the conditional UPDATEs of
+backend.purchaseProduct do.
+
+SQLite lets one transaction write at a time. Rather than have writing
+threads retry on SQLITE_BUSY with growing sleeps, which is unfair and wastes
+the time between retries, each process queues its write transactions and
+hands the write lock from one to the next in arrival order. Separate
+processes, such as Gunicorn workers, still wait for each other through
+busy_timeout.
+'''
+
+# Statements pysqlite starts a transaction for, the only ones that write
+# inside one. Schema changes and pragmas run outside of the queue
+WRITE_STATEMENT = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE)\b',
+                             re.IGNORECASE)
+
+
+class WriterQueue:
+    """
+    First come, first served lock held by the transaction that is writing
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiting = deque()
+        self._busy = False
+
+    def acquire(self, timeout):
+        '''
+        Wait for every transaction queued before this one to finish
+          Parameters:
+            timeout (float): seconds to wait
+          Returns:
+            True once it's this transaction's turn, False on timeout
+        '''
+        with self._lock:
+            if not self._busy:
+                self._busy = True
+                return True
+            turn = threading.Event()
+            self._waiting.append(turn)
+        if turn.wait(timeout):
+            return True
+        with self._lock:
+            if turn in self._waiting:
+                self._waiting.remove(turn)
+                return False
+        # The lock was handed over just as the wait timed out
+        return True
+
+    def release(self):
+        with self._lock:
+            if self._waiting:
+                self._waiting.popleft().set()
+            else:
+                self._busy = False
+
+
+writerQueue = WriterQueue()
+
+
+class QueuedCursor(sqlite3.Cursor):
+    """
+    Cursor that queues for the write lock before a transaction first writes
+    """
+
+    def execute(self, sql, parameters=()):
+        self.connection.queueWrite(sql)
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        self.connection.queueWrite(sql)
+        return super().executemany(sql, parameters)
+
+
+class QueuedConnection(sqlite3.Connection):
+    """
+    Connection applying the profile's pragmas, that holds writerQueue from
+    a transaction's first write until it commits or rolls back
+    """
+
+    def __init__(self, *args, pragmas=(), writeTimeout=5.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writing = False
+        self.writeTimeout = writeTimeout
+        for pragma in pragmas:
+            self.execute(pragma)
+
+    def cursor(self, factory=QueuedCursor):
+        return super().cursor(factory)
+
+    def queueWrite(self, sql):
+        if self.writing or not WRITE_STATEMENT.match(sql):
+            return
+        if not writerQueue.acquire(self.writeTimeout):
+            raise sqlite3.OperationalError('database is locked')
+        self.writing = True
+
+    def _finishWrite(self):
+        if self.writing and not self.in_transaction:
+            self.writing = False
+            writerQueue.release()
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self._finishWrite()
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self._finishWrite()
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self.writing:
+                self.writing = False
+                writerQueue.release()
+
+
+def connectArgs(config):
+    '''
+    Get the sqlite3.connect arguments for the SQLite profile in the config
+      Parameters:
+        config (dict): app config
+      Returns:
+        dict of arguments
+    '''
+    if config['SQLITE_PROFILE'] != 'production':
+        return {}
+    busyTimeout = config['SQLITE_BUSY_TIMEOUT']
+    pragmas = [
+        'PRAGMA journal_mode=WAL',
+        # Durable across crashes of the app, may lose the last commits if
+        # the machine loses power, and no fsync on every commit
+        'PRAGMA synchronous=NORMAL',
+        f'PRAGMA mmap_size={config["SQLITE_MMAP_SIZE"]}',
+        # Negative sizes are in KiB rather than pages
+        f'PRAGMA cache_size=-{config["SQLITE_CACHE_SIZE"] // 1024}',
+        f'PRAGMA busy_timeout={int(busyTimeout * 1000)}',
+    ]
+    return {
+        'factory': functools.partial(QueuedConnection, pragmas=pragmas,
+                                     writeTimeout=busyTimeout),
+        'isolation_level': 'IMMEDIATE',
+        'timeout': busyTimeout,
+    }
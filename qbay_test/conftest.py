@@ -4,7 +4,7 @@ import time
 import tempfile # NOQA, imported in template code
 import threading
 from werkzeug.serving import make_server
-from qbay import app
+from qbay import app, createApp
 '''
 This file defines what to do BEFORE running any test cases:
 '''
@@ -15,9 +15,13 @@ def pytest_sessionstart():
     Delete database file if existed. So testing can start fresh.
     '''
     print('Setting up environment..')
-    db_file = 'db.sqlite'
-    if os.path.exists(db_file):
-        os.remove(db_file)
+    # Along with the write-ahead log of sqlite_profile=production
+    for db_file in ['db.sqlite', 'db.sqlite-wal', 'db.sqlite-shm']:
+        if os.path.exists(db_file):
+            os.remove(db_file)
+    from qbay.models import createSchema
+    with app.app_context():
+        createSchema()
 
 
 def pytest_sessionfinish():
@@ -35,9 +39,7 @@ class ServerThread(threading.Thread):
 
     def __init__(self):
         threading.Thread.__init__(self)
-        # import necessary routes
-        from qbay import controllers # NOQA, imported in template code
-        self.srv = make_server('127.0.0.1', 8081, app)
+        self.srv = make_server('127.0.0.1', 8081, createApp())
         self.ctx = app.app_context()
         self.ctx.push()
 
@@ -1,10 +1,26 @@
-from qbay.models import db, User, Product, Session
+from qbay import app
+from qbay.cache import loginFailures, catalogVersions
+from qbay.models import db, User, Product, Session, Transaction, \
+    migrateUUIDs, migrateSchema, engineOptions, replicaEngines
+from qbay.sqlite import WriterQueue
 from qbay.backend import purchaseProduct, updateProduct, register, \
-    queryUser, createProduct, login, updateUser
+    queryUser, createProduct, login, updateUser, listProducts, \
+    getSessionUser, sweepSessions, purchaseHistory, salesHistory, \
+    searchProducts, userProducts, catalogVersion
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
 import datetime as dt
+import flask
 import hashlib
+import os
 import pytest
-from uuid import uuid4
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from uuid import uuid4, UUID
 
 
 @pytest.mark.parametrize("username, email, password, expected", [
@@ -676,3 +692,581 @@ def test_placing_order():
     assert prod.buyer == user
     assert origOwnerBalance + prod.price == prod.user.balance
     assert origBuyerBalance - prod.price == user.balance
+
+
+def test_list_products_pagination():
+    '''
+    Test that paging through the product listing returns every unsold product
+    from other users exactly once, newest first
+    '''
+    register('Lister', 'lister@test.com', 'Password1!')
+    register('Seller', 'seller@test.com', 'Password1!')
+    for i in range(5):
+        createProduct(productName=f'Paged {i}',
+                      description='This is a test description',
+                      price=10.0,
+                      last_modified_date=dt.datetime(2021, 10, 8 + i),
+                      owner_email='seller@test.com')
+    user = User.query.filter_by(email='lister@test.com').first()
+
+    # Walk every page
+    seen = []
+    products, cursor = listProducts(user.id, limit=2)
+    seen += products
+    while cursor is not None:
+        assert len(products) == 2
+        products, cursor = listProducts(user.id, cursor, limit=2)
+        seen += products
+
+    ids = [p.id for p in seen]
+    expected = Product.query.filter(Product.userId != user.id,
+                                    Product.sold.is_(False)).all()
+    assert len(ids) == len(set(ids))
+    assert set(ids) == {p.id for p in expected}
+    keys = [(p.lastModifiedDate, p.id) for p in seen]
+    assert keys == sorted(keys, reverse=True)
+
+    # Malformed cursors restart from the first page
+    assert listProducts(user.id, 'garbage', 2)[0] == seen[:2]
+
+
+def test_session_expiry_and_sweep():
+    '''
+    Test that expired sessions do not resolve to a user, and that the
+    sweeper deletes them in batches while keeping valid sessions
+    '''
+    register('Sweeper', 'sweeper@test.com', 'Password1!')
+    valid = login('sweeper@test.com', 'Password1!', '127.0.0.1')
+    expired = []
+    for _ in range(5):
+        s = login('sweeper@test.com', 'Password1!', '127.0.0.1')
+        s.expiry = dt.datetime.now() - dt.timedelta(days=1)
+        expired.append(s.sessionId)
+    db.session.commit()
+
+    user, _ = getSessionUser(valid.sessionId, '127.0.0.1')
+    assert user.email == 'sweeper@test.com'
+    assert getSessionUser(valid.sessionId, '1.1.1.1') is None
+    assert getSessionUser(expired[0], '127.0.0.1') is None
+
+    assert sweepSessions(batchSize=2) >= 5
+    assert Session.query.filter(Session.sessionId.in_(expired)).count() == 0
+    assert Session.query.filter_by(sessionId=valid.sessionId).count() == 1
+
+
+def test_login_failure_cache():
+    '''
+    Test that an email is short-circuited after repeated failed logins, and
+    that the failures are forgotten once the entry is dropped
+    '''
+    register('Stuffed', 'stuffed@test.com', 'Password1!')
+    for _ in range(app.config['LOGIN_FAILURE_LIMIT']):
+        assert login('stuffed@test.com', 'Wr0ngPass!', '127.0.0.1') is None
+    assert loginFailures.get('stuffed@test.com') == \
+        app.config['LOGIN_FAILURE_LIMIT']
+
+    # Even the right password is rejected while the email is blocked
+    assert login('stuffed@test.com', 'Password1!', '127.0.0.1') is None
+
+    loginFailures.invalidate('stuffed@test.com')
+    assert login('stuffed@test.com', 'Password1!', '127.0.0.1') is not None
+    # A successful login clears earlier failures
+    assert login('stuffed@test.com', 'Wr0ngPass!', '127.0.0.1') is None
+    assert login('stuffed@test.com', 'Password1!', '127.0.0.1') is not None
+    assert loginFailures.get('stuffed@test.com') is None
+
+
+def test_register_clears_login_failures():
+    '''
+    Test that failed logins at an email before it is registered don't block
+    the new user from logging in
+    '''
+    for _ in range(app.config['LOGIN_FAILURE_LIMIT']):
+        assert login('unclaimed@test.com', 'Password1!', '127.0.0.1') is None
+    assert register('Unclaimed', 'unclaimed@test.com', 'Password1!')
+    assert loginFailures.get('unclaimed@test.com') is None
+    assert login('unclaimed@test.com', 'Password1!', '127.0.0.1') is not None
+
+
+def test_concurrent_purchases():
+    '''
+    Fire thousands of simultaneous purchases between a group of users, and
+    check that no product is sold twice, no balance goes negative, and no
+    money is created or lost
+    '''
+    users = []
+    for i in range(10):
+        user = User(id=str(uuid4()), username=f'Stress {i}',
+                    email=f'stress{i}@test.com', password='', balance=100,
+                    shippingAddress='', postalCode='')
+        db.session.add(user)
+        users.append(user.id)
+    products = []
+    for i in range(200):
+        product = Product(id=str(uuid4()), productName=f'Stress {i}',
+                          userId=users[i % 10],
+                          ownerEmail=f'stress{i % 10}@test.com',
+                          price=10 + (i % 5) * 10,
+                          description='Product for the stress test',
+                          lastModifiedDate=dt.datetime(2021, 10, 8))
+        db.session.add(product)
+        products.append(product.id)
+    db.session.commit()
+
+    succeeded = []
+    lock = threading.Lock()
+
+    def buy(seed):
+        rand = random.Random(seed)
+        with app.app_context():
+            for _ in range(150):
+                try:
+                    purchaseProduct(rand.choice(users), rand.choice(products))
+                    with lock:
+                        succeeded.append(1)
+                except (ValueError, OperationalError):
+                    pass
+            db.session.remove()
+
+    threads = [threading.Thread(target=buy, args=(i,)) for i in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    db.session.expire_all()
+    sold = Product.query.filter(Product.id.in_(products),
+                                Product.sold.is_(True)).all()
+    balances = [u.balance for u in
+                User.query.filter(User.id.in_(users)).all()]
+    assert len(sold) == len(succeeded)
+    # Every sale has exactly one ledger entry
+    assert Transaction.query.filter(Transaction.productId.in_(products))\
+                            .count() == len(sold)
+    assert all(p.buyerId is not None and p.buyerId != p.userId for p in sold)
+    assert min(balances) >= 0
+    assert sum(balances) == 100 * len(users)
+
+
+def test_purchase_history():
+    '''
+    Test that purchases are recorded in the ledger, and that purchase and
+    sales history page through them newest first
+    '''
+    register('Ledger Buyer', 'ledgerBuyer@test.com', 'Password1!')
+    register('Ledger Seller', 'ledgerSeller@test.com', 'Password1!')
+    buyer = User.query.filter_by(email='ledgerBuyer@test.com').first()
+    seller = User.query.filter_by(email='ledgerSeller@test.com').first()
+    for i in range(5):
+        createProduct(productName=f'Ledger {i}',
+                      description='This is a test description',
+                      price=10.0,
+                      last_modified_date=dt.datetime(2021, 10, 8),
+                      owner_email='ledgerSeller@test.com')
+        product = Product.query.filter_by(productName=f'Ledger {i}').first()
+        purchaseProduct(buyer.id, product.id)
+
+    bought = []
+    page, cursor = purchaseHistory(buyer.id, limit=2)
+    bought += page
+    while cursor is not None:
+        page, cursor = purchaseHistory(buyer.id, cursor, limit=2)
+        bought += page
+    assert [t.product.productName for t in bought] == \
+        [f'Ledger {i}' for i in reversed(range(5))]
+    assert all(t.merchantId == seller.id and t.netAmount == 10.0
+               for t in bought)
+
+    sales, cursor = salesHistory(seller.id)
+    assert cursor is None
+    assert {t.paymentId for t in sales} == {t.paymentId for t in bought}
+    assert salesHistory(buyer.id)[0] == []
+
+
+def test_catalog_version():
+    '''
+    Test that every change to listed products gives the catalog a new
+    version, which other processes read from the catalog version row
+    '''
+    register('Version Seller', 'versionSeller@test.com', 'Password1!')
+    register('Version Buyer', 'versionBuyer@test.com', 'Password1!')
+    seller = User.query.filter_by(email='versionSeller@test.com').first()
+    buyer = User.query.filter_by(email='versionBuyer@test.com').first()
+    versions = [catalogVersion()]
+    createProduct(productName='Version Clock',
+                  description='This is a test description',
+                  price=10.0,
+                  last_modified_date=dt.datetime(2021, 10, 8),
+                  owner_email='versionSeller@test.com')
+    versions.append(catalogVersion())
+    product = Product.query.filter_by(productName='Version Clock').first()
+    updateUser(seller.id, username='Version Vendor')
+    versions.append(catalogVersion())
+    purchaseProduct(buyer.id, product.id)
+    versions.append(catalogVersion())
+    assert len({version for version, _ in versions}) == len(versions)
+    # Changes that listings don't show keep the version
+    updateUser(seller.id, shippingAddress='123 Version Street')
+    assert catalogVersion() == versions[-1]
+
+    # A process without a cached copy reads the row, then caches it
+    catalogVersions.clear()
+    assert catalogVersion() == versions[-1]
+    hits = catalogVersions.hits
+    assert catalogVersion() == versions[-1]
+    assert catalogVersions.hits == hits + 1
+
+
+def test_search_products():
+    '''
+    Test that search ranks name matches first, follows product updates and
+    excludes sold products
+    '''
+    register('Searcher', 'searcher@test.com', 'Password1!')
+    register('Search Seller', 'searchSeller@test.com', 'Password1!')
+    products = {
+        'Zebra Lamp': 'A lamp with a striped quokka shade',
+        'Quokka Mug': 'A mug for coffee, tea or anything else',
+        'Plain Chair': 'An ordinary wooden chair for sitting',
+    }
+    for name, description in products.items():
+        createProduct(productName=name, description=description, price=10.0,
+                      last_modified_date=dt.datetime(2021, 10, 8),
+                      owner_email='searchSeller@test.com')
+
+    results, nextOffset = searchProducts('quokka')
+    assert [p.productName for p in results] == ['Quokka Mug', 'Zebra Lamp']
+    assert nextOffset is None
+    # Every word has to match, and input is never parsed as a query
+    assert [p.productName for p in searchProducts('quokka mug')[0]] == \
+        ['Quokka Mug']
+    assert searchProducts('"quokka" OR NOT') == ([], None)
+    assert searchProducts('  ') == ([], None)
+
+    # Paging
+    page, nextOffset = searchProducts('quokka', limit=1)
+    assert [p.productName for p in page] == ['Quokka Mug']
+    assert searchProducts('quokka', 1, nextOffset)[0] == [results[1]]
+
+    # Updates are searchable
+    chair = Product.query.filter_by(productName='Plain Chair').first()
+    chair.description = 'An ordinary quokka shaped chair'
+    db.session.commit()
+    names = [p.productName for p in searchProducts('quokka')[0]]
+    assert 'Plain Chair' in names
+
+    # Sold products are excluded
+    buyer = User.query.filter_by(email='searcher@test.com').first()
+    mug = Product.query.filter_by(productName='Quokka Mug').first()
+    purchaseProduct(buyer.id, mug.id)
+    assert 'Quokka Mug' not in \
+        [p.productName for p in searchProducts('quokka')[0]]
+
+
+def test_binary_uuids():
+    '''
+    Test that IDs are stored as 16 bytes but read as strings, and that
+    migrateUUIDs converts IDs stored as text by older versions
+    '''
+    register('Binary Id', 'binaryId@test.com', 'Password1!')
+    user = User.query.filter_by(email='binaryId@test.com').one()
+    userId = user.id
+    raw = text('SELECT id FROM user WHERE email = :email')
+    params = {'email': 'binaryId@test.com'}
+    assert db.session.execute(raw, params).scalar() == UUID(userId).bytes
+    assert db.session.get(User, userId.upper()) is user
+    assert db.session.get(User, 'not an id') is None
+
+    db.session.execute(text('UPDATE user SET id = :id WHERE email = :email'),
+                       {'id': userId, **params})
+    db.session.commit()
+    assert migrateUUIDs() == 1
+    assert db.session.execute(raw, params).scalar() == UUID(userId).bytes
+    assert migrateUUIDs() == 0
+    db.session.expire_all()
+    assert db.session.get(User, userId).email == 'binaryId@test.com'
+
+
+def test_migrate_schema():
+    '''
+    Test that migrateSchema gives tables created by older versions the
+    columns and indexes added since, and that purchases then work
+    '''
+    for index in ['ix_transaction_customer', 'ix_transaction_merchant',
+                  'ix_session_expiry']:
+        db.session.execute(text(f'DROP INDEX {index}'))
+    db.session.execute(text('ALTER TABLE "transaction" DROP COLUMN createdAt'))
+    db.session.commit()
+
+    assert sorted(migrateSchema()) == [
+        'session.ix_session_expiry', 'transaction.createdAt',
+        'transaction.ix_transaction_customer',
+        'transaction.ix_transaction_merchant']
+    assert migrateSchema() == []
+    assert db.session.execute(text(
+        'SELECT count(*) FROM "transaction" WHERE createdAt IS NULL'))\
+        .scalar() == 0
+
+    register('Migrated Buyer', 'migratedBuyer@test.com', 'Password1!')
+    register('Migrated Seller', 'migratedSeller@test.com', 'Password1!')
+    createProduct(productName='Migrated Lamp',
+                  description='This is a test description',
+                  price=10.0,
+                  last_modified_date=dt.datetime(2021, 10, 8),
+                  owner_email='migratedSeller@test.com')
+    buyer = User.query.filter_by(email='migratedBuyer@test.com').one()
+    product = Product.query.filter_by(productName='Migrated Lamp').one()
+    assert purchaseProduct(buyer.id, product.id)
+    assert [t.productId for t in purchaseHistory(buyer.id)[0]] \
+        == [product.id]
+
+
+# Tables as created by the first version of qbay, with one user's purchase
+BASELINE_SCHEMA = """
+CREATE TABLE user (
+    id VARCHAR(36) NOT NULL, username VARCHAR(64) NOT NULL,
+    email VARCHAR(120) NOT NULL, password VARCHAR(165) NOT NULL,
+    balance FLOAT NOT NULL, "shippingAddress" VARCHAR(64),
+    "postalCode" VARCHAR(36),
+    PRIMARY KEY (id), UNIQUE (username), UNIQUE (email));
+CREATE TABLE product (
+    id VARCHAR(36) NOT NULL, "productName" VARCHAR(80) NOT NULL,
+    "userId" VARCHAR(36) NOT NULL, "ownerEmail" VARCHAR(120) NOT NULL,
+    price FLOAT NOT NULL, description VARCHAR(2000) NOT NULL,
+    "lastModifiedDate" DATETIME NOT NULL, sold BOOLEAN NOT NULL,
+    "buyerId" VARCHAR(36),
+    PRIMARY KEY (id), FOREIGN KEY("userId") REFERENCES user (id),
+    FOREIGN KEY("buyerId") REFERENCES user (id));
+CREATE TABLE session (
+    "sessionId" VARCHAR(36) NOT NULL, "userId" VARCHAR(36) NOT NULL,
+    expiry DATETIME, "ipAddress" VARCHAR(15), "csrfToken" VARCHAR(32),
+    PRIMARY KEY ("sessionId"), FOREIGN KEY("userId") REFERENCES user (id));
+CREATE TABLE product_picture (
+    width INTEGER NOT NULL, height INTEGER NOT NULL,
+    mimetype VARCHAR(255) NOT NULL, original BOOLEAN NOT NULL,
+    created_at DATETIME NOT NULL, "productId" VARCHAR(36) NOT NULL,
+    PRIMARY KEY (width, height, "productId"),
+    FOREIGN KEY("productId") REFERENCES product (id));
+CREATE TABLE "transaction" (
+    "paymentId" VARCHAR(36) NOT NULL, "customerId" VARCHAR(36) NOT NULL,
+    "merchantId" VARCHAR(36) NOT NULL, "productId" VARCHAR(36) NOT NULL,
+    "netAmount" FLOAT NOT NULL, "cardId" BIGINT NOT NULL,
+    cvv INTEGER NOT NULL, "expiryDate" DATE NOT NULL,
+    "billAddress" VARCHAR(128) NOT NULL,
+    PRIMARY KEY ("paymentId"),
+    FOREIGN KEY("customerId") REFERENCES user (id),
+    FOREIGN KEY("merchantId") REFERENCES user (id),
+    FOREIGN KEY("productId") REFERENCES product (id), UNIQUE ("cardId"));
+CREATE TABLE review (
+    id VARCHAR(36) NOT NULL, "productId" VARCHAR(36) NOT NULL,
+    "userId" VARCHAR(36) NOT NULL, rating INTEGER NOT NULL,
+    content VARCHAR(32767) NOT NULL, datetime DATETIME NOT NULL,
+    PRIMARY KEY (id), UNIQUE (id),
+    FOREIGN KEY("productId") REFERENCES product (id),
+    FOREIGN KEY("userId") REFERENCES user (id));
+INSERT INTO user VALUES ('00000000-0000-4000-8000-000000000001', 'Old Buyer',
+    'oldBuyer@test.com', 'x', 100, '', '');
+INSERT INTO user VALUES ('00000000-0000-4000-8000-000000000002',
+    'Old Seller', 'oldSeller@test.com', 'x', 100, '', '');
+INSERT INTO product VALUES ('00000000-0000-4000-8000-000000000003',
+    'Old Lamp', '00000000-0000-4000-8000-000000000002', 'oldSeller@test.com',
+    10, 'This is a test description', '2021-10-08 00:00:00', 1,
+    '00000000-0000-4000-8000-000000000001');
+INSERT INTO product_picture VALUES (100, 100, 'image/png', 1,
+    '2021-10-08 00:00:00', '00000000-0000-4000-8000-000000000003');
+INSERT INTO "transaction" VALUES ('00000000-0000-4000-8000-000000000004',
+    '00000000-0000-4000-8000-000000000001',
+    '00000000-0000-4000-8000-000000000002',
+    '00000000-0000-4000-8000-000000000003', 10, 4111111111111111, 123,
+    '2030-01-01', '1 Old Street');
+"""
+
+
+def test_migrate_baseline_schema(tmp_path):
+    '''
+    Test that a database created by the first version is upgraded by
+    create-schema, migrate-schema and migrate-uuids, keeping its rows, and
+    that balance purchases can then be recorded
+    '''
+    database = tmp_path / 'baseline.sqlite'
+    with sqlite3.connect(database) as conn:
+        conn.executescript(BASELINE_SCHEMA)
+    code = """
+from qbay import app
+from qbay.models import createSchema, migrateSchema, migrateUUIDs, User, \\
+    Product
+from qbay.backend import register, createProduct, purchaseProduct, \\
+    purchaseHistory
+import datetime as dt
+with app.app_context():
+    createSchema()
+    migrateSchema()
+    migrateUUIDs()
+    assert migrateSchema() == []
+    register('New Buyer', 'newBuyer@test.com', 'Password1!')
+    buyer = User.query.filter_by(email='newBuyer@test.com').one()
+    for name in ['New Lamp', 'New Desk']:
+        createProduct(productName=name,
+                      description='This is a test description', price=10.0,
+                      last_modified_date=dt.datetime(2021, 10, 8),
+                      owner_email='oldSeller@test.com')
+        product = Product.query.filter_by(productName=name).one()
+        purchaseProduct(buyer.id, product.id)
+    print(len(purchaseHistory(buyer.id)[0]))
+"""
+    env = dict(os.environ, db_string=f'sqlite:///{database}')
+    result = subprocess.run([sys.executable, '-c', code], env=env,
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().splitlines()[-1] == '2'
+
+    with sqlite3.connect(database) as conn:
+        # Two balance purchases without card details, beside the card one
+        assert conn.execute('SELECT count(*), count("cardId"), '
+                            'count("createdAt") FROM "transaction"')\
+            .fetchone() == (3, 1, 3)
+        columns = {row[1]: row[3] for row in
+                   conn.execute('PRAGMA table_info("transaction")')}
+        assert columns['createdAt'] == 1 and columns['cardId'] == 0
+        # The old picture had no stored file
+        assert conn.execute('SELECT count(*) FROM product_picture')\
+            .fetchone() == (0,)
+
+
+def test_import_side_effects(tmp_path):
+    '''
+    Test that importing the backend neither connects to the database nor
+    loads the image libraries
+    '''
+    database = tmp_path / 'import.sqlite'
+    env = dict(os.environ, db_string=f'sqlite:///{database}')
+    code = ('import sys, qbay.backend; '
+            'print(sorted(m for m in sys.modules if m.split(".")[0] in '
+            '("wand", "sqlalchemy_imageattach", "qbay")))')
+    result = subprocess.run([sys.executable, '-c', code], env=env,
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == str(['qbay', 'qbay.backend', 'qbay.cache',
+                                         'qbay.hashing', 'qbay.models',
+                                         'qbay.sqlite'])
+    assert not database.exists()
+
+
+def test_sqlite_profile(tmp_path):
+    '''
+    Test that the production SQLite profile sets its pragmas, and that
+    concurrent read-then-write transactions queue instead of failing
+    '''
+    config = dict(app.config, SQLITE_PROFILE='production',
+                  SQLALCHEMY_DATABASE_URI=f'sqlite:///{tmp_path}/p.sqlite')
+    engine = create_engine(config['SQLALCHEMY_DATABASE_URI'],
+                           **engineOptions(config))
+    with engine.begin() as conn:
+        assert conn.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert conn.execute(text('PRAGMA synchronous')).scalar() == 1
+        conn.execute(text('CREATE TABLE counter (n INTEGER)'))
+        conn.execute(text('INSERT INTO counter VALUES (0)'))
+
+    errors = []
+
+    def increment():
+        for _ in range(50):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text('SELECT n FROM counter')).scalar()
+                    conn.execute(text('UPDATE counter SET n = n + 1'))
+            except Exception as err:
+                errors.append(err)
+
+    threads = [threading.Thread(target=increment) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    with engine.connect() as conn:
+        assert conn.execute(text('SELECT n FROM counter')).scalar() == 400
+    engine.dispose()
+
+
+def test_writer_queue():
+    '''
+    Test that the write lock is handed over in arrival order, and that
+    waiting for it can time out
+    '''
+    queue = WriterQueue()
+    assert queue.acquire(1)
+    assert not queue.acquire(0.01)
+    order = []
+
+    def write(i):
+        queue.acquire(5)
+        order.append(i)
+        queue.release()
+
+    threads = []
+    for i in range(5):
+        threads.append(threading.Thread(target=write, args=(i,)))
+        threads[-1].start()
+        # Each thread is waiting before the next one starts
+        while len(queue._waiting) <= i:
+            time.sleep(0.001)
+    queue.release()
+    for thread in threads:
+        thread.join()
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_read_replicas(tmp_path, monkeypatch):
+    '''
+    Test that read-only functions query the replicas in turn, and that
+    reads after a write go to the primary
+    '''
+    register('Replica Seller', 'replicaSeller@test.com', 'Password1!')
+    sellerId = User.query.filter_by(email='replicaSeller@test.com').one().id
+    db.session.remove()
+    binds = {f'replica{i}': f'sqlite:///{tmp_path}/replica{i}.sqlite'
+             for i in range(2)}
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_BINDS', binds)
+    engines = replicaEngines()
+    # Each replica has a product of its own, the primary has neither
+    for i, engine in enumerate(engines):
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(Product.__table__.insert().values(
+                id=uuid4(), productName=f'Replica {i}', userId=sellerId,
+                ownerEmail='replicaSeller@test.com', price=10.0,
+                description='Only on a replica', sold=False,
+                lastModifiedDate=dt.datetime(2021, 10, 8)))
+
+    def names():
+        return [p.productName for p in userProducts(sellerId)[0]]
+
+    assert [names() for _ in range(4)] in (
+        [['Replica 0'], ['Replica 1']] * 2,
+        [['Replica 1'], ['Replica 0']] * 2)
+    # Request metrics count the statements run on replicas
+    with app.test_request_context():
+        flask.g.metricsStatements = 0
+        names()
+        assert flask.g.metricsStatements == 1
+
+    # Once the session writes, its reads stay on the primary
+    assert createProduct(productName='Primary Lamp',
+                         description='This is a test description',
+                         price=10.0,
+                         last_modified_date=dt.datetime(2021, 10, 8),
+                         owner_email='replicaSeller@test.com')
+    assert names() == ['Primary Lamp']
+    db.session.remove()
+    assert names() != ['Primary Lamp']
+
+    # So do the user's next requests, for REPLICA_READ_AFTER_WRITE seconds
+    with app.test_request_context():
+        flask.session['wroteAt'] = time.time()
+        assert names() == ['Primary Lamp']
+        flask.session['wroteAt'] = time.time() \
+            - app.config['REPLICA_READ_AFTER_WRITE']
+        assert names() != ['Primary Lamp']
+    db.session.remove()
+    for engine in engines:
+        engine.dispose()
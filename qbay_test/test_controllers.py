@@ -0,0 +1,447 @@
+from qbay import app
+from qbay.models import db, User, Product
+from qbay.backend import register, createProduct, login, updateUser, \
+    purchaseProduct, catalogVersion
+from qbay.cache import sessionCache, catalogFragments
+from qbay.compression import CompressionMiddleware, installCompression
+from qbay.metrics import Histogram, timedMacro
+from qbay.server import afterFork
+from flask import template_rendered, g
+from werkzeug.test import create_environ
+from sqlalchemy import event, text
+import datetime as dt
+import gzip
+import pytest
+import time
+import zlib
+
+
+class StatementCounter:
+    '''
+    Count the SQL statements executed on the database engine
+    '''
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(db.engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(db.engine, 'before_cursor_execute', self)
+
+
+def loggedInClient(email):
+    '''
+    Create a test client with a session for the given user
+    '''
+    client = app.test_client()
+    s = login(email, 'Password1!', '127.0.0.1')
+    client.get(f'/_test/{s.sessionId}')
+    return client
+
+
+@pytest.mark.parametrize('count', [1, 10])
+def test_home_statement_count(count):
+    '''
+    Test that the home page runs the same number of SQL statements no matter
+    how many products are shown
+    '''
+    register('Counter', 'counter@test.com', 'Password1!')
+    for i in range(count):
+        email = f'countSeller{count}x{i}@test.com'
+        register(f'Count Seller {count} {i}', email, 'Password1!')
+        createProduct(productName=f'Counted {count} {i}',
+                      description='This is a test description',
+                      price=10.0,
+                      last_modified_date=dt.datetime(2021, 10, 8),
+                      owner_email=email)
+    client = loggedInClient('counter@test.com')
+
+    with StatementCounter() as counter:
+        response = client.get('/')
+    assert response.status_code == 200
+    # Session lookup, then listing and own products
+    assert counter.count <= 3
+
+
+@pytest.mark.parametrize('count', [1, 10])
+def test_search_statement_count(count):
+    '''
+    Test that the search page runs the same number of SQL statements no
+    matter how many products it finds
+    '''
+    register('Search Counter', 'searchCounter@test.com', 'Password1!')
+    for i in range(count):
+        email = f'searchSeller{count}x{i}@test.com'
+        register(f'Search Seller {count} {i}', email, 'Password1!')
+        createProduct(productName=f'Wombat {count} {i}',
+                      description='This is a test description',
+                      price=10.0,
+                      last_modified_date=dt.datetime(2021, 10, 8),
+                      owner_email=email)
+    client = loggedInClient('searchCounter@test.com')
+
+    with StatementCounter() as counter:
+        response = client.get(f'/search?q=wombat+{count}')
+    assert response.status_code == 200
+    assert response.data.count(b'Search Seller') == count
+    # Session lookup, search table check, then products and their sellers
+    assert counter.count <= 4
+
+
+def test_session_cache():
+    '''
+    Test that repeat requests authenticate from the session cache, and that
+    changing the user invalidates the cached copy
+    '''
+    register('Cached', 'cached@test.com', 'Password1!')
+    user = User.query.filter_by(email='cached@test.com').first()
+    client = loggedInClient('cached@test.com')
+    # Both requests use the cached catalog version
+    catalogVersion()
+
+    # First request populates the cache
+    with StatementCounter() as miss:
+        client.get('/')
+    hits = sessionCache.hits
+    # Render the listing again, so only the session lookup is saved
+    catalogFragments.bump()
+    with StatementCounter() as hit:
+        response = client.get('/')
+    assert response.status_code == 200
+    assert sessionCache.hits == hits + 1
+    # Session lookup is skipped on a hit
+    assert hit.count == miss.count - 1
+
+    # Updating the user drops the cached session
+    updateUser(user.id, shippingAddress='123 Cache Street')
+    misses = sessionCache.misses
+    response = client.get('/')
+    assert sessionCache.misses == misses + 1
+    assert b'123 Cache Street' in response.data
+
+    # Logging out drops the cached session
+    client.get('/user/logout')
+    assert client.get('/').status_code == 302
+
+
+def test_listing_fragment_cache():
+    '''
+    Test that the home page's listing is rendered once per catalog change
+    for every user, and that Buy buttons still follow the user's balance
+    '''
+    register('Fragment Viewer', 'fragmentViewer@test.com', 'Password1!')
+    register('Fragment Seller', 'fragmentSeller@test.com', 'Password1!')
+    createProduct(productName='Fragment Vase',
+                  description='This is a test description',
+                  price=50.0,
+                  last_modified_date=dt.datetime(2021, 10, 8),
+                  owner_email='fragmentSeller@test.com')
+    client = loggedInClient('fragmentViewer@test.com')
+    first = client.get('/').data
+    assert b'Fragment Vase' in first
+    assert b'class="buy-btn"' in first
+
+    # The listing query and render are skipped until the catalog changes
+    with StatementCounter() as counter:
+        assert client.get('/').data == first
+    assert counter.count == 1
+    createProduct(productName='Fragment Lamp',
+                  description='This is a test description',
+                  price=60.0,
+                  last_modified_date=dt.datetime(2021, 10, 9),
+                  owner_email='fragmentSeller@test.com')
+    assert b'Fragment Lamp' in client.get('/').data
+
+    # Other users get the same rows, without their own products
+    hits = catalogFragments.hits
+    page = loggedInClient('fragmentSeller@test.com').get('/').data
+    assert catalogFragments.hits == hits + 1
+    available, own = page.split(b'id="ownProducts"')
+    assert b'Fragment Lamp' not in available and b'Fragment Lamp' in own
+
+    # A balance change alone picks the other button from the cached rows
+    viewer = User.query.filter_by(email='fragmentViewer@test.com').one()
+    User.query.filter_by(id=viewer.id).update({User.balance: 0})
+    db.session.commit()
+    sessionCache.invalidateUser(viewer.id)
+    generation = catalogFragments.generation
+    page = client.get('/').data
+    assert catalogFragments.generation == generation
+    assert b'class="buy-btn"' not in page
+    assert b'id="Fragment Vase"' in page
+
+
+def test_conditional_get():
+    '''
+    Test that pages the client has are answered with 304 without rendering
+    templates, until what they show changes
+    '''
+    register('Conditional', 'conditional@test.com', 'Password1!')
+    register('Conditional Seller', 'conditionalSeller@test.com',
+             'Password1!')
+    createProduct(productName='Conditional Kettle',
+                  description='This is a test description',
+                  price=10.0,
+                  last_modified_date=dt.datetime(2021, 10, 8),
+                  owner_email='conditionalSeller@test.com')
+    client = loggedInClient('conditional@test.com')
+    seller = loggedInClient('conditionalSeller@test.com')
+    rendered = []
+
+    def record(sender, template, context, **extra):
+        rendered.append(template.name)
+
+    response = client.get('/')
+    etag = response.headers['ETag']
+    assert etag.startswith('W/')
+    assert response.cache_control.private and response.cache_control.no_cache
+    with template_rendered.connected_to(record, app):
+        response = client.get('/', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        assert response.data == b''
+        update = seller.get('/product/update/Conditional Kettle')
+        assert seller.get('/product/update/Conditional Kettle',
+                          headers={'If-None-Match': update.headers['ETag']})\
+            .status_code == 304
+    assert rendered == ['product/update.html']
+
+    # Selling the product changes both pages
+    buyer = User.query.filter_by(email='conditional@test.com').one()
+    product = Product.query.filter_by(productName='Conditional Kettle').one()
+    purchaseProduct(buyer.id, product.id)
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert seller.get('/product/update/Conditional Kettle',
+                      headers={'If-None-Match': update.headers['ETag']})\
+        .status_code == 200
+
+    # Last-Modified is sent once its second is over
+    time.sleep(1)
+    lastModified = client.get('/').headers['Last-Modified']
+    with template_rendered.connected_to(record, app):
+        rendered.clear()
+        assert client.get('/', headers={'If-Modified-Since': lastModified})\
+            .status_code == 304
+    assert rendered == []
+
+
+def test_compression():
+    '''
+    Test that pages are compressed with the encoding the client accepts,
+    and that small responses are not
+    '''
+    installCompression(app)
+    register('Compressed', 'compressed@test.com', 'Password1!')
+    client = loggedInClient('compressed@test.com')
+    page = client.get('/').data
+    assert len(page) > app.config['COMPRESSION_MIN_SIZE']
+
+    response = client.get('/', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert 'Content-Length' not in response.headers
+    assert len(response.data) < len(page)
+    assert gzip.decompress(response.data) == page
+    response = client.get('/', headers={'Accept-Encoding':
+                                        'gzip;q=0.5, deflate'})
+    assert response.headers['Content-Encoding'] == 'deflate'
+    assert zlib.decompress(response.data) == page
+
+    response = client.get('/', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == page
+    response = client.get('/user/purchases',
+                          headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_json()['transactions'] == []
+
+
+def test_streamed_compression():
+    '''
+    Test that streamed responses are compressed and sent chunk by chunk,
+    rather than buffered until the end
+    '''
+    chunks = [f'line {i}\n'.encode() * 100 for i in range(3)]
+    sent = []
+
+    def stream(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        for chunk in chunks:
+            sent.append(chunk)
+            yield chunk
+
+    def startResponse(status, headers, exc_info=None):
+        startResponse.headers = dict(headers)
+
+    middleware = CompressionMiddleware(stream, minSize=0)
+    body = middleware(create_environ(headers={'Accept-Encoding': 'gzip'}),
+                      startResponse)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for i, data in enumerate(body):
+        if len(sent) == i + 1:
+            # Each chunk decompresses as soon as it is received
+            assert decompressor.decompress(data) == chunks[i]
+        else:
+            decompressor.decompress(data)
+    assert startResponse.headers['Content-Encoding'] == 'gzip'
+    assert decompressor.eof
+
+
+def test_history_api():
+    '''
+    Test that purchase and sales history are served as paginated JSON
+    '''
+    register('History Buyer', 'historyBuyer@test.com', 'Password1!')
+    register('History Seller', 'historySeller@test.com', 'Password1!')
+    createProduct(productName='History Item',
+                  description='This is a test description',
+                  price=10.0,
+                  last_modified_date=dt.datetime(2021, 10, 8),
+                  owner_email='historySeller@test.com')
+    buyer = User.query.filter_by(email='historyBuyer@test.com').first()
+    product = Product.query.filter_by(productName='History Item').first()
+    purchaseProduct(buyer.id, product.id)
+
+    data = loggedInClient('historyBuyer@test.com').get('/user/purchases')\
+        .get_json()
+    assert data['nextCursor'] is None
+    assert [t['productName'] for t in data['transactions']] == \
+        ['History Item']
+    data = loggedInClient('historySeller@test.com').get('/user/sales')\
+        .get_json()
+    assert data['transactions'][0]['customerId'] == buyer.id
+
+
+def test_histogram_quantiles():
+    '''
+    Test that quantiles are interpolated within histogram buckets
+    '''
+    h = Histogram((1.0, 2.0, 4.0))
+    assert h.quantile(0.5) == 0
+    for value in [0.5] * 50 + [1.5] * 40 + [3.0] * 9 + [10.0]:
+        h.observe(value)
+    assert h.count == 100
+    assert h.quantile(0.5) == 1.0
+    assert 1.0 < h.quantile(0.7) < 2.0
+    assert 2.0 < h.quantile(0.95) <= 4.0
+    assert h.quantile(1.0) == 4.0
+
+
+# Header Prometheus sends with the token set by the metrics tests
+SCRAPER = {'Authorization': 'Bearer scrape-token'}
+
+
+def test_metrics_endpoint(monkeypatch):
+    '''
+    Test that requests are recorded per route with SQL and render timings,
+    and exported in Prometheus text format to holders of the token
+    '''
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'scrape-token')
+    register('Metrics', 'metrics@test.com', 'Password1!')
+    client = loggedInClient('metrics@test.com')
+    client.get('/')
+    response = client.get('/_metrics', headers=SCRAPER)
+    assert response.status_code == 200
+    text = response.get_data(as_text=True)
+    label = 'method="GET",route="/"'
+    assert f'qbay_request_duration_seconds_count{{{label}}}' in text
+    assert f'qbay_render_duration_seconds_count{{{label}}}' in text
+    assert f'qbay_request_duration_quantile_seconds{{{label},' \
+        'quantile="0.99"}' in text
+    statements = [line for line in text.splitlines()
+                  if line.startswith(f'qbay_sql_statements_total{{{label}}}')]
+    assert int(statements[0].split()[-1]) > 0
+
+    # Local requests, such as from a reverse proxy, need the token too
+    assert client.get('/_metrics').status_code == 404
+    response = client.get('/_metrics',
+                          headers={'Authorization': 'Bearer wrong'})
+    assert response.status_code == 404
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', None)
+    assert client.get('/_metrics', headers=SCRAPER).status_code == 404
+
+
+def test_macro_render_time():
+    '''
+    Test that rows rendered from macros, outside render_template, count as
+    render time
+    '''
+    with app.test_request_context('/'):
+        g.metricsRenderTime = 0.0
+        row = timedMacro(lambda product: time.sleep(0.01) or product)
+        assert row('Rendered') == 'Rendered'
+        assert g.metricsRenderTime >= 0.01
+
+
+def test_search_page():
+    '''
+    Test that the search page renders matching products
+    '''
+    register('Page Searcher', 'pageSearcher@test.com', 'Password1!')
+    register('Page Seller', 'pageSeller@test.com', 'Password1!')
+    createProduct(productName='Wombat Clock',
+                  description='A clock shaped like a wombat',
+                  price=10.0,
+                  last_modified_date=dt.datetime(2021, 10, 8),
+                  owner_email='pageSeller@test.com')
+    client = loggedInClient('pageSearcher@test.com')
+    response = client.get('/search?q=wombat')
+    assert response.status_code == 200
+    assert b'Wombat Clock' in response.data
+    assert b'Seller: Page Seller' in response.data
+    assert b'No products found' in client.get('/search?q=nothing').data
+
+
+def test_worker_after_fork():
+    '''
+    Test that a new worker process gets its own connection pool, without
+    closing the connections the master process still holds
+    '''
+    with app.app_context():
+        pool = db.engine.pool
+        conn = db.engine.connect()
+        afterFork(app)(None, None)
+        assert db.engine.pool is not pool
+        assert conn.execute(text('SELECT 1')).scalar() == 1
+        conn.close()
+
+
+def test_pool_exhaustion(monkeypatch):
+    '''
+    Test that requests fail fast with 503 when every pooled connection is
+    in use, and that checkout waits and timeouts are exported
+    '''
+    register('Pool', 'pool@test.com', 'Password1!')
+    client = loggedInClient('pool@test.com')
+    with app.app_context():
+        pool = db.engine.pool
+        monkeypatch.setattr(pool, '_timeout', 0.05)
+        # Requests from the test client share this thread's session
+        db.session.remove()
+        held = [db.engine.connect()
+                for _ in range(pool.size() + pool._max_overflow
+                               - pool.checkedout())]
+        try:
+            response = client.get('/')
+            assert response.status_code == 503
+            assert response.headers['Retry-After'] == '1'
+        finally:
+            for conn in held:
+                conn.close()
+    assert client.get('/').status_code == 200
+
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'scrape-token')
+    page = client.get('/_metrics', headers=SCRAPER).get_data(as_text=True)
+    assert 'qbay_db_pool_checkout_seconds_count{pool="default"}' in page
+    timeouts = [line for line in page.splitlines()
+                if line.startswith('qbay_db_pool_timeouts_total')]
+    assert int(timeouts[0].split()[-1]) >= 1
+    assert '# TYPE qbay_db_pool_checked_out gauge' in page
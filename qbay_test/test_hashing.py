@@ -0,0 +1,85 @@
+from qbay.hashing import getHasher, hashPassword, verifyPassword, \
+    needsRehash, HashingPool, HashingPoolFull, _hash, _verify
+from qbay.models import db, User
+from qbay.backend import login
+from uuid import uuid4
+import hashlib
+import pytest
+import threading
+import time
+
+
+@pytest.mark.parametrize("name, cost", [
+    ['pbkdf2_sha256', 1000],
+    ['scrypt', 2 ** 10],
+])
+def test_hasher_roundtrip(name, cost):
+    '''
+    Test that each algorithm verifies its own hashes and rejects others
+    '''
+    hasher = getHasher(name, cost)
+    encoded = hasher.hash('P&ssw0rd')
+    assert encoded.split("$")[:2] == [name, str(cost)]
+    assert verifyPassword('P&ssw0rd', encoded)
+    assert not verifyPassword('P&ssw0rD', encoded)
+    # Salts are random, so hashes of the same password differ
+    assert hasher.hash('P&ssw0rd') != encoded
+
+
+def test_malformed_hash():
+    '''
+    Test that hashes which cannot be parsed never verify
+    '''
+    assert not verifyPassword('P&ssw0rd', '')
+    assert not verifyPassword('P&ssw0rd', 'unknown$1$00$00')
+    assert not verifyPassword('P&ssw0rd', 'pbkdf2_sha256$1$zz')
+
+
+def test_legacy_rehash():
+    '''
+    Test that legacy salted SHA-512 hashes are upgraded on login
+    '''
+    salt = str(uuid4())
+    legacy = salt + ":" + hashlib.sha512(('P&ssw0rd' + salt)
+                                         .encode('utf-8')).hexdigest()
+    user = User(id=str(uuid4()), username="Rehash test",
+                email='rehash@test.com', password=legacy, balance=100,
+                shippingAddress="", postalCode="")
+    db.session.add(user)
+    db.session.commit()
+    assert needsRehash(legacy)
+
+    assert login('rehash@test.com', 'P&ssw0rd', '127.0.0.1') is not None
+    user = User.query.filter_by(email='rehash@test.com').one()
+    assert not needsRehash(user.password)
+    assert user.password != legacy
+    # The new hash still accepts the same password
+    assert login('rehash@test.com', 'P&ssw0rd', '127.0.0.1') is not None
+    assert hashPassword('P&ssw0rd') != user.password
+
+
+def test_hashing_pool_saturation():
+    '''
+    Test that the hashing pool runs jobs, and rejects jobs once every worker
+    and queue slot is taken
+    '''
+    pool = HashingPool('thread', 1, 1)
+    encoded = pool.run(_hash, 'pbkdf2_sha256', 1000, 'P&ssw0rd')
+    assert verifyPassword('P&ssw0rd', encoded)
+
+    # Occupy the worker and the queue slot
+    release = threading.Event()
+    threads = [threading.Thread(target=pool.run, args=(release.wait,))
+               for _ in range(2)]
+    for t in threads:
+        t.start()
+    while pool._slots._value > 0:
+        time.sleep(0.01)
+    with pytest.raises(HashingPoolFull):
+        pool.run(_hash, 'pbkdf2_sha256', 1000, 'P&ssw0rd')
+
+    release.set()
+    for t in threads:
+        t.join()
+    # Slots are released once the jobs finish
+    assert pool.run(_verify, 'P&ssw0rd', encoded)
@@ -0,0 +1,260 @@
+from qbay import app
+from qbay import images
+from qbay.images import ProductPicture, imageInfo, imageStore, \
+    saveProductImage, pictureFor, resize, ResizeError, collectImages, \
+    recountImages, storageStats
+from qbay.models import db, Product, ImageBlob
+from qbay.backend import register, createProduct
+from sqlalchemy_imageattach.context import store_context
+from qbay_test.test_controllers import loggedInClient
+import datetime as dt
+import hashlib
+import io
+import os
+import pytest
+import re
+import struct
+import time
+import zlib
+
+
+def png(width, height):
+    '''
+    Build a valid black PNG of the given size
+    '''
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data \
+            + struct.pack('>I', zlib.crc32(kind + data))
+    rows = b''.join(b'\x00' + b'\x00\x00\x00' * width for _ in range(height))
+    return b'\x89PNG\r\n\x1a\n' \
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0,
+                                     0)) \
+        + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    '''
+    Use a temporary image store, and resize without ImageMagick
+    '''
+    monkeypatch.setattr(imageStore, 'path', str(tmp_path))
+    monkeypatch.setattr(images, 'resize',
+                        lambda path, width, height: png(width, height))
+    monkeypatch.setitem(app.config, 'THUMBNAIL_SIZES', [160, 480])
+    return tmp_path
+
+
+def sellerProduct(name, email):
+    register(name, email, 'Password1!')
+    createProduct(productName=name + ' Photo',
+                  description='This is a test description',
+                  price=10.0,
+                  last_modified_date=dt.datetime(2021, 10, 8),
+                  owner_email=email)
+    return Product.query.filter_by(ownerEmail=email).one()
+
+
+def test_image_info():
+    '''
+    Test that image types and sizes are read from headers only
+    '''
+    jpeg = b'\xff\xd8' + b'\xff\xe0' + struct.pack('>H', 16) + b'\x00' * 14 \
+        + b'\xff\xc0' + struct.pack('>HBHH', 17, 8, 200, 300)
+    gif = b'GIF89a' + struct.pack('<HH', 3, 2) + b'\x00' * 8
+    webp = b'RIFF' + b'\x00' * 4 + b'WEBPVP8X' + b'\x00' * 8 \
+        + (639).to_bytes(3, 'little') + (479).to_bytes(3, 'little')
+    assert imageInfo(io.BytesIO(png(4, 3))) == ('image/png', 4, 3)
+    assert imageInfo(io.BytesIO(jpeg)) == ('image/jpeg', 300, 200)
+    assert imageInfo(io.BytesIO(gif)) == ('image/gif', 3, 2)
+    assert imageInfo(io.BytesIO(webp)) == ('image/webp', 640, 480)
+    for data in [b'not an image', png(4, 3)[:20], jpeg[:-3],
+                 b'\xff\xd8\xff\xff']:
+        with pytest.raises(ValueError):
+            imageInfo(io.BytesIO(data))
+
+
+def test_thumbnails(store):
+    '''
+    Test that thumbnails are made in the background, and that replacing a
+    picture removes files nothing refers to anymore
+    '''
+    product = sellerProduct('Thumb Seller', 'thumbSeller@test.com')
+    assert saveProductImage(product.id, io.BytesIO(png(800, 600))).result() \
+        == 2
+    db.session.expire_all()
+    pictures = product.image.order_by(ProductPicture.width).all()
+    assert [p.size for p in pictures] == [(160, 120), (480, 360), (800, 600)]
+    assert [p.original for p in pictures] == [False, False, True]
+    assert pictureFor(product, 300).width == 480
+    assert pictureFor(product, 1000).width == 800
+    old = [imageStore.filePath(p) for p in pictures]
+    assert all(os.path.exists(path) for path in old)
+
+    # Smaller than every thumbnail width, so only the original is kept
+    assert saveProductImage(product.id, io.BytesIO(png(100, 50))).result() \
+        == 0
+    db.session.expire_all()
+    assert [p.size for p in product.image] == [(100, 50)]
+    assert not any(os.path.exists(path) for path in old)
+
+
+def test_shared_images(store, monkeypatch):
+    '''
+    Test that identical pictures are stored once with shared thumbnails,
+    and deleted when the last product using them is
+    '''
+    resized = []
+    monkeypatch.setattr(images, 'resize', lambda path, width, height:
+                        resized.append(width) or png(width, height))
+    first = sellerProduct('Shared Seller', 'sharedSeller@test.com')
+    second = sellerProduct('Shared Seller Two', 'sharedSellerTwo@test.com')
+    baseline = storageStats()
+    assert saveProductImage(first.id, io.BytesIO(png(800, 600))).result() \
+        == 2
+    assert saveProductImage(second.id, io.BytesIO(png(800, 600))).result() \
+        == 2
+    assert resized == [160, 480]
+
+    db.session.expire_all()
+    pictures = ProductPicture.query.filter(
+        ProductPicture.productId.in_([first.id, second.id])).all()
+    hashes = {p.contentHash for p in pictures}
+    assert len(pictures) == 6 and len(hashes) == 3
+    blobs = ImageBlob.query.filter(ImageBlob.contentHash.in_(hashes)).all()
+    assert [blob.refCount for blob in blobs] == [2, 2, 2]
+    stats = storageStats()
+    size = sum(blob.size for blob in blobs)
+    assert stats['files'] - baseline['files'] == 3
+    assert stats['savedBytes'] - baseline['savedBytes'] == size
+
+    # Still used by the second product
+    saveProductImage(first.id, io.BytesIO(png(90, 90))).result()
+    paths = [imageStore.filePath(p) for p in pictures[:3]]
+    assert all(os.path.exists(path) for path in paths)
+
+    # sqlalchemy_imageattach needs a store to delete pictures from
+    with store_context(imageStore):
+        db.session.delete(db.session.get(Product, second.id))
+        db.session.commit()
+    assert collectImages() == (3, size)
+    assert not any(os.path.exists(path) for path in paths)
+    assert ImageBlob.query.filter(ImageBlob.contentHash.in_(hashes)).count() \
+        == 0
+
+    # Counts can be rebuilt from the pictures
+    db.session.query(ImageBlob).update({'refCount': 0})
+    db.session.commit()
+    recountImages()
+    assert ImageBlob.query.filter_by(refCount=0).count() == 0
+
+
+def test_failed_upload_files(store):
+    '''
+    Test that the file of an upload that rolled back is kept until it is an
+    hour old, then deleted by gc-images without touching used files
+    '''
+    product = sellerProduct('Orphan Seller', 'orphanSeller@test.com')
+    saveProductImage(product.id, io.BytesIO(png(100, 100))).result()
+    used = imageStore.filePath(product.image.original)
+
+    data = png(120, 120)
+    with store_context(imageStore):
+        product.image.from_raw_file(
+            io.BytesIO(data), imageStore, size=(120, 120),
+            mimetype='image/png', original=False,
+            extra_kwargs={'contentHash': hashlib.sha256(data).hexdigest()})
+        db.session.flush()
+        db.session.rollback()
+    orphan = os.path.join(str(store), imageStore.relativePath(
+        hashlib.sha256(data).hexdigest(), 'image/png'))
+    assert os.path.exists(orphan)
+    assert collectImages(orphans=True) == (0, 0)
+    assert os.path.exists(orphan)
+
+    old = time.time() - images.ORPHAN_AGE - 1
+    for path in [used, orphan]:
+        os.utime(path, (old, old))
+    assert collectImages(orphans=True) == (1, len(data))
+    assert not os.path.exists(orphan)
+    assert os.path.exists(used)
+
+
+def test_image_upload_and_serving(store):
+    '''
+    Test uploading a picture and serving it with cache, range and
+    conditional request headers
+    '''
+    product = sellerProduct('Upload Seller', 'uploadSeller@test.com')
+    client = loggedInClient('uploadSeller@test.com')
+    response = client.post(f'/product/image/{product.productName}',
+                           data={'image': (io.BytesIO(png(800, 600)),
+                                           'photo.png')})
+    assert response.status_code == 302
+    for _ in range(50):
+        if ProductPicture.query.filter_by(productId=product.id).count() == 3:
+            break
+        time.sleep(0.1)
+    db.session.remove()
+
+    page = client.get(f'/product/update/{product.productName}').data.decode()
+    url = re.search(r'src="(/images/[^"]+)"', page).group(1)
+    digest = url.rsplit('/', 1)[1].split('.')[0]
+    assert 'width="480"' in page
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.data == png(480, 360)
+    assert response.headers['ETag'] == f'"{digest}"'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'max-age=31536000' in response.headers['Cache-Control']
+
+    response = client.get(url, headers={'Range': 'bytes=0-7'})
+    assert response.status_code == 206
+    assert response.data == b'\x89PNG\r\n\x1a\n'
+    response = client.get(url, headers={'If-None-Match': f'"{digest}"'})
+    assert response.status_code == 304
+    assert client.get('/images/../db.sqlite').status_code == 404
+
+    response = client.post(f'/product/image/{product.productName}',
+                           data={'image': (io.BytesIO(b'text'), 'a.txt')})
+    assert b'Unsupported image type' in response.data
+
+
+def test_upload_limits(store, monkeypatch):
+    '''
+    Test that uploads over the size limit are cut off while streaming, and
+    that images claiming too many pixels are rejected from their header
+    '''
+    monkeypatch.setitem(app.config, 'IMAGE_MAX_SIZE', 1000)
+    product = sellerProduct('Limit Seller', 'limitSeller@test.com')
+    client = loggedInClient('limitSeller@test.com')
+    url = f'/product/image/{product.productName}'
+    # Cut off while streaming, and rejected from the body length
+    for size in [2000, 200000]:
+        response = client.post(url, data={
+            'image': (io.BytesIO(png(8, 8) + b'\x00' * size), 'big.png')})
+        assert response.status_code == 413
+        assert b'Images can be at most' in response.data
+
+    # Only the header of a decompression bomb is read
+    bomb = png(1, 1)
+    bomb = bomb[:16] + struct.pack('>II', 100000, 100000) + bomb[24:]
+    response = client.post(url, data={'image': (io.BytesIO(bomb), 'a.png')})
+    assert b'Image is too large' in response.data
+    assert response.status_code == 413
+    assert ProductPicture.query.filter_by(productId=product.id).count() == 0
+    assert client.post(url, data={}).status_code == 400
+
+
+def test_resize_errors(tmp_path, monkeypatch):
+    '''
+    Test that resize failures and timeouts in the resize process are
+    reported as ResizeError
+    '''
+    path = tmp_path / 'broken.png'
+    path.write_bytes(png(8, 8)[:30])
+    with pytest.raises(ResizeError):
+        resize(str(path), 4, 4)
+    monkeypatch.setitem(app.config, 'IMAGE_RESIZE_TIMEOUT', 0.001)
+    with pytest.raises(ResizeError, match='took over'):
+        resize(str(path), 4, 4)
@@ -0,0 +1,76 @@
+from qbay.importer import readRows, importProducts
+from qbay.backend import register
+from qbay.models import Product
+import io
+import json
+
+CSV = '''productName,description,price,ownerEmail,lastModifiedDate
+Import A,This is a test description,10,importer@test.com,2021-10-08
+Import B,This is a test description,20,importer@test.com,2021-10-08
+Import A,This is a test description,10,importer@test.com,2021-10-08
+Import C,This is a test description,abc,importer@test.com,2021-10-08
+Import D,This is a test description,10,nobody@test.com,2021-10-08
+Import E,Too short,10,importer@test.com,2021-10-08
+'''
+
+
+def test_import_csv():
+    '''
+    Test that valid CSV rows are imported across batches and invalid rows
+    are reported with their row number
+    '''
+    register('Importer', 'importer@test.com', 'Password1!')
+    report = importProducts(readRows(io.StringIO(CSV), 'csv'), batchSize=2)
+
+    assert report.imported == 2
+    assert report.rows == 6
+    assert [row for row, _ in report.errors] == [4, 5, 6, 7]
+    assert 'already has product' in report.errors[0][1]
+    assert 'Invalid price' in report.errors[1][1]
+    assert 'Owner does not exist' in report.errors[2][1]
+    assert report.rowsPerSecond > 0
+    product = Product.query.filter_by(ownerEmail='importer@test.com',
+                                      productName='Import B').one()
+    assert product.price == 20 and product.sold is False
+
+    # Importing again finds the existing products
+    report = importProducts(readRows(io.StringIO(CSV), 'csv'))
+    assert report.imported == 0
+
+
+def test_import_jsonl():
+    '''
+    Test that JSON Lines imports report unparseable lines
+    '''
+    register('Json Importer', 'jsonImporter@test.com', 'Password1!')
+    lines = io.StringIO(
+        '{"productName": "Json A", "description": "This is a test '
+        'description", "price": 15, "ownerEmail": "jsonImporter@test.com", '
+        '"lastModifiedDate": "2021-10-08T12:00:00"}\n'
+        '\n'
+        '{"productName": \n'
+        '[1, 2]\n')
+    report = importProducts(readRows(lines, 'jsonl'))
+    assert report.imported == 1
+    assert [row for row, _ in report.errors] == [3, 4]
+
+
+def test_import_jsonl_types():
+    '''
+    Test that JSON Lines values of the wrong type are reported as row errors
+    instead of stopping the import
+    '''
+    register('Typed Importer', 'typedImporter@test.com', 'Password1!')
+    valid = {'productName': 'Typed A', 'price': 15,
+             'description': 'This is a test description',
+             'ownerEmail': 'typedImporter@test.com',
+             'lastModifiedDate': '2021-10-08T12:00:00'}
+    rows = [valid, dict(valid, productName=5), dict(valid, description=[]),
+            dict(valid, ownerEmail={'a': 1}), dict(valid, lastModifiedDate=3),
+            dict(valid, price=True), dict(valid, price=None)]
+    lines = io.StringIO(''.join(json.dumps(row) + '\n' for row in rows))
+    report = importProducts(readRows(lines, 'jsonl'))
+    assert report.imported == 1
+    assert [row for row, _ in report.errors] == [2, 3, 4, 5, 6, 7]
+    assert 'productName 5' in report.errors[0][1]
+    assert 'Invalid price' in report.errors[4][1]